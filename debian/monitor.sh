@@ -1,6 +1,8 @@
 #!/bin/bash
 
 # monitor.sh
+# DEPRECADO: lo sustituye debian/suspend_agent.py (ver services.txt). No ejecutar los
+# dos a la vez: cada uno pararia y suspenderia el servidor por su cuenta.
 # Monitorea jugadores conectados y suspende el servidor si est inactivo
 
 # Configuracin
@@ -116,6 +118,11 @@ monitor_players() {
     done
 }
 
-# Ejecutar monitoreo
+# Ejecutar monitoreo (nunca junto al agente de suspension)
+if pgrep -f '^[^ ]*python[0-9.]* [^ ]*suspend_agent\.py' > /dev/null; then
+    echo "$(date): suspend_agent.py ya esta en marcha - monitor.sh no arranca"
+    exit 1
+fi
+echo "$(date): AVISO: monitor.sh esta deprecado, usar suspend_agent.py (ver services.txt)"
 echo "Iniciando monitoreo de jugadores..."
 monitor_players
\ No newline at end of file
@@ -1,2 +1,2 @@
 #!/bin/bash
-mcrcon -H 127.0.0.1 -P 25575 -p minecraft "$@"
+python3 "$(dirname "$0")/rcon_client.py" -H 127.0.0.1 -P 25575 -p minecraft "$@"
@@ -0,0 +1,274 @@
+# -*- coding: utf-8 -*-
+# rcon_client.py
+# Cliente RCON de Minecraft que mantiene una sola conexion autenticada
+# y la reutiliza entre comandos (en vez de lanzar mcrcon cada vez).
+#
+# Como libreria:
+#     rcon = RconClient()
+#     rcon.command("list")
+#     rcon.commands(["list", "tps", "save-all"])   # en orden, por la misma conexion
+#
+# Como comando (sustituye a mcrcon en rcon.sh):
+#     python3 rcon_client.py "say hola" list
+#     python3 rcon_client.py                       # modo interactivo
+#
+# Comprobacion de los parsers de "list" (doctests):
+#     python3 -m doctest rcon_client.py
+import argparse
+import re
+import socket
+import struct
+import sys
+import threading
+
+# --- CONFIGURACION ---
+RCON_HOST = "localhost"
+RCON_PORT = 25575
+RCON_PASSWORD = "minecraft"
+RCON_TIMEOUT = 10
+
+# Tipos de paquete del protocolo RCON
+SERVERDATA_AUTH = 3
+SERVERDATA_AUTH_RESPONSE = 2
+SERVERDATA_EXECCOMMAND = 2
+SERVERDATA_RESPONSE_VALUE = 0
+# Tipo desconocido para el servidor: responde "Unknown request" con el mismo id.
+# El servidor parte las respuestas cada 4096 bytes; si llega un trozo completo se
+# envia este marcador y lo que llegue antes de su respuesta es el resto
+MARKER_TYPE = 200
+RESPONSE_CHUNK = 4096
+
+# El hilo RCON de vanilla/Paper lee como mucho 1460 bytes por read() y cierra la conexion
+# si lo leido no es exactamente un paquete: un paquete por escritura y sin enviar el
+# siguiente hasta tener la respuesta del anterior
+MAX_PACKET_SIZE = 1460
+
+# Comandos que solo consultan: se pueden repetir si la conexion se cae sin respuesta.
+# Los demas (stop, save-all, say...) podrian haberse ejecutado ya y no se repiten
+READ_ONLY_COMMANDS = frozenset({'list', 'tps', 'mspt', 'seed', 'help', 'version', 'plugins'})
+
+# TCP_QUICKACK solo existe en Linux
+QUICKACK = hasattr(socket, 'TCP_QUICKACK')
+
+# Cabecera: longitud, id de peticion, tipo (little endian)
+HEADER = struct.Struct('<iii')
+
+# Codigos de color de Minecraft (§a, §l, ...)
+COLOR_CODES = re.compile('§.')
+
+class RconError(Exception):
+    """Error de protocolo o de autenticacion RCON"""
+
+class RconAuthError(RconError):
+    """Contrasena RCON incorrecta (no tiene sentido reintentar)"""
+
+def encode_packet(request_id, packet_type, body):
+    payload = struct.pack('<ii', request_id, packet_type) + body.encode('utf-8') + b'\x00\x00'
+    if len(payload) + 4 > MAX_PACKET_SIZE:
+        raise RconError(f"Comando demasiado largo para RCON ({len(payload) + 4} bytes, maximo {MAX_PACKET_SIZE})")
+    return struct.pack('<i', len(payload)) + payload
+
+def is_read_only(command):
+    words = command.split(None, 1)
+    return bool(words) and words[0].lstrip('/').lower() in READ_ONLY_COMMANDS
+
+class RconClient:
+    """Conexion RCON persistente. Se conecta al primer comando y se reconecta
+    sola si el servidor cierra la conexion (p. ej. tras un reinicio).
+    Es segura entre hilos: los comandos de distintos hilos se serializan"""
+
+    def __init__(self, host=RCON_HOST, port=RCON_PORT, password=RCON_PASSWORD, timeout=RCON_TIMEOUT):
+        self.host = host
+        self.port = port
+        self.password = password
+        self.timeout = timeout
+        self.sock = None
+        self._buffer = bytearray()
+        self._next_id = 0
+        self._lock = threading.Lock()
+
+    def connect(self):
+        """Abre la conexion y se autentica"""
+        self.close()
+        sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.sock = sock
+        try:
+            request_id = self._new_id()
+            self.sock.sendall(encode_packet(request_id, SERVERDATA_AUTH, self.password))
+            response_id, packet_type, _ = self._recv_packet()
+            # El servidor responde con id -1 si la contrasena es incorrecta
+            if response_id == -1 or response_id != request_id or packet_type != SERVERDATA_AUTH_RESPONSE:
+                raise RconAuthError("Autenticacion RCON rechazada")
+        except BaseException:
+            self.close()
+            raise
+
+    def close(self):
+        if self.sock is not None:
+            try:
+                self.sock.close()
+            except OSError:
+                pass
+            self.sock = None
+        self._buffer.clear()
+
+    def command(self, command):
+        """Ejecuta un comando y devuelve la respuesta"""
+        return self.commands([command])[0]
+
+    def commands(self, commands):
+        """Ejecuta varios comandos en orden por la misma conexion y devuelve las respuestas"""
+        with self._lock:
+            return [self._execute(command) for command in commands]
+
+    def _execute(self, command):
+        """Un comando. Si la conexion estaba rota se reconecta; el comando solo se repite
+        si es de consulta (READ_ONLY_COMMANDS), porque sin respuesta no se sabe si se ejecuto"""
+        for attempt in (1, 2):
+            try:
+                if self.sock is None:
+                    self.connect()
+                return self._round_trip(command)
+            except (OSError, RconError) as e:
+                self.close()
+                if attempt == 2 or isinstance(e, RconAuthError) or not is_read_only(command):
+                    raise
+
+    def _round_trip(self, command):
+        request_id = self._new_id()
+        self.sock.sendall(encode_packet(request_id, SERVERDATA_EXECCOMMAND, command))
+        parts = [self._recv_response(request_id)]
+        if len(parts[0]) >= RESPONSE_CHUNK:
+            # Respuesta partida: el servidor ya esta enviando el resto y contesta al
+            # marcador despues del ultimo trozo
+            marker_id = self._new_id()
+            self.sock.sendall(encode_packet(marker_id, MARKER_TYPE, ''))
+            while True:
+                response_id, _, body = self._recv_packet()
+                if response_id == marker_id:
+                    break
+                if response_id != request_id:
+                    raise RconError(f"Respuesta RCON inesperada (id {response_id}, esperado {request_id})")
+                parts.append(body)
+        return b''.join(parts).decode('utf-8', errors='replace')
+
+    def _recv_response(self, request_id):
+        response_id, _, body = self._recv_packet()
+        if response_id != request_id:
+            raise RconError(f"Respuesta RCON inesperada (id {response_id}, esperado {request_id})")
+        return body
+
+    def _new_id(self):
+        self._next_id = self._next_id % 0x7fffffff + 1
+        return self._next_id
+
+    def _recv_packet(self):
+        length, request_id, packet_type = HEADER.unpack(self._recv_exact(HEADER.size))
+        if length < 10:
+            raise RconError(f"Paquete RCON invalido (longitud {length})")
+        body = self._recv_exact(length - 8)
+        return request_id, packet_type, body[:-2]
+
+    def _recv_exact(self, size):
+        # Una respuesta larga llega en varios paquetes seguidos:
+        # leer en bloques grandes y cortar del buffer
+        while len(self._buffer) < size:
+            if QUICKACK:
+                # El servidor escribe cada paquete por separado con Nagle activo: sin ACK
+                # inmediato el trozo siguiente esperaria al ACK retardado (~40 ms)
+                self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_QUICKACK, 1)
+            chunk = self.sock.recv(65536)
+            if not chunk:
+                raise RconError("El servidor cerro la conexion RCON")
+            self._buffer += chunk
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return data
+
+    def players(self):
+        """(jugadores conectados, maximo, nombres) segun "list" """
+        return parse_player_list(self.command("list"))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def parse_player_count(list_response):
+    """Jugadores conectados segun la respuesta de "list" (None si no se reconoce).
+    Paper colorea los numeros, asi que se quitan los codigos de color antes
+
+    >>> parse_player_count("There are 0 of a max of 20 players online: ")
+    0
+    >>> parse_player_count("There are §c0§6 out of maximum §c20§6 players online.")
+    0
+    >>> parse_player_count("There are §c3§6 out of maximum §c20§6 players online.\\ndefault: a, b, c")
+    3
+    >>> parse_player_count("Unknown command") is None
+    True
+    """
+    match = re.search(r'(\d+)\s+(?:of|out of)\b', COLOR_CODES.sub('', list_response))
+    return int(match.group(1)) if match else None
+
+def parse_player_list(list_response):
+    """(conectados, maximo, nombres) segun la respuesta de "list" (None si no se reconoce)
+
+    >>> parse_player_list("There are 2 of a max of 20 players online: Steve, Alex")
+    (2, 20, ['Steve', 'Alex'])
+    >>> parse_player_list("There are §c2§6 out of maximum §c20§6 players online.\\n§6default§r: Steve, Alex")
+    (2, 20, ['Steve', 'Alex'])
+    """
+    text = COLOR_CODES.sub('', list_response)
+    match = re.search(r'(\d+)\s+(?:of a max of|out of maximum)\s+(\d+)[^:\n]*[:\n]?(.*)', text, re.S)
+    if not match:
+        return None
+    names = []
+    for line in match.group(3).splitlines():
+        # Paper agrupa por rango: "default: jugador1, jugador2"
+        line = line.split(':', 1)[-1]
+        names.extend(name.strip() for name in line.split(',') if name.strip())
+    return int(match.group(1)), int(match.group(2)), names
+
+def strip_colors(text):
+    return COLOR_CODES.sub('', text)
+
+def interactive(rcon):
+    """Consola interactiva: un comando por linea, Q o Ctrl+D para salir"""
+    while True:
+        try:
+            line = input("> ").strip()
+        except (EOFError, KeyboardInterrupt):
+            print()
+            return
+        if not line:
+            continue
+        if line in ('Q', 'quit', 'exit'):
+            return
+        print(strip_colors(rcon.command(line)))
+
+def main():
+    parser = argparse.ArgumentParser(description="Cliente RCON de Minecraft (sustituto de mcrcon)")
+    parser.add_argument('-H', '--host', default=RCON_HOST)
+    parser.add_argument('-P', '--port', type=int, default=RCON_PORT)
+    parser.add_argument('-p', '--password', default=RCON_PASSWORD)
+    parser.add_argument('-r', '--raw', action='store_true', help="No quitar los codigos de color")
+    parser.add_argument('commands', nargs='*', help="Comandos a ejecutar (sin comandos: modo interactivo)")
+    args = parser.parse_args()
+
+    try:
+        with RconClient(args.host, args.port, args.password) as rcon:
+            if not args.commands:
+                interactive(rcon)
+                return 0
+            for response in rcon.commands(args.commands):
+                if response:
+                    print(response if args.raw else strip_colors(response))
+        return 0
+    except (OSError, RconError) as e:
+        print(f"[RCON] Error: {e}", file=sys.stderr)
+        return 1
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,223 @@
+# -*- coding: utf-8 -*-
+# suspend_agent.py
+# Para el servidor de Minecraft y suspende la maquina cuando nadie juega.
+# Sustituye el bucle de monitor.sh: la actividad la da el proxy de la Raspberry
+# (GET /idle) y los jugadores una conexion RCON persistente, sin lanzar procesos.
+# Se despliega como la unidad minecraft-suspend (ver services.txt)
+import json
+import os
+import socket
+import subprocess
+import time
+import urllib.request
+
+from rcon_client import RconClient, RconError, parse_player_count
+
+# --- CONFIGURACION ---
+SERVER_DIR = "/home/paip/minecraft/server"
+MINECRAFT_PORT = 25565
+
+# Endpoint de actividad del proxy (IDLE_ENDPOINT_ENABLED en minecraft_proxy.py)
+PROXY_IDLE_URL = "http://raspberrypi.local:9466/idle"
+PROXY_BACKEND = "principal"  # nombre de este servidor en el proxy
+PROXY_TIMEOUT = 5
+
+IDLE_TIMEOUT = 600       # 10 minutos sin jugadores antes de suspender
+GRACE_PERIOD = 300       # 5 minutos de gracia despues de arrancar o despertar
+CHECK_INTERVAL = 60      # maximo entre comprobaciones (se acorta para caer justo en IDLE_TIMEOUT)
+SHUTDOWN_WARNING = 30    # aviso a los jugadores antes de parar
+STOP_TIMEOUT = 180       # maximo esperando a que el servidor termine de guardar y salga
+RCON_FAILURE_LIMIT = 3   # comprobaciones seguidas sin RCON antes de avisar con un error
+
+SUSPEND_COMMAND = ["sudo", "systemctl", "suspend"]
+
+def log(message):
+    print(f"[AGENTE] {message}", flush=True)
+
+def fetch_proxy_activity():
+    """(tuneles abiertos, segundos de inactividad, mantener despierto) segun el proxy, o
+    None si no responde. keep_awake es True durante una franja en la que el proxy preve
+    jugadores (PREWAKE_ENABLED)"""
+    try:
+        with urllib.request.urlopen(PROXY_IDLE_URL, timeout=PROXY_TIMEOUT) as response:
+            backend = json.load(response)["backends"][PROXY_BACKEND]
+        return backend["active_tunnels"], backend["idle_seconds"], backend.get("keep_awake", False)
+    except Exception as e:
+        log(f"No se pudo consultar la actividad del proxy: {e}")
+        return None
+
+def is_server_running():
+    """El servidor acepta conexiones en su puerto"""
+    try:
+        socket.create_connection(("127.0.0.1", MINECRAFT_PORT), timeout=2).close()
+        return True
+    except OSError:
+        return False
+
+def find_server_pid():
+    """PID del java que corre en SERVER_DIR, buscando en /proc"""
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            if os.readlink(f'/proc/{entry}/cwd') != SERVER_DIR:
+                continue
+            with open(f'/proc/{entry}/cmdline', 'rb') as f:
+                if b'java' in f.read():
+                    return int(entry)
+        except OSError:
+            continue
+    return None
+
+def legacy_monitor_pid():
+    """PID de un monitor.sh en marcha (el bucle antiguo), o None"""
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit() or int(entry) == os.getpid():
+            continue
+        try:
+            with open(f'/proc/{entry}/cmdline', 'rb') as f:
+                if any(os.path.basename(arg) == b'monitor.sh' for arg in f.read().split(b'\0')):
+                    return int(entry)
+        except OSError:
+            continue
+    return None
+
+def suspended_time():
+    """Segundos que la maquina lleva suspendida desde el arranque: CLOCK_BOOTTIME
+    sigue contando durante la suspension y CLOCK_MONOTONIC no"""
+    return time.clock_gettime(time.CLOCK_BOOTTIME) - time.monotonic()
+
+class SuspendAgent:
+    """Cuenta la inactividad con el proxy y RCON y suspende al cumplir IDLE_TIMEOUT"""
+
+    def __init__(self, rcon):
+        self.rcon = rcon
+        now = time.monotonic()
+        self.grace_until = now + GRACE_PERIOD
+        self.idle_since = now
+        self.last_suspended = suspended_time()
+        self.rcon_failures = 0
+
+    def check_resume(self):
+        """Detecta un despertar y abre el periodo de gracia"""
+        suspended = suspended_time()
+        if suspended - self.last_suspended > 1:
+            log(f"Despertar detectado. Periodo de gracia de {GRACE_PERIOD} segundos")
+            now = time.monotonic()
+            self.grace_until = now + GRACE_PERIOD
+            self.idle_since = now
+        self.last_suspended = suspended
+
+    def online_players(self):
+        try:
+            return parse_player_count(self.rcon.command("list"))
+        except (OSError, RconError) as e:
+            log(f"No se pudo obtener el estado de jugadores: {e}")
+            return None
+
+    def idle_seconds(self):
+        """Segundos sin jugadores. Normalmente hace falta que lo digan el proxy y RCON:
+        RCON ve tambien a quien entra sin pasar por el proxy.
+        Si RCON falla, la inactividad se cuenta solo con el proxy (quien entre sin pasar
+        por el proxy no se ve) y tras RCON_FAILURE_LIMIT fallos seguidos se registra un
+        error. Solo si tampoco responde el proxy se toma como actividad"""
+        now = time.monotonic()
+        players = self.online_players()
+        activity = fetch_proxy_activity()
+        self.count_rcon_failure(players is None)
+        if players or (players is None and activity is None):
+            self.idle_since = now
+        idle = now - self.idle_since
+
+        if activity is not None:
+            active_tunnels, proxy_idle, keep_awake = activity
+            idle = 0 if active_tunnels or keep_awake else min(idle, proxy_idle)
+        return idle, players
+
+    def count_rcon_failure(self, failed):
+        if not failed:
+            if self.rcon_failures >= RCON_FAILURE_LIMIT:
+                log("RCON responde de nuevo")
+            self.rcon_failures = 0
+            return
+        self.rcon_failures += 1
+        if self.rcon_failures == RCON_FAILURE_LIMIT:
+            log(f"ERROR: RCON no responde en {RCON_FAILURE_LIMIT} comprobaciones seguidas - "
+                f"la inactividad se cuenta solo con el proxy")
+
+    def run(self):
+        log("Iniciando monitoreo de jugadores...")
+        while True:
+            self.check_resume()
+            delay = CHECK_INTERVAL
+
+            if not is_server_running():
+                log("Servidor no esta ejecutandose")
+                self.idle_since = time.monotonic()
+            else:
+                idle, players = self.idle_seconds()
+                grace = self.grace_until - time.monotonic()
+                if grace > 0:
+                    if idle == 0 and players:
+                        log(f"Jugadores conectados durante gracia: {players} - Eliminando periodo de gracia")
+                        self.grace_until = 0
+                    else:
+                        log(f"En periodo de gracia. Tiempo restante: {grace:.0f} segundos")
+                        # La inactividad se empieza a contar al terminar la gracia
+                        self.idle_since = time.monotonic()
+                        delay = min(delay, grace)
+                elif idle >= IDLE_TIMEOUT:
+                    self.shutdown()
+                    continue
+                elif idle > 0:
+                    log(f"Servidor vacio. Tiempo inactivo: {idle:.0f} segundos")
+                    delay = min(delay, IDLE_TIMEOUT - idle)
+                elif players:
+                    log(f"Jugadores conectados: {players}")
+
+            time.sleep(max(1, delay))
+
+    def shutdown(self):
+        """Avisa, para el servidor por RCON, espera a que salga y suspende"""
+        log(f"Sin jugadores por {IDLE_TIMEOUT} segundos. Suspender servidor...")
+        try:
+            self.rcon.command(f"say El servidor se suspendera por inactividad en {SHUTDOWN_WARNING} segundos")
+        except (OSError, RconError) as e:
+            log(f"No se pudo avisar a los jugadores: {e}")
+        time.sleep(SHUTDOWN_WARNING)
+
+        idle, _ = self.idle_seconds()
+        if idle < IDLE_TIMEOUT:
+            log("Alguien se conecto durante el aviso - suspension cancelada")
+            return
+
+        # Detener servidor de Minecraft correctamente
+        pid = find_server_pid()
+        try:
+            self.rcon.command("stop")
+        except (OSError, RconError) as e:
+            log(f"Error enviando stop: {e}")
+        self.rcon.close()
+
+        # Esperar a que el proceso termine de guardar y salga (o al menos a que cierre el puerto)
+        deadline = time.monotonic() + STOP_TIMEOUT
+        while time.monotonic() < deadline:
+            if pid is not None and not os.path.exists(f'/proc/{pid}'):
+                break
+            if pid is None and not is_server_running():
+                break
+            time.sleep(1)
+        else:
+            log(f"El servidor no termino en {STOP_TIMEOUT} segundos - suspendiendo igualmente")
+
+        # Suspender el sistema (al despertar, check_resume abre el periodo de gracia)
+        log("Suspendiendo el sistema")
+        subprocess.run(SUSPEND_COMMAND)
+
+if __name__ == '__main__':
+    # Los dos pararian y suspenderian el servidor por su cuenta
+    legacy = legacy_monitor_pid()
+    if legacy is not None:
+        log(f"monitor.sh sigue en marcha (pid {legacy}) - pararlo antes de arrancar el agente")
+        raise SystemExit(1)
+    SuspendAgent(RconClient()).run()
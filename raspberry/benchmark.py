@@ -0,0 +1,819 @@
+# -*- coding: utf-8 -*-
+"""Benchmarks y pruebas de carga para minecraft_proxy.py en una sola maquina Linux.
+
+Levanta un servidor de Minecraft falso (handshake, status, ping y login con eco),
+arranca el proxy apuntando a el y mide:
+  - tormentas de pings de lista de servidores (pings/s, p50/p99)
+  - logins concurrentes (tiempo hasta tener el tunel abierto, p50/p99)
+  - throughput sostenido por tunel (MB/s)
+  - microbenchmarks de write_varint, read_varint_from_bytes, read_packet y handle_handshake
+  - reproduccion de capturas reales del proxy (CAPTURE_ENABLED): los clientes envian lo
+    que enviaron los jugadores y el servidor falso lo que envio el servidor real, con los
+    mismos tiempos (o acelerados), y se mide la latencia de cada bloque a traves del proxy
+  - parada con SIGTERM: la captura queda completa aunque el proxy se pare con tuneles abiertos
+
+Uso:
+    python3 benchmark.py all
+    python3 benchmark.py --engine threads ping --clients 50 --duration 10
+    python3 benchmark.py micro
+    python3 benchmark.py replay capturas/*.mcap --speed 10
+    python3 benchmark.py --workers 2 shutdown
+"""
+import argparse
+import asyncio
+import json
+import os
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import timeit
+import tracemalloc
+import types
+
+PROXY_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'minecraft_proxy.py')
+ICON_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'server-icon.png')
+
+# --- PROTOCOLO (copia minima para no depender del proxy en los clientes) ---
+
+def write_varint(value):
+    data = bytearray()
+    while True:
+        byte = value & 0x7F
+        value >>= 7
+        if value:
+            data.append(byte | 0x80)
+        else:
+            data.append(byte)
+            return bytes(data)
+
+def encode_packet(packet_id, data=b''):
+    body = write_varint(packet_id) + data
+    return write_varint(len(body)) + body
+
+def encode_string(text):
+    data = text.encode('utf-8')
+    return write_varint(len(data)) + data
+
+def handshake_packet(port, next_state, protocol=767, host='localhost'):
+    return encode_packet(0x00, write_varint(protocol) + encode_string(host) + struct.pack('>H', port) + write_varint(next_state))
+
+def login_start_packet(name):
+    return encode_packet(0x00, encode_string(name) + os.urandom(16))
+
+async def read_varint_stream(reader):
+    value = 0
+    for i in range(5):
+        byte = (await reader.readexactly(1))[0]
+        value |= (byte & 0x7F) << (7 * i)
+        if not byte & 0x80:
+            return value
+    raise ValueError("VarInt demasiado largo")
+
+async def read_packet_stream(reader):
+    length = await read_varint_stream(reader)
+    return await reader.readexactly(length)
+
+def read_varint_bytes(data, position=0):
+    """(valor, posicion siguiente) de un VarInt dentro de data"""
+    value = 0
+    for i in range(5):
+        byte = data[position]
+        position += 1
+        value |= (byte & 0x7F) << (7 * i)
+        if not byte & 0x80:
+            return value, position
+    raise ValueError("VarInt demasiado largo")
+
+def load_proxy_module(path=PROXY_PATH):
+    """Importa minecraft_proxy.py. El archivo del repo trae placeholders de despliegue
+    ({SERVER_HOST}, {SERVER_MAC}); se reemplazan por valores locales solo en memoria"""
+    with open(path, encoding='utf-8') as f:
+        source = f.read()
+    source = source.replace('SERVER_HOST = {SERVER_HOST}', "SERVER_HOST = '127.0.0.1'")
+    source = source.replace('SERVER_MAC = {SERVER_MAC}', "SERVER_MAC = '00:00:00:00:00:00'")
+    module = types.ModuleType('minecraft_proxy')
+    module.__file__ = path
+    sys.modules['minecraft_proxy'] = module
+    exec(compile(source, path, 'exec'), module.__dict__)
+    return module
+
+# --- SERVIDOR FALSO ---
+
+class FakeBackend:
+    """Servidor de Minecraft minimo: responde status/ping y, tras el Login Start,
+    devuelve como eco todo lo que recibe (sirve para medir tuneles)"""
+
+    def __init__(self, host='127.0.0.1', port=0, players_online=3):
+        self.host = host
+        self.port = port
+        status = {
+            "version": {"name": "1.21.4", "protocol": 767},
+            "players": {"max": 20, "online": players_online, "sample": []},
+            "description": {"text": "Servidor falso de benchmark"},
+        }
+        self.status_packet = encode_packet(0x00, encode_string(json.dumps(status)))
+        self.logins = 0
+
+    async def handle(self, reader, writer):
+        try:
+            handshake = await read_packet_stream(reader)
+            next_state = handshake[-1]
+            if next_state == 1:
+                await read_packet_stream(reader)
+                writer.write(self.status_packet)
+                ping = await read_packet_stream(reader)
+                writer.write(write_varint(len(ping)) + ping)
+                await writer.drain()
+                return
+            login = await read_packet_stream(reader)
+            self.logins += 1
+            await self.tunnel(reader, writer, login)
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def tunnel(self, reader, writer, login):
+        """Lo que hace el servidor tras el Login Start: eco de todo lo que recibe"""
+        while True:
+            data = await reader.read(65536)
+            if not data:
+                break
+            writer.write(data)
+            await writer.drain()
+
+    async def serve(self, ready=None):
+        server = await asyncio.start_server(self.handle, self.host, self.port, backlog=1024)
+        self.port = server.sockets[0].getsockname()[1]
+        if ready is not None:
+            ready(self.port)
+        async with server:
+            await server.serve_forever()
+
+def wait_for_port(port, timeout=10):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=0.5):
+                return True
+        except OSError:
+            time.sleep(0.05)
+    return False
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def start_backend_process(port):
+    """Servidor falso en un proceso aparte para no competir por el GIL con los clientes"""
+    process = subprocess.Popen([sys.executable, os.path.abspath(__file__), 'backend', '--port', str(port)])
+    if not wait_for_port(port):
+        process.kill()
+        raise RuntimeError("El servidor falso no arranco")
+    return process
+
+def start_backend_thread(backend, port):
+    """Servidor falso en un hilo de este proceso, para escenarios que comparten estado con el"""
+    ready = threading.Event()
+    backend.port = port
+    thread = threading.Thread(target=asyncio.run, args=(backend.serve(lambda port: ready.set()),), daemon=True)
+    thread.start()
+    if not ready.wait(10):
+        raise RuntimeError("El servidor falso no arranco")
+
+def start_proxy_process(port, backend_port, engine, log=False, workers=1, socket_profile=None, capture_dir=None):
+    """Arranca el proxy real en un proceso aparte, apuntando al servidor falso"""
+    args = [sys.executable, os.path.abspath(__file__), '--engine', engine, '--workers', str(workers)]
+    if socket_profile:
+        args += ['--socket-profile', socket_profile]
+    args += ['proxy', '--port', str(port), '--backend-port', str(backend_port)]
+    if capture_dir:
+        args += ['--capture-dir', capture_dir]
+    output = None if log else subprocess.DEVNULL
+    process = subprocess.Popen(args, stdout=output)
+    if not wait_for_port(port):
+        process.kill()
+        raise RuntimeError("El proxy no arranco")
+    return process
+
+def run_proxy(port, backend_port, engine, workers=1, socket_profile=None, capture_dir=None):
+    """Configura minecraft_proxy para el benchmark y ejecuta su main()"""
+    proxy = load_proxy_module()
+    whitelist = tempfile.NamedTemporaryFile('w', suffix='.json', delete=False)
+    json.dump({"enabled": False, "players": []}, whitelist)
+    whitelist.close()
+
+    proxy.PROXY_HOST = '127.0.0.1'
+    proxy.PROXY_PORT = port
+    proxy.SERVER_PORT = backend_port
+    proxy.WHITELIST_PATH = whitelist.name
+    proxy.SERVER_ICON_PATH = ICON_PATH
+    # Todas las conexiones vienen de 127.0.0.1: sin limites de admision
+    proxy.ADMISSION_RATE_PER_IP = 1e9
+    proxy.ADMISSION_BURST_PER_IP = 1e9
+    proxy.MAX_CONCURRENT_HANDSHAKES = 1 << 30
+    if socket_profile:
+        proxy.TUNNEL_SOCKET_PROFILE = socket_profile
+    proxy.HANDLER_QUEUE_DEPTH = 1 << 30
+    if capture_dir:
+        proxy.CAPTURE_ENABLED = True
+        proxy.CAPTURE_DIR = capture_dir
+    sys.argv = [proxy.__file__, '--engine', engine, '--workers', str(workers)]
+    proxy.main()
+
+# --- ESTADISTICAS ---
+
+def percentile(values, fraction):
+    if not values:
+        return float('nan')
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(fraction * (len(ordered) - 1)))))
+    return ordered[index]
+
+def latency_summary(latencies):
+    return (f"p50={percentile(latencies, 0.50) * 1000:.2f}ms "
+            f"p99={percentile(latencies, 0.99) * 1000:.2f}ms "
+            f"max={max(latencies) * 1000 if latencies else float('nan'):.2f}ms")
+
+# --- GENERADORES DE CARGA ---
+
+async def ping_once(port):
+    """Un ciclo completo de lista de servidores: handshake, status request, ping"""
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    try:
+        writer.write(handshake_packet(port, 1) + encode_packet(0x00))
+        await read_packet_stream(reader)
+        writer.write(encode_packet(0x01, struct.pack('>q', 1)))
+        await read_packet_stream(reader)
+    finally:
+        writer.close()
+
+async def ping_storm(port, clients, duration):
+    latencies = []
+    errors = 0
+    deadline = time.monotonic() + duration
+
+    async def worker():
+        nonlocal errors
+        while time.monotonic() < deadline:
+            started = time.perf_counter()
+            try:
+                await asyncio.wait_for(ping_once(port), 10)
+                latencies.append(time.perf_counter() - started)
+            except Exception:
+                errors += 1
+
+    started = time.monotonic()
+    await asyncio.gather(*(worker() for _ in range(clients)))
+    elapsed = time.monotonic() - started
+    print(f"[BENCH] ping storm: {clients} clientes, {len(latencies)} pings en {elapsed:.1f}s "
+          f"= {len(latencies) / elapsed:.0f} pings/s, {latency_summary(latencies)}, errores={errors}")
+    return latencies
+
+async def login_once(port, index):
+    """Login completo hasta comprobar que el tunel hace eco"""
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    try:
+        marker = b'tunel-%d' % index
+        writer.write(handshake_packet(port, 2) + login_start_packet(f"bench{index}") + marker)
+        await reader.readexactly(len(marker))
+    finally:
+        writer.close()
+
+async def login_burst(port, clients, rounds):
+    latencies = []
+    errors = 0
+
+    async def one(index):
+        nonlocal errors
+        started = time.perf_counter()
+        try:
+            await asyncio.wait_for(login_once(port, index), 30)
+            latencies.append(time.perf_counter() - started)
+        except Exception:
+            errors += 1
+
+    started = time.monotonic()
+    for round_number in range(rounds):
+        await asyncio.gather(*(one(round_number * clients + i) for i in range(clients)))
+    elapsed = time.monotonic() - started
+    print(f"[BENCH] logins concurrentes: {clients} x {rounds} rondas en {elapsed:.1f}s, "
+          f"{latency_summary(latencies)}, errores={errors}")
+    return latencies
+
+async def tunnel_throughput(port, tunnels, megabytes, chunk_size=16384):
+    """Cada tunel envia `megabytes` MB y lee el mismo volumen de eco"""
+    results = []
+    total = int(megabytes * 1024 * 1024)
+    chunk = os.urandom(chunk_size)
+
+    async def one(index):
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        try:
+            writer.write(handshake_packet(port, 2) + login_start_packet(f"bench{index}"))
+            started = time.perf_counter()
+
+            async def send():
+                sent = 0
+                while sent < total:
+                    writer.write(chunk)
+                    sent += len(chunk)
+                    await writer.drain()
+
+            async def receive():
+                received = 0
+                while received < total:
+                    data = await reader.read(262144)
+                    if not data:
+                        raise ConnectionError("tunel cerrado antes de tiempo")
+                    received += len(data)
+
+            await asyncio.gather(send(), receive())
+            elapsed = time.perf_counter() - started
+            results.append(total / elapsed / 1e6)
+        finally:
+            writer.close()
+
+    await asyncio.gather(*(one(i) for i in range(tunnels)))
+    per_tunnel = ", ".join(f"{value:.1f}" for value in results)
+    print(f"[BENCH] throughput: {tunnels} tuneles x {megabytes} MB, MB/s por tunel (eco): {per_tunnel}; "
+          f"total {sum(results):.1f} MB/s")
+    return results
+
+# --- REPRODUCCION DE CAPTURAS ---
+# Formato de los archivos de CAPTURE_DIR (ver CAPTURE_* en minecraft_proxy.py)
+
+CAPTURE_MAGIC = b'MCPCAP\x00\x01'
+CAPTURE_RECORD = struct.Struct('>dIBI')
+CAPTURE_OPEN, CAPTURE_CLIENT, CAPTURE_SERVER, CAPTURE_CLOSE = range(4)
+
+class CapturedSession:
+    """Una sesion grabada, con sus bloques en segundos desde la apertura"""
+
+    def __init__(self, opened, info):
+        self.opened = opened
+        self.kind = info.get("kind")
+        self.chunks = []  # (segundos, CAPTURE_CLIENT o CAPTURE_SERVER, datos)
+        self.duration = None
+
+    def data(self, record_type):
+        return [(offset, data) for offset, kind, data in self.chunks if kind == record_type]
+
+def read_capture(path):
+    """(instante, sesion, tipo, datos) de cada registro. Un registro cortado al final
+    (el proceso murio a medio volcar el buffer) se ignora"""
+    with open(path, 'rb') as f:
+        if f.read(len(CAPTURE_MAGIC)) != CAPTURE_MAGIC:
+            raise ValueError(f"{path} no es una captura de minecraft_proxy")
+        while True:
+            header = f.read(CAPTURE_RECORD.size)
+            if len(header) < CAPTURE_RECORD.size:
+                return
+            when, session, record_type, length = CAPTURE_RECORD.unpack(header)
+            data = f.read(length)
+            if len(data) < length:
+                return
+            yield when, session, record_type, data
+
+def load_sessions(paths):
+    """Sesiones de todos los archivos ordenadas por apertura"""
+    sessions = []
+    for path in paths:
+        # Los numeros de sesion son por archivo
+        open_sessions = {}
+        for when, number, record_type, data in read_capture(path):
+            if record_type == CAPTURE_OPEN:
+                open_sessions[number] = CapturedSession(when, json.loads(data))
+                sessions.append(open_sessions[number])
+                continue
+            session = open_sessions.get(number)
+            if session is None:
+                continue
+            if record_type == CAPTURE_CLOSE:
+                session.duration = when - session.opened
+                del open_sessions[number]
+            else:
+                session.chunks.append((when - session.opened, record_type, data))
+    for session in sessions:
+        if session.duration is None:
+            session.duration = session.chunks[-1][0] if session.chunks else 0
+    sessions.sort(key=lambda session: session.opened)
+    return sessions
+
+def split_login(data):
+    """Separa el primer bloque de un login en (handshake, resto tras el Login Start)"""
+    length, position = read_varint_bytes(data)
+    handshake_end = position + length
+    length, position = read_varint_bytes(data, handshake_end)
+    return data[:handshake_end], data[position + length:]
+
+class ReplayedLogin:
+    """Una sesion de login en reproduccion, compartida por el cliente y el servidor falso.
+    Cada lado anota (bytes enviados acumulados, instante) antes de escribir cada bloque
+    y el otro mide cuanto tarda en llegarle cada uno"""
+
+    def __init__(self, session, name):
+        handshake, rest = split_login(session.data(CAPTURE_CLIENT)[0][1])
+        self.prelude = handshake + login_start_packet(name)
+        client = session.data(CAPTURE_CLIENT)
+        self.client_chunks = ([(client[0][0], rest)] if rest else []) + client[1:]
+        self.server_chunks = session.data(CAPTURE_SERVER)
+        self.duration = session.duration
+        self.client_marks = []
+        self.server_marks = []
+        self.start = None
+
+async def play_chunks(writer, chunks, marks, start, speed, lateness):
+    """Escribe cada bloque en su instante (relativo a start) y anota lo enviado"""
+    sent = 0
+    for offset, data in chunks:
+        delay = start + offset / speed - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        # Cuanto se retraso el propio reproductor respecto a lo programado
+        lateness.append(max(0.0, time.perf_counter() - start - offset / speed))
+        sent += len(data)
+        marks.append((sent, time.perf_counter()))
+        writer.write(data)
+        await writer.drain()
+
+async def receive_chunks(reader, expected, marks, latencies):
+    """Lee hasta recibir expected bytes y mide la latencia de cada bloque del otro lado"""
+    received = 0
+    pending = 0
+    while received < expected:
+        data = await reader.read(262144)
+        if not data:
+            break
+        received += len(data)
+        now = time.perf_counter()
+        while pending < len(marks) and marks[pending][0] <= received:
+            latencies.append(now - marks[pending][1])
+            pending += 1
+    return received
+
+class ReplayBackend(FakeBackend):
+    """Servidor falso que, tras el Login Start de una sesion reproducida, envia lo que
+    envio el servidor real en la captura"""
+
+    def __init__(self, replayer):
+        super().__init__()
+        self.replayer = replayer
+
+    async def tunnel(self, reader, writer, login):
+        length, position = read_varint_bytes(login, 1)
+        login_session = self.replayer.logins.get(login[position:position + length].decode('utf-8'))
+        if login_session is None:
+            return await super().tunnel(reader, writer, login)
+        replayer = self.replayer
+        expected = sum(len(data) for _, data in login_session.client_chunks)
+        await asyncio.gather(
+            play_chunks(writer, login_session.server_chunks, login_session.server_marks,
+                        login_session.start, replayer.speed, replayer.lateness),
+            receive_chunks(reader, expected, login_session.client_marks, replayer.client_latencies),
+        )
+        # Esperar a que el cliente cierre
+        while await reader.read(65536):
+            pass
+
+class Replayer:
+    """Lanza cada sesion capturada en su instante (dividido por speed) contra el proxy"""
+
+    def __init__(self, sessions, speed=1.0):
+        self.sessions = sessions
+        self.speed = speed
+        self.logins = {}
+        self.status_latencies = []
+        self.client_latencies = []
+        self.server_latencies = []
+        self.lateness = []
+        self.expected_bytes = 0
+        self.received_bytes = 0
+        self.errors = 0
+
+    async def run(self, port):
+        if not self.sessions:
+            print("[REPLAY] La captura no tiene sesiones")
+            return
+        first = self.sessions[0].opened
+        recorded = max(session.opened + session.duration for session in self.sessions) - first
+        start = time.perf_counter()
+        await asyncio.gather(*(self.replay(port, index, session, start + (session.opened - first) / self.speed)
+                               for index, session in enumerate(self.sessions)))
+        elapsed = time.perf_counter() - start
+        logins = len(self.logins)
+        print(f"[REPLAY] {len(self.sessions)} sesiones ({logins} logins, {len(self.sessions) - logins} status): "
+              f"{recorded:.1f}s grabados reproducidos en {elapsed:.1f}s (x{self.speed:g}), errores={self.errors}")
+        print(f"[REPLAY] status: {latency_summary(self.status_latencies)}")
+        print(f"[REPLAY] bloques cliente->servidor: {latency_summary(self.client_latencies)}")
+        print(f"[REPLAY] bloques servidor->cliente: {latency_summary(self.server_latencies)}")
+        print(f"[REPLAY] bytes servidor->cliente recibidos {self.received_bytes} de {self.expected_bytes}; "
+              f"retraso del reproductor: {latency_summary(self.lateness)}")
+
+    async def replay(self, port, index, session, start):
+        delay = start - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        try:
+            if session.kind == 'login':
+                await asyncio.wait_for(self.replay_login(port, index, session, start),
+                                       session.duration / self.speed + 30)
+            elif session.kind == 'status':
+                await asyncio.wait_for(self.replay_status(port, session), 10)
+        except Exception:
+            self.errors += 1
+
+    async def replay_status(self, port, session):
+        started = time.perf_counter()
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        try:
+            writer.write(session.data(CAPTURE_CLIENT)[0][1] + encode_packet(0x00))
+            await read_packet_stream(reader)
+            writer.write(encode_packet(0x01, struct.pack('>q', 1)))
+            await read_packet_stream(reader)
+            self.status_latencies.append(time.perf_counter() - started)
+        finally:
+            writer.close()
+
+    async def replay_login(self, port, index, session, start):
+        # Nombre unico para que el servidor falso sepa que sesion reproducir
+        name = f"replay{index}"
+        login_session = ReplayedLogin(session, name)
+        login_session.start = start
+        self.logins[name] = login_session
+        expected = sum(len(data) for _, data in login_session.server_chunks)
+        self.expected_bytes += expected
+
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        try:
+            writer.write(login_session.prelude)
+            _, received = await asyncio.gather(
+                play_chunks(writer, login_session.client_chunks, login_session.client_marks, start,
+                            self.speed, self.lateness),
+                receive_chunks(reader, expected, login_session.server_marks, self.server_latencies),
+            )
+            self.received_bytes += received
+            delay = start + login_session.duration / self.speed - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        finally:
+            writer.close()
+
+# --- MICROBENCHMARKS ---
+
+def microbenchmarks(number=200000):
+    proxy = load_proxy_module()
+    handshake = handshake_packet(25565, 2)
+    # payload del handshake (sin longitud ni packet ID)
+    handshake_payload = handshake[2:]
+    varint_bytes = proxy.write_varint(2097151)
+
+    a, b = socket.socketpair()
+    packet = encode_packet(0x00, b'x' * 200)
+
+    def read_packet_round():
+        a.sendall(packet)
+        proxy.read_packet(b)
+
+    cases = [
+        ("write_varint(300)", lambda: proxy.write_varint(300), number),
+        ("write_varint(2097151)", lambda: proxy.write_varint(2097151), number),
+        ("read_varint_from_bytes(3 bytes)", lambda: proxy.read_varint_from_bytes(varint_bytes), number),
+        ("handle_handshake", lambda: proxy.handle_handshake(handshake_payload, None), number),
+        ("read_packet(socketpair, 200 B)", read_packet_round, number // 10),
+    ]
+    for name, function, count in cases:
+        elapsed = min(timeit.repeat(function, number=count, repeat=3))
+        print(f"[MICRO] {name}: {elapsed / count * 1e9:.0f} ns/op")
+    a.close()
+    b.close()
+    memory_microbenchmarks(proxy)
+
+def allocated_per_object(factory, count):
+    """Bytes del heap de Python por objeto que crea factory (tracemalloc, sin contar
+    pilas de hilos ni buffers del kernel)"""
+    objects = []
+    tracemalloc.start()
+    try:
+        before = tracemalloc.take_snapshot()
+        for _ in range(count):
+            objects.append(factory())
+        after = tracemalloc.take_snapshot()
+    finally:
+        tracemalloc.stop()
+    grown = sum(stat.size_diff for stat in after.compare_to(before, 'filename'))
+    return grown / count, objects
+
+def memory_microbenchmarks(proxy, count=2000):
+    """Memoria del estado por conexion: Connection mientras dura el handshake y
+    TunnelStats mientras dura el tunel"""
+    pairs = [socket.socketpair() for _ in range(count)]
+    sockets = iter(pairs)
+    accepted_at = time.monotonic()
+    per_connection, connections = allocated_per_object(
+        lambda: proxy.Connection(next(sockets)[0], accepted_at), count)
+    per_tunnel, tunnels = allocated_per_object(lambda: proxy.TunnelStats("bench", "threads"), count)
+    print(f"[MICRO] Connection: {per_connection:.0f} B/conexion (heap de Python)")
+    print(f"[MICRO] TunnelStats: {per_tunnel:.0f} B/tunel (heap de Python)")
+    for tunnel in tunnels:
+        proxy.active_tunnels.discard(tunnel)
+    del connections
+    for a, b in pairs:
+        a.close()
+        b.close()
+
+# --- PARADA ---
+
+def open_echo_tunnel(port, name, payload):
+    """Login por el proxy y envio de payload; vuelve cuando el eco ha llegado entero"""
+    sock = socket.create_connection(('127.0.0.1', port), timeout=10)
+    sock.sendall(handshake_packet(port, 2) + login_start_packet(name) + payload)
+    received = 0
+    while received < len(payload):
+        data = sock.recv(65536)
+        if not data:
+            raise ConnectionError(f"tunel de {name} cerrado antes de tiempo")
+        received += len(data)
+    return sock
+
+def captured_logins(capture_dir):
+    """{jugador: (bytes cliente->servidor, bytes servidor->cliente, cerrada)} de todas
+    las capturas del directorio (una por proceso del proxy)"""
+    logins = {}
+    for filename in sorted(os.listdir(capture_dir)):
+        names = {}
+        for _, number, record_type, data in read_capture(os.path.join(capture_dir, filename)):
+            if record_type == CAPTURE_OPEN:
+                info = json.loads(data)
+                if info.get("kind") == 'login':
+                    names[number] = info["name"]
+                    logins[info["name"]] = [b'', b'', False]
+                continue
+            login = logins.get(names.get(number))
+            if login is None:
+                continue
+            if record_type == CAPTURE_CLIENT:
+                login[0] += data
+            elif record_type == CAPTURE_SERVER:
+                login[1] += data
+            elif record_type == CAPTURE_CLOSE:
+                login[2] = True
+    return logins
+
+def shutdown_capture(args):
+    """Para el proxy con SIGTERM (como systemctl stop) con un tunel ya cerrado y otro
+    abierto, y comprueba que la captura tiene todo lo que paso por los dos. Sin el
+    volcado al salir el buffer de CaptureWriter se pierde y el archivo queda cortado"""
+    capture_dir = tempfile.mkdtemp(prefix='mcproxy-captura-')
+    backend_port = free_port()
+    proxy_port = args.proxy_port or free_port()
+    backend = start_backend_process(backend_port)
+    proxy = None
+    payloads = {"cerrado": b'c' * 5000, "abierto": b'a' * 7000}
+    try:
+        proxy = start_proxy_process(proxy_port, backend_port, args.engine, args.proxy_log, args.workers,
+                                    args.socket_profile, capture_dir)
+        time.sleep(0.5)
+        open_echo_tunnel(proxy_port, "cerrado", payloads["cerrado"]).close()
+        still_open = open_echo_tunnel(proxy_port, "abierto", payloads["abierto"])
+        # Que el proxy vea el cierre del primero antes de la senal
+        time.sleep(0.5)
+        proxy.terminate()
+        code = proxy.wait(30)
+        proxy = None
+        still_open.close()
+    finally:
+        for process in (proxy, backend):
+            if process is not None:
+                process.terminate()
+                process.wait()
+    errors = []
+    try:
+        logins = captured_logins(capture_dir)
+    except ValueError as e:
+        # Archivo vacio: no se llego a volcar ni la cabecera
+        logins = {}
+        errors.append(str(e))
+    for name, payload in payloads.items():
+        if name not in logins:
+            errors.append(f"falta la sesion de {name}")
+            continue
+        client, server, closed = logins[name]
+        if not client.endswith(payload):
+            errors.append(f"{name}: {len(client)} bytes cliente->servidor, faltan datos del cliente")
+        if server != payload:
+            errors.append(f"{name}: {len(server)} de {len(payload)} bytes servidor->cliente")
+    if "cerrado" in logins and not logins["cerrado"][2]:
+        errors.append("cerrado: falta el registro de cierre")
+    print(f"[SHUTDOWN] SIGTERM: codigo de salida {code}, {len(os.listdir(capture_dir))} capturas en {capture_dir}")
+    if errors:
+        for error in errors:
+            print(f"[SHUTDOWN] ERROR: {error}")
+        sys.exit(1)
+    print("[SHUTDOWN] Captura completa")
+
+# --- ORQUESTACION ---
+
+def with_environment(args, scenario, fake_backend=None):
+    """Levanta servidor falso y proxy, ejecuta el escenario y limpia.
+    Con fake_backend el servidor falso corre en un hilo de este proceso"""
+    backend_port = free_port()
+    proxy_port = args.proxy_port or free_port()
+    backend = None
+    if fake_backend is None:
+        backend = start_backend_process(backend_port)
+    else:
+        start_backend_thread(fake_backend, backend_port)
+    proxy = None
+    try:
+        proxy = start_proxy_process(proxy_port, backend_port, args.engine, args.proxy_log, args.workers,
+                                    args.socket_profile)
+        # Dar tiempo al primer sondeo del proxy
+        time.sleep(0.5)
+        return asyncio.run(scenario(proxy_port))
+    finally:
+        for process in (proxy, backend):
+            if process is not None:
+                process.terminate()
+                process.wait()
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks de minecraft_proxy.py")
+    parser.add_argument('--engine', choices=['asyncio', 'threads'], default='asyncio')
+    parser.add_argument('--workers', type=int, default=1, help="Procesos worker del proxy (SO_REUSEPORT)")
+    parser.add_argument('--proxy-port', type=int, default=0)
+    parser.add_argument('--proxy-log', action='store_true', help="Mostrar la salida del proxy")
+    parser.add_argument('--socket-profile', help="Perfil de TUNNEL_SOCKET_PROFILES para los tuneles del proxy")
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    backend = sub.add_parser('backend', help="Solo el servidor falso")
+    backend.add_argument('--port', type=int, default=25566)
+
+    proxy = sub.add_parser('proxy', help="Solo el proxy apuntando al servidor falso")
+    proxy.add_argument('--port', type=int, default=25565)
+    proxy.add_argument('--backend-port', type=int, default=25566)
+    proxy.add_argument('--capture-dir', help="Grabar sesiones (CAPTURE_ENABLED) en este directorio")
+
+    ping = sub.add_parser('ping', help="Tormenta de pings de lista de servidores")
+    ping.add_argument('--clients', type=int, default=50)
+    ping.add_argument('--duration', type=float, default=10)
+
+    login = sub.add_parser('login', help="Logins concurrentes")
+    login.add_argument('--clients', type=int, default=50)
+    login.add_argument('--rounds', type=int, default=5)
+
+    throughput = sub.add_parser('throughput', help="Throughput sostenido por tunel")
+    throughput.add_argument('--tunnels', type=int, default=4)
+    throughput.add_argument('--megabytes', type=float, default=64)
+
+    micro = sub.add_parser('micro', help="Microbenchmarks de las funciones del protocolo")
+    micro.add_argument('--number', type=int, default=200000)
+
+    replay = sub.add_parser('replay', help="Reproducir capturas del proxy (CAPTURE_ENABLED)")
+    replay.add_argument('captures', nargs='+', help="Archivos .mcap (uno por proceso del proxy)")
+    replay.add_argument('--speed', type=float, default=1.0, help="Factor de aceleracion (1 = tiempo real)")
+    replay.add_argument('--limit', type=int, default=0, help="Reproducir solo las primeras N sesiones")
+
+    sub.add_parser('shutdown', help="Comprobar que SIGTERM deja la captura completa")
+
+    sub.add_parser('all', help="Todos los escenarios con valores por defecto")
+
+    args = parser.parse_args()
+
+    if args.command == 'backend':
+        asyncio.run(FakeBackend(port=args.port).serve())
+    elif args.command == 'proxy':
+        run_proxy(args.port, args.backend_port, args.engine, args.workers, args.socket_profile, args.capture_dir)
+    elif args.command == 'ping':
+        with_environment(args, lambda port: ping_storm(port, args.clients, args.duration))
+    elif args.command == 'login':
+        with_environment(args, lambda port: login_burst(port, args.clients, args.rounds))
+    elif args.command == 'throughput':
+        with_environment(args, lambda port: tunnel_throughput(port, args.tunnels, args.megabytes))
+    elif args.command == 'micro':
+        microbenchmarks(args.number)
+    elif args.command == 'replay':
+        sessions = load_sessions(args.captures)
+        if args.limit:
+            sessions = sessions[:args.limit]
+        replayer = Replayer(sessions, args.speed)
+        with_environment(args, replayer.run, ReplayBackend(replayer))
+    elif args.command == 'shutdown':
+        shutdown_capture(args)
+    elif args.command == 'all':
+        microbenchmarks()
+
+        async def scenario(port):
+            await ping_storm(port, 50, 10)
+            await login_burst(port, 50, 5)
+            await tunnel_throughput(port, 4, 64)
+
+        with_environment(args, scenario)
+
+if __name__ == '__main__':
+    main()
@@ -1,12 +1,30 @@
 # -*- coding: utf-8 -*-
 import socket
 import threading
+import asyncio
+import argparse
 import os
 import time
 import json
 import struct
+import errno
 import base64
+import copy
+import collections
+import bisect
+import http.server
+import socketserver
+import hashlib
 import signal
+import sys
+import mmap
+import atexit
+import itertools
+import heapq
+import select
+import subprocess
+import queue
+import fcntl
 
 # --- CONFIGURACION ---
 PROXY_HOST = '0.0.0.0'
@@ -16,12 +34,214 @@ SERVER_HOST = {SERVER_HOST}
 SERVER_PORT = 25565
 SERVER_MAC = {SERVER_MAC}
 
+# Varios servidores detras del mismo proxy, elegidos por el hostname del handshake.
+# Si la lista esta vacia se usa un unico servidor con SERVER_HOST/SERVER_PORT/SERVER_MAC.
+# Campos: name, hostnames (exactos o comodin "*.dominio"), host, port, mac y opcionales
+# motd_online, motd_offline, whitelist (ruta a un whitelist.json propio) y socket_profile
+# (perfil de TUNNEL_SOCKET_PROFILES para sus tuneles)
+BACKENDS = [
+    # {
+    #     "name": "creativo",
+    #     "hostnames": ["creativo.midominio.com", "*.creativo.midominio.com"],
+    #     "host": "192.168.1.51",
+    #     "port": 25565,
+    #     "mac": "aa:bb:cc:dd:ee:ff",
+    #     "motd_online": "\u00a7aCreativo activo. \u00a77Ingresa para jugar!",
+    #     "motd_offline": "\u00a7cCreativo suspendido. \u00a77Conectate para encenderlo!",
+    #     "whitelist": "/home/paip/minecraft-proxy/whitelist-creativo.json",
+    #     "socket_profile": "rafagas",
+    # },
+]
+# Backend para hostnames sin coincidencia (None = el primero de la lista)
+DEFAULT_BACKEND = None
+
 # Ruta al icono del servidor (PNG 64x64)
 SERVER_ICON_PATH = '/home/paip/minecraft-proxy/server-icon.png'
 
 # Ruta al archivo de whitelist
 WHITELIST_PATH = '/home/paip/minecraft-proxy/whitelist.json'
 
+# Motor de conexiones: 'asyncio' (un solo event loop) o 'threads' (un hilo por conexion)
+# Se puede cambiar al arrancar con --engine
+PROXY_ENGINE = 'asyncio'
+
+# Procesos worker que aceptan en PROXY_PORT con SO_REUSEPORT, vigilados por un supervisor
+# que sondea los servidores y envia los Wake-on-LAN (1 = un solo proceso; 0 = uno por nucleo)
+# Se puede cambiar al arrancar con --workers
+WORKERS = 1
+WORKER_RESTART_DELAY = 1      # segundos antes de relanzar un worker caido
+WORKER_POLL_INTERVAL = 0.25   # cada cuanto miran los workers el estado compartido al retener logins
+SHARED_STATUS_SIZE = 65536    # bytes reservados por servidor para el status real compartido
+
+# Reenviar los tuneles de login con os.splice (copia en el kernel, sin pasar por Python)
+# Si splice no esta disponible se usa el bucle recv/sendall de siempre
+TUNNEL_SPLICE = True
+TUNNEL_CHUNK_SIZE = 65536
+
+# Opciones de los dos sockets de cada tunel (cliente y servidor real), por perfil:
+#   nodelay: TCP_NODELAY (sin Nagle: los paquetes de movimiento salen sin esperar)
+#   rcvbuf/sndbuf: SO_RCVBUF/SO_SNDBUF en bytes (sin ellos, el autoajuste del kernel)
+#   keepalive: [inactividad, intervalo, sondas] en segundos para detectar clientes muertos
+#   user_timeout: TCP_USER_TIMEOUT en ms (corta si lo enviado lleva tanto sin confirmarse)
+#   read_min/read_max: tamano de lectura del bucle de copia; crece al llenarse y baja
+#   cuando las lecturas son pequenas (con splice se usa TUNNEL_CHUNK_SIZE)
+# Las metricas y el resumen de cada tunel llevan el perfil, para comparar perfiles con numeros
+TUNNEL_SOCKET_PROFILES = {
+    "juego": {"nodelay": True, "keepalive": [30, 10, 3], "user_timeout": 60000,
+              "read_min": 16384, "read_max": 262144},
+    # Rafagas grandes de chunks (distancia de renderizado alta, enlaces con mucho RTT)
+    "rafagas": {"nodelay": True, "rcvbuf": 1048576, "sndbuf": 1048576, "keepalive": [60, 15, 4],
+                "user_timeout": 120000, "read_min": 65536, "read_max": 1048576},
+    # Opciones del sistema, sin tocar nada
+    "sistema": {},
+}
+TUNNEL_SOCKET_PROFILE = "juego"
+
+# Sondeo del servidor real en segundo plano (los clientes leen siempre de la cache)
+HEALTH_CHECK_INTERVAL = 5    # segundos entre sondeos mientras el servidor esta activo
+HEALTH_BACKOFF_MAX = 30      # maximo de segundos entre sondeos mientras esta dormido
+HEALTH_CACHE_TTL = 15        # segundos de validez del status real cacheado
+
+# Maximo de respuestas de status pre-codificadas (una por protocol version de cliente)
+STATUS_CACHE_MAX_ENTRIES = 64
+
+# Lectura de paquetes del cliente: bytes por recv y tamano maximo aceptado
+PACKET_READ_SIZE = 4096
+MAX_PACKET_SIZE = 2097151  # maximo de un VarInt de 3 bytes, limite del protocolo
+
+# Cada cuantos segundos se revisa si whitelist.json cambio (recarga sin reiniciar)
+WHITELIST_POLL_INTERVAL = 2
+
+# --- CONTROL DE ADMISION ---
+# Cola de conexiones pendientes del socket de escucha
+LISTEN_BACKLOG = 128
+# Token bucket por IP: conexiones por segundo y rafaga maxima
+ADMISSION_RATE_PER_IP = 2.0
+ADMISSION_BURST_PER_IP = 10
+# Maximo de conexiones en fase de handshake/status/login a la vez (los tuneles no cuentan)
+MAX_CONCURRENT_HANDSHAKES = 64
+# Motor threads: hilos fijos que atienden handshake, status y login, y cola acotada de
+# conexiones admitidas esperando hilo (con la cola llena se rechaza en el accept).
+# Con workers se reparten entre los procesos, como MAX_CONCURRENT_HANDSHAKES
+HANDLER_POOL_SIZE = 32
+HANDLER_QUEUE_DEPTH = 32
+# Pila de cada hilo creado por el motor threads (handlers y tuneles), en bytes.
+# 0 = la del sistema (8 MiB de memoria virtual por hilo); ningun hilo recursa
+THREAD_STACK_SIZE = 256 * 1024
+# Plazos por fase de cada conexion (segundos desde que empieza la fase); al vencer se
+# corta el socket. Los vigila un solo hilo para todas las conexiones
+HANDSHAKE_TIMEOUT = 10        # desde el accept hasta tener el handshake
+STATUS_TIMEOUT = 10           # status request + ping
+LOGIN_START_TIMEOUT = 10      # Login Start tras el handshake
+BACKEND_CONNECT_TIMEOUT = 10  # conectar al servidor real y reenviarle el login
+# (la retencion de un login mientras despierta el servidor dura WAKE_HOLD_TIMEOUT)
+# Tunel sin trafico en ninguna direccion durante este tiempo: se cierra (0 = sin limite).
+# El servidor manda keep-alive cada 15 s, asi que un tunel callado tanto tiempo esta muerto
+TUNNEL_IDLE_TIMEOUT = 120
+# Cada cuantos segundos se imprime el resumen de rechazos (0 = nunca)
+ADMISSION_REPORT_INTERVAL = 300
+
+# --- WAKE-ON-LAN ---
+# Destino del magic packet (broadcast de la red local)
+WAKE_BROADCAST_ADDR = '255.255.255.255'
+WAKE_BROADCAST_PORT = 9
+# Segundos maximos esperando a que el servidor arranque antes de darlo por dormido otra vez
+WAKE_TIMEOUT = 180
+# Sondeo del arranque: primer intervalo y maximo (backoff)
+WAKE_POLL_INTERVAL = 1
+WAKE_POLL_MAX = 5
+# Reenviar el magic packet mientras se espera, por si se perdio
+WAKE_RESEND_INTERVAL = 15
+# Segundos que se retiene un login esperando al servidor (el cliente corta a los ~30)
+WAKE_HOLD_TIMEOUT = 25
+
+# --- PREDESPERTAR ---
+# Guarda cada login permitido (jugador, servidor, instante) en un historial binario y
+# aprende en que franjas de la semana (dia y hora local) se suele jugar. Antes de una
+# franja prevista envia el magic packet y, durante ella, /idle pide al agente de
+# suspension que no suspenda. En modo prueba solo registra las predicciones y si
+# acertaron, para ajustar la antelacion y el umbral antes de gastar luz
+PREWAKE_ENABLED = False
+PREWAKE_HISTORY_PATH = "/home/paip/minecraft-proxy/logins.bin"
+PREWAKE_HISTORY_DAYS = 28      # solo se aprende de las ultimas semanas
+PREWAKE_SLOT_MINUTES = 30      # tamano de cada franja
+PREWAKE_LEAD_TIME = 300        # segundos de antelacion del magic packet (arranque + carga del mundo)
+PREWAKE_CONFIDENCE = 0.5       # fraccion de semanas con algun login en la franja para predecirla
+PREWAKE_DRY_RUN = True         # solo registrar predicciones, sin despertar ni mantener despierto
+PREWAKE_REPORT_INTERVAL = 86400  # segundos entre informes de predicciones vs logins (0 = nunca)
+
+# --- METRICAS ---
+# Endpoint HTTP local con metricas en formato Prometheus (GET /metrics)
+METRICS_ENABLED = False
+METRICS_HOST = '127.0.0.1'
+METRICS_PORT = 9465
+# Con varios workers el supervisor usa METRICS_PORT y el worker N usa METRICS_PORT + 1 + N
+
+# --- ACTIVIDAD ---
+# Endpoint HTTP con la actividad de los tuneles de login (GET /idle, JSON). Lo consulta
+# debian/suspend_agent.py para decidir cuando parar y suspender el servidor
+IDLE_ENDPOINT_ENABLED = False
+IDLE_ENDPOINT_HOST = '0.0.0.0'
+IDLE_ENDPOINT_PORT = 9466
+
+# --- QUERY (UDP) ---
+# Responde al protocolo query de Minecraft (GameSpy4 sobre UDP) que usan las webs de estado
+# y las listas de servidores, con el mismo status cacheado que la lista de servidores: un
+# sondeo externo nunca despierta la maquina ni llega al servidor real. El query no lleva
+# hostname, asi que siempre responde con los datos del servidor por defecto
+QUERY_ENABLED = False
+QUERY_HOST = '0.0.0.0'
+QUERY_PORT = 25565            # el query de vanilla usa el mismo numero que el puerto TCP
+QUERY_TOKEN_ROTATION = 30     # segundos entre rotaciones del secreto de los challenge tokens
+QUERY_PUBLIC_HOST = ''        # hostip anunciado (vacio = la direccion local por la que llego el query)
+
+# --- REGISTRO ---
+# Los mensajes van a una cola en memoria y un hilo los escribe por lotes en stdout,
+# asi los handlers nunca se bloquean escribiendo en journald
+LOG_LEVEL = 'INFO'          # DEBUG, INFO, WARNING o ERROR (se puede cambiar con --log-level)
+LOG_QUEUE_SIZE = 10000      # mensajes en cola como maximo; si se llena se descartan y se cuentan
+LOG_FLUSH_INTERVAL = 0.5    # segundos maximos entre lotes (los WARNING/ERROR se escriben ya)
+# Eventos repetitivos (conexiones, pings de status): como mucho LOG_SAMPLE_BURST por
+# ventana de LOG_SAMPLE_WINDOW segundos; del resto solo se escribe un resumen
+LOG_SAMPLE_BURST = 20
+LOG_SAMPLE_WINDOW = 10
+
+# --- TRAZAS Y PERFILADO ---
+# Marca de tiempo por fase de cada conexion (leer handshake, parsear, estado del servidor,
+# respuesta de status, login, conexion al servidor...). Las conexiones que tardan mas de
+# TRACE_SLOW_THRESHOLD segundos vuelcan su desglose; con --log-level DEBUG se vuelcan todas
+TRACE_ENABLED = False
+TRACE_SLOW_THRESHOLD = 0.25
+# Perfilador por muestreo: "kill -USR1 <pid>" muestrea las pilas de todos los hilos durante
+# PROFILE_DURATION segundos y registra las funciones mas calientes, sin reiniciar el proxy
+PROFILE_SIGNAL_ENABLED = True
+PROFILE_DURATION = 10
+PROFILE_INTERVAL = 0.005
+PROFILE_TOP = 20
+
+# --- CAPTURA DE TRAFICO ---
+# Graba las sesiones (handshake, login y los bytes del tunel en ambas direcciones, con su
+# instante) para reproducirlas despues con "benchmark.py replay". Cada proceso escribe su
+# propio archivo en CAPTURE_DIR. Mientras se graba, los tuneles nuevos copian por Python
+# en vez de usar splice. CAPTURE_ENABLED se puede cambiar en caliente (SIGHUP)
+CAPTURE_ENABLED = False
+CAPTURE_DIR = "/home/paip/minecraft-proxy/capturas"
+CAPTURE_BUFFER_SIZE = 1024 * 1024  # bytes acumulados en memoria antes de cada write() al archivo
+CAPTURE_MAX_BYTES = 1024 ** 3      # al llegar a este tamano el archivo deja de crecer
+
+# --- RECARGA Y ACTUALIZACION ---
+# JSON opcional con valores que sustituyen a los de esta configuracion, p. ej.
+# {"BACKENDS": [...], "FAKE_SERVER_STATUS_ONLINE": {...}, "ADMISSION_RATE_PER_IP": 4}.
+# Se lee al arrancar y con "kill -HUP <pid>", que ademas recarga whitelist, icono y MOTDs
+# sin cerrar ninguna conexion
+CONFIG_PATH = '/home/paip/minecraft-proxy/config.json'
+# "kill -USR2 <pid>" arranca un proceso nuevo (con el codigo y la configuracion actuales)
+# que hereda los sockets de escucha; el viejo deja de aceptar y sigue reenviando sus
+# tuneles hasta que se cierran. Con systemd la unidad necesita Type=notify y
+# NotifyAccess=all para que el proceso nuevo pase a ser el principal
+UPGRADE_READY_TIMEOUT = 30    # segundos maximos esperando a que arranque el proceso nuevo
+UPGRADE_DRAIN_TIMEOUT = None  # segundos maximos drenando (None = hasta que salga el ultimo jugador)
+
 # Mensaje cuando un jugador no esta en la whitelist
 MENSAJE_NO_WHITELIST = "No estas en la whitelist de este servidor."
 
@@ -60,69 +280,686 @@ MENSAJE_DESPERTANDO = "Despertando el servidor! Espera unos 30 segundos y vuelve
 
 # --- FIN DE LA CONFIGURACION ---
 
-is_waking_up = False
+# Nombres de las opciones (lo unico en mayusculas hasta aqui): las que acepta CONFIG_PATH
+CONFIG_KEYS = frozenset(name for name in globals() if name.isupper())
+
+router = None
+admission = None
 server_icon_base64 = None
-whitelist = []
-whitelist_enabled = True
+whitelist = None
+active_tunnels = set()
+handler_pool = None
 
-def load_whitelist():
-    """Carga la whitelist desde el archivo JSON"""
-    global whitelist, whitelist_enabled
-    try:
-        if os.path.exists(WHITELIST_PATH):
-            with open(WHITELIST_PATH, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-                whitelist_enabled = data.get('enabled', True)
-                whitelist = data.get('players', [])
-            print(f"[WHITELIST] Cargados {len(whitelist)} jugadores desde {WHITELIST_PATH}")
-            print(f"[WHITELIST] Estado: {'ACTIVADA' if whitelist_enabled else 'DESACTIVADA'}")
+# --- METRICAS ---
+# Contadores e histogramas en memoria. Registrar un valor es una suma bajo un lock,
+# lo bastante barato para dejarlo siempre activo; el endpoint HTTP es opcional.
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+WAKE_BUCKETS = (5, 10, 15, 20, 30, 45, 60, 90, 120, 180, 300)
+BYTES_BUCKETS = (1e3, 1e4, 1e5, 1e6, 1e7, 1e8, 1e9, 1e10)
+
+metrics_registry = []
+
+def format_labels(labelnames, values, extra=()):
+    pairs = list(zip(labelnames, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{value}"' for name, value in pairs) + '}'
+
+class Counter:
+    """Contador monotono, opcionalmente con etiquetas"""
+    kind = 'counter'
+    
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = labelnames
+        # Sin etiquetas se publica 0 desde el inicio
+        self.values = {} if labelnames else {(): 0}
+        self._lock = threading.Lock()
+        metrics_registry.append(self)
+    
+    def inc(self, amount=1, *labels):
+        with self._lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+    
+    def samples(self):
+        with self._lock:
+            items = list(self.values.items())
+        for labels, value in items:
+            yield self.name + format_labels(self.labelnames, labels), value
+
+class Gauge:
+    """Valor instantaneo que se calcula al pedir las metricas.
+    Con etiquetas, la funcion devuelve una lista de (valores de etiquetas, valor)"""
+    kind = 'gauge'
+    
+    def __init__(self, name, help_text, function, labelnames=()):
+        self.name = name
+        self.help = help_text
+        self.function = function
+        self.labelnames = labelnames
+        metrics_registry.append(self)
+    
+    def samples(self):
+        try:
+            values = self.function() if self.labelnames else [((), self.function())]
+        except Exception:
+            return
+        for labels, value in values:
+            yield self.name + format_labels(self.labelnames, labels), value
+
+class Histogram:
+    """Histograma acumulativo con buckets fijos, opcionalmente con etiquetas"""
+    kind = 'histogram'
+    
+    def __init__(self, name, help_text, buckets=LATENCY_BUCKETS, labelnames=()):
+        self.name = name
+        self.help = help_text
+        self.buckets = tuple(buckets)
+        self.labelnames = labelnames
+        self.series = {}
+        self._lock = threading.Lock()
+        metrics_registry.append(self)
+    
+    def observe(self, value, *labels):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self.series.get(labels)
+            if series is None:
+                # [cuentas por bucket..., +Inf, suma]
+                series = self.series[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[index] += 1
+            series[-1] += value
+    
+    def samples(self):
+        with self._lock:
+            items = [(labels, list(series)) for labels, series in self.series.items()]
+        for labels, series in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), series[:-1]):
+                cumulative += count
+                yield self.name + '_bucket' + format_labels(self.labelnames, labels, [('le', bound)]), cumulative
+            yield self.name + '_sum' + format_labels(self.labelnames, labels), series[-1]
+            yield self.name + '_count' + format_labels(self.labelnames, labels), cumulative
+
+def render_metrics():
+    """Todas las metricas en formato de texto de Prometheus"""
+    lines = []
+    for metric in metrics_registry:
+        lines.append(f"# HELP {metric.name} {metric.help}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        for sample, value in metric.samples():
+            lines.append(f"{sample} {value}")
+    return '\n'.join(lines) + '\n'
+
+HANDSHAKE_SECONDS = Histogram('mcproxy_accept_to_handshake_seconds',
+                              'Tiempo desde accept hasta tener el handshake decodificado')
+PROBE_SECONDS = Histogram('mcproxy_backend_probe_seconds',
+                          'Duracion de los sondeos al servidor real', labelnames=('backend', 'probe'))
+STATUS_RESPONSE_SECONDS = Histogram('mcproxy_status_response_seconds',
+                                    'Tiempo desde el handshake hasta enviar la respuesta de status')
+WAKE_READY_SECONDS = Histogram('mcproxy_wake_to_ready_seconds',
+                               'Tiempo desde el magic packet hasta que el servidor acepta conexiones',
+                               buckets=WAKE_BUCKETS, labelnames=('backend',))
+TUNNEL_RTT_SECONDS = Histogram('mcproxy_tunnel_rtt_seconds', 'RTT suavizado de TCP al cerrar cada tunel',
+                               labelnames=('profile', 'side'))
+TUNNEL_THROUGHPUT = Histogram('mcproxy_tunnel_throughput_bytes_per_second',
+                              'Bytes por segundo de vida de cada tunel (ambas direcciones)',
+                              buckets=(1e2, 1e3, 1e4, 1e5, 1e6, 1e7, 1e8, 1e9), labelnames=('profile',))
+TUNNEL_RETRANSMITS_TOTAL = Counter('mcproxy_tunnel_retransmits_total', 'Segmentos TCP retransmitidos en los tuneles',
+                                   labelnames=('profile', 'side'))
+TUNNEL_BYTES = Histogram('mcproxy_tunnel_bytes', 'Bytes reenviados por tunel (ambas direcciones)',
+                         buckets=BYTES_BUCKETS)
+CONNECTIONS_TOTAL = Counter('mcproxy_connections_total', 'Conexiones por intencion del handshake',
+                            labelnames=('next_state',))
+BYTES_FORWARDED_TOTAL = Counter('mcproxy_bytes_forwarded_total', 'Bytes reenviados por los tuneles',
+                                labelnames=('direction',))
+TUNNELS_TOTAL = Counter('mcproxy_tunnels_total', 'Tuneles de login abiertos desde el arranque')
+WHITELIST_REJECTS_TOTAL = Counter('mcproxy_whitelist_rejects_total', 'Logins rechazados por la whitelist')
+PREWAKE_WINDOWS_TOTAL = Counter('mcproxy_prewake_windows_total', 'Franjas previstas ya terminadas',
+                                labelnames=('backend', 'result'))
+WOL_SENT_TOTAL = Counter('mcproxy_wol_packets_sent_total', 'Magic packets de Wake-on-LAN enviados',
+                         labelnames=('backend',))
+ADMISSION_REJECTS_TOTAL = Counter('mcproxy_admission_rejects_total', 'Conexiones rechazadas en el accept',
+                                  labelnames=('reason',))
+HANDLER_QUEUE_WAIT_SECONDS = Histogram('mcproxy_handler_queue_wait_seconds',
+                                        'Tiempo de una conexion admitida en la cola del pool de handlers')
+LOG_DROPPED_TOTAL = Counter('mcproxy_log_dropped_total', 'Mensajes de registro descartados con la cola llena')
+QUERY_REQUESTS_TOTAL = Counter('mcproxy_query_requests_total', 'Peticiones del query UDP por tipo',
+                               labelnames=('type',))
+DEADLINES_EXPIRED_TOTAL = Counter('mcproxy_deadlines_expired_total', 'Conexiones cortadas por plazo vencido',
+                                  labelnames=('phase',))
+LOG_SAMPLED_OUT_TOTAL = Counter('mcproxy_log_sampled_out_total', 'Eventos repetitivos omitidos del registro',
+                                labelnames=('event',))
+
+def resident_bytes():
+    """Memoria residente (RSS) del proceso segun /proc/self/statm (0 fuera de Linux)"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return 0
+
+def memory_per_tunnel():
+    """Media de TunnelStats.memory() de los tuneles abiertos, para dimensionar el pool y
+    los limites (0 sin tuneles). Medida de los objetos vivos, no de la RSS"""
+    tunnels = list(active_tunnels)
+    if not tunnels:
+        return 0
+    return sum(tunnel.memory() for tunnel in tunnels) // len(tunnels)
+
+Gauge('mcproxy_active_tunnels', 'Tuneles de login abiertos ahora', lambda: len(active_tunnels))
+Gauge('mcproxy_active_handshakes', 'Conexiones en fase de handshake ahora', lambda: admission.active_handshakes)
+Gauge('mcproxy_handler_pool_size', 'Hilos del pool de handlers (motor threads)',
+      lambda: handler_pool.size if handler_pool is not None else 0)
+Gauge('mcproxy_handler_pool_busy', 'Hilos del pool atendiendo una conexion ahora',
+      lambda: handler_pool.busy if handler_pool is not None else 0)
+Gauge('mcproxy_handler_pool_queued', 'Conexiones admitidas esperando un hilo del pool',
+      lambda: handler_pool.queue.qsize() if handler_pool is not None else 0)
+Gauge('mcproxy_resident_bytes', 'Memoria residente del proceso', lambda: resident_bytes())
+Gauge('mcproxy_memory_per_connection_bytes',
+      'Memoria media por tunel abierto: estado y buffers de copia (sin pilas de hilos ni buffers del kernel)',
+      lambda: memory_per_tunnel())
+Gauge('mcproxy_backend_online', '1 si el servidor real esta en linea',
+      lambda: [((backend.name,), int(backend.monitor.is_online())) for backend in router.backends],
+      labelnames=('backend',))
+
+# --- REGISTRO ---
+
+DEBUG, INFO, WARNING, ERROR = 10, 20, 30, 40
+LOG_LEVELS = {'DEBUG': DEBUG, 'INFO': INFO, 'WARNING': WARNING, 'ERROR': ERROR}
+
+class LogWriter:
+    """Cola acotada de registros (nivel, etiqueta, mensaje, argumentos) y un hilo que
+    la vacia por lotes. El mensaje se formatea en el hilo escritor, no en el handler"""
+    
+    def __init__(self, stream=None, queue_size=None, flush_interval=None):
+        self.stream = stream
+        self.queue_size = queue_size if queue_size is not None else LOG_QUEUE_SIZE
+        self.flush_interval = flush_interval if flush_interval is not None else LOG_FLUSH_INTERVAL
+        self.level = LOG_LEVELS[LOG_LEVEL]
+        self.queue = collections.deque()
+        self.dropped = 0
+        self._wakeup = threading.Event()
+        self._flush_lock = threading.Lock()
+    
+    def emit(self, level, tag, message, args):
+        if len(self.queue) >= self.queue_size:
+            self.dropped += 1
+            LOG_DROPPED_TOTAL.inc()
+            return
+        self.queue.append((level, tag, message, args))
+        if level >= WARNING:
+            self._wakeup.set()
+    
+    def start(self):
+        """Arranca el hilo escritor (hay que relanzarlo tras un fork)"""
+        threading.Thread(target=self._run, name="log-writer", daemon=True).start()
+    
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception:
+                pass
+    
+    def flush(self):
+        """Escribe todo lo pendiente de una vez"""
+        with self._flush_lock:
+            lines = []
+            queue = self.queue
+            while queue:
+                level, tag, message, args = queue.popleft()
+                try:
+                    text = message.format(*args) if args else message
+                except Exception as e:
+                    text = f"{message} {args} (error de formato: {e})"
+                lines.append(f"[{tag}] {text}\n")
+            if self.dropped:
+                dropped, self.dropped = self.dropped, 0
+                lines.append(f"[LOG] {dropped} mensajes descartados (cola de registro llena)\n")
+            if lines:
+                stream = self.stream or sys.stdout
+                stream.write(''.join(lines))
+                stream.flush()
+    
+    def discard(self):
+        """Vacia la cola sin escribir (en el hijo de un fork, que hereda la cola del padre)"""
+        self.queue.clear()
+        self.dropped = 0
+
+class LogSampler:
+    """Deja pasar LOG_SAMPLE_BURST eventos por ventana y cuenta el resto. Al abrir
+    la ventana siguiente registra cuantos se omitieron"""
+    
+    def __init__(self, event, burst=None, window=None):
+        self.event = event
+        self.burst = burst if burst is not None else LOG_SAMPLE_BURST
+        self.window = window if window is not None else LOG_SAMPLE_WINDOW
+        self.window_start = 0.0
+        self.count = 0
+        self.suppressed = 0
+    
+    def sample(self):
+        now = time.monotonic()
+        if now - self.window_start >= self.window:
+            if self.suppressed:
+                log(INFO, 'LOG', "{} eventos '{}' omitidos en {:.0f}s", self.suppressed, self.event,
+                    now - self.window_start)
+            self.window_start = now
+            self.count = 0
+            self.suppressed = 0
+        if self.count < self.burst:
+            self.count += 1
+            return True
+        self.suppressed += 1
+        LOG_SAMPLED_OUT_TOTAL.inc(1, self.event)
+        return False
+
+log_writer = LogWriter()
+log_samplers = {}
+
+def log(level, tag, message, *args):
+    """Encola un mensaje "[tag] mensaje". Los argumentos se aplican con str.format
+    en el hilo escritor; los mensajes por debajo de LOG_LEVEL cuestan una comparacion"""
+    if level >= log_writer.level:
+        log_writer.emit(level, tag, message, args)
+
+def log_sampled(event):
+    """True si este evento repetitivo debe registrarse (muestreo por ventana)"""
+    sampler = log_samplers.get(event)
+    if sampler is None:
+        sampler = log_samplers.setdefault(event, LogSampler(event))
+    return sampler.sample()
+
+def flush_log():
+    log_writer.flush()
+
+atexit.register(flush_log)
+
+# --- TRAZAS ---
+
+trace_ids = itertools.count(1)
+# Prefijo de los ids de conexion ("w2-" en el worker 2) para que no se repitan entre procesos
+trace_prefix = ''
+
+class ConnectionTrace:
+    """Fases de una conexion: (nombre, segundos desde la marca anterior)"""
+    
+    __slots__ = ('conn_id', 'peer', 'started', 'last', 'phases', 'outcome', 'finished')
+    
+    def __init__(self, accepted_at, peer):
+        self.conn_id = f"{trace_prefix}{next(trace_ids)}"
+        self.peer = peer
+        self.started = accepted_at
+        self.last = accepted_at
+        self.phases = []
+        self.outcome = 'cerrada'
+        self.finished = False
+    
+    def mark(self, phase):
+        now = time.perf_counter()
+        self.phases.append((phase, now - self.last))
+        self.last = now
+    
+    def finish(self):
+        """Vuelca el desglose si la conexion fue lenta (o siempre en DEBUG). Idempotente"""
+        if self.finished:
+            return
+        self.finished = True
+        total = time.perf_counter() - self.started
+        if total >= TRACE_SLOW_THRESHOLD:
+            level, label = WARNING, "lenta"
+        elif log_writer.level <= DEBUG:
+            level, label = DEBUG, "ok"
         else:
-            # Crear archivo de ejemplo si no existe
-            example_whitelist = {
-                "enabled": True,
-                "players": [
-                    "Notch",
-                    "Jeb_",
-                    "TuNombreAqui"
-                ]
-            }
-            with open(WHITELIST_PATH, 'w', encoding='utf-8') as f:
-                json.dump(example_whitelist, f, indent=2, ensure_ascii=False)
-            whitelist = example_whitelist['players']
-            whitelist_enabled = example_whitelist['enabled']
-            print(f"[WHITELIST] Creado archivo de ejemplo en {WHITELIST_PATH}")
-    except Exception as e:
-        print(f"[WHITELIST] Error cargando whitelist: {e}")
-        whitelist = []
-        whitelist_enabled = False
+            return
+        breakdown = ", ".join(f"{phase} {seconds * 1000:.1f}ms" for phase, seconds in self.phases)
+        log(level, 'TRAZA', "Conexion #{} {} {} ({}): {:.1f}ms - {}", self.conn_id, self.peer, label,
+            self.outcome, total * 1000, breakdown)
+
+class NullTrace:
+    """Traza que no hace nada (TRACE_ENABLED = False)"""
+    
+    __slots__ = ()
+    outcome = None
+    
+    def mark(self, phase):
+        pass
+    
+    def finish(self):
+        pass
+    
+    def __setattr__(self, name, value):
+        pass
+
+NULL_TRACE = NullTrace()
+
+def start_trace(accepted_at, peer=None, sock=None):
+    """Traza nueva para una conexion, o NULL_TRACE si las trazas estan desactivadas"""
+    if not TRACE_ENABLED:
+        return NULL_TRACE
+    if peer is None and sock is not None:
+        try:
+            peer = sock.getpeername()
+        except OSError:
+            pass
+    trace = ConnectionTrace(accepted_at, peer)
+    trace.mark('admision')
+    return trace
+
+# --- PERFILADOR ---
+
+profiler_lock = threading.Lock()
+
+def frame_label(code):
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+def run_profiler(duration=None, interval=None, top=None):
+    """Muestrea sys._current_frames() y registra las funciones con mas muestras:
+    'propio' = la funcion estaba en lo alto de la pila, 'acumulado' = estaba en la pila"""
+    duration = duration if duration is not None else PROFILE_DURATION
+    interval = interval if interval is not None else PROFILE_INTERVAL
+    top = top if top is not None else PROFILE_TOP
+    if not profiler_lock.acquire(blocking=False):
+        log(INFO, 'PERFIL', "Ya hay un perfilado en curso")
+        return
+    try:
+        log(INFO, 'PERFIL', "Muestreando pilas durante {}s (pid {})", duration, os.getpid())
+        own = threading.get_ident()
+        own_counts = collections.Counter()
+        stack_counts = collections.Counter()
+        samples = 0
+        rounds = 0
+        deadline = time.monotonic() + duration
+        while time.monotonic() < deadline:
+            rounds += 1
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                samples += 1
+                own_counts[frame.f_code] += 1
+                seen = set()
+                while frame is not None:
+                    if frame.f_code not in seen:
+                        seen.add(frame.f_code)
+                        stack_counts[frame.f_code] += 1
+                    frame = frame.f_back
+            time.sleep(interval)
+        
+        if not samples:
+            log(INFO, 'PERFIL', "Sin muestras")
+            return
+        lines = [f"{samples} muestras en {rounds} rondas (pid {os.getpid()}). Mas calientes:"]
+        for code, count in own_counts.most_common(top):
+            lines.append(f"  {count * 100 / samples:5.1f}% propio {stack_counts[code] * 100 / samples:5.1f}% "
+                         f"acumulado  {frame_label(code)}")
+        log(INFO, 'PERFIL', "\n".join(lines))
+    finally:
+        profiler_lock.release()
+
+def handle_profile_signal(signum, frame):
+    """SIGUSR1: perfila en un hilo aparte (el handler no puede bloquear el hilo principal)"""
+    threading.Thread(target=run_profiler, name="profiler", daemon=True).start()
+
+def install_signal(signum, handler):
+    try:
+        signal.signal(signum, handler)
+    except ValueError:
+        # signal.signal solo funciona en el hilo principal (p. ej. main() lanzado desde un hilo)
+        log(DEBUG, 'PROXY', "No se pudo instalar el handler de {} fuera del hilo principal",
+            signal.Signals(signum).name)
+
+def install_profile_signal(handler=None):
+    if PROFILE_SIGNAL_ENABLED:
+        install_signal(signal.SIGUSR1, handler or handle_profile_signal)
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    """Sirve GET /metrics"""
+    
+    # ruta -> (funcion que genera el cuerpo, Content-Type)
+    routes = {'/metrics': (lambda: render_metrics(), 'text/plain; version=0.0.4; charset=utf-8')}
+    
+    def do_GET(self):
+        route = self.routes.get(self.path.split('?', 1)[0])
+        if route is None:
+            self.send_error(404)
+            return
+        render, content_type = route
+        body = render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+    
+    def log_message(self, format, *args):
+        pass
+
+class IdleHandler(MetricsHandler):
+    """Sirve GET /idle"""
+    
+    routes = {'/idle': (lambda: render_idle(), 'application/json')}
+
+http_servers = []
+
+def start_http_server(handler, host, port, name, server_class=http.server.ThreadingHTTPServer):
+    """Sirve handler en un hilo propio. Si el puerto esta ocupado (p. ej. por el proceso
+    que se esta drenando tras una actualizacion) sigue intentandolo un tiempo"""
+    def serve():
+        deadline = time.monotonic() + UPGRADE_READY_TIMEOUT
+        while True:
+            try:
+                server = server_class((host, port), handler)
+                break
+            except OSError as e:
+                if e.errno != errno.EADDRINUSE or time.monotonic() >= deadline:
+                    log(ERROR, 'ERROR', "No se pudo abrir {} en {}:{}: {}", name, host, port, e)
+                    return
+                time.sleep(0.5)
+        server.daemon_threads = True
+        http_servers.append(server)
+        server.serve_forever()
+    threading.Thread(target=serve, name=name, daemon=True).start()
+
+def close_http_servers():
+    """Cierra los endpoints HTTP de este proceso (para cederle los puertos a otro)"""
+    while http_servers:
+        server = http_servers.pop()
+        server.shutdown()
+        server.server_close()
+
+def start_metrics_server(port=None):
+    """Arranca el endpoint de metricas en un hilo propio"""
+    port = port if port is not None else METRICS_PORT
+    start_http_server(MetricsHandler, METRICS_HOST, port, "metrics-http")
+    log(INFO, 'METRICAS', "Endpoint en http://{}:{}/metrics", METRICS_HOST, port)
+
+def render_idle():
+    """Actividad de los tuneles por servidor. idle_seconds es 0 mientras haya tuneles abiertos"""
+    now = time.time()
+    backends = {}
+    for backend in router.backends:
+        active, last_activity = backend.idle_state()
+        backends[backend.name] = {
+            "online": backend.monitor.is_online(),
+            "waking": backend.wake.state == WakeController.WAKING,
+            "active_tunnels": active,
+            "last_activity": round(last_activity, 3),
+            "idle_seconds": 0 if active else round(max(0.0, now - last_activity), 3),
+            "keep_awake": backend.keep_awake_until > now,
+        }
+    return json.dumps({"time": round(now, 3), "backends": backends})
+
+def start_idle_server():
+    """Arranca el endpoint de actividad en un hilo propio"""
+    start_http_server(IdleHandler, IDLE_ENDPOINT_HOST, IDLE_ENDPOINT_PORT, "idle-http")
+    log(INFO, 'ACTIVIDAD', "Endpoint en http://{}:{}/idle", IDLE_ENDPOINT_HOST, IDLE_ENDPOINT_PORT)
+
+def start_http_endpoints():
+    """Metricas, actividad y query del proceso principal (el supervisor si hay workers)"""
+    if METRICS_ENABLED:
+        start_metrics_server()
+    # Actividad de los tuneles para el agente de suspension
+    if IDLE_ENDPOINT_ENABLED:
+        start_idle_server()
+    if QUERY_ENABLED:
+        start_query_server()
+
+# Estado inmutable de la whitelist: se reemplaza entero en cada recarga, asi los
+# handlers lo leen sin locks
+WhitelistSnapshot = collections.namedtuple('WhitelistSnapshot', ['enabled', 'names', 'uuids', 'size'])
+
+def normalize_uuid(value):
+    """Normaliza un UUID a 32 caracteres hex en minusculas (o None si no es valido)"""
+    if not isinstance(value, str):
+        return None
+    value = value.replace('-', '').lower()
+    if len(value) != 32:
+        return None
+    try:
+        int(value, 16)
+    except ValueError:
+        return None
+    return value
+
+def build_whitelist_snapshot(data):
+    """Construye el indice de la whitelist a partir del JSON.
+    Acepta nombres sueltos o entradas {"name": ..., "uuid": ...} como la whitelist de vanilla.
+    uuids va de nombre a UUID, solo para las entradas que traen los dos"""
+    names = set()
+    uuids = {}
+    players = data.get('players', [])
+    for entry in players:
+        if isinstance(entry, str):
+            names.add(entry.lower())
+        elif isinstance(entry, dict) and isinstance(entry.get('name'), str):
+            name = entry['name'].lower()
+            names.add(name)
+            uuid = normalize_uuid(entry.get('uuid'))
+            if uuid:
+                uuids[name] = uuid
+    return WhitelistSnapshot(bool(data.get('enabled', True)), frozenset(names), uuids, len(players))
+
+class Whitelist:
+    """Whitelist indexada con recarga en caliente.
+    Un hilo revisa el mtime del archivo y publica un nuevo snapshot cuando cambia"""
+    
+    def __init__(self, path, poll_interval=None):
+        self.path = path
+        self.poll_interval = poll_interval if poll_interval is not None else WHITELIST_POLL_INTERVAL
+        self.snapshot = WhitelistSnapshot(True, frozenset(), {}, 0)
+        self._stamp = None
+        self._thread = None
+        self._stopped = False
+    
+    def _stat(self):
+        try:
+            st = os.stat(self.path)
+            return (st.st_ino, st.st_size, st.st_mtime_ns)
+        except OSError:
+            return None
+    
+    def load(self, initial=False):
+        """Lee el archivo y reemplaza el snapshot. En una recarga, si el archivo
+        esta mal formado (p. ej. a medio guardar) se conserva el anterior"""
+        try:
+            if os.path.exists(self.path):
+                self._stamp = self._stat()
+                with open(self.path, 'r', encoding='utf-8') as f:
+                    data = json.load(f)
+                self.snapshot = build_whitelist_snapshot(data)
+                log(INFO, 'WHITELIST', "Cargados {} jugadores desde {}", self.snapshot.size, self.path)
+                log(INFO, 'WHITELIST', "Estado: {}", 'ACTIVADA' if self.snapshot.enabled else 'DESACTIVADA')
+            elif initial:
+                # Crear archivo de ejemplo si no existe
+                example_whitelist = {
+                    "enabled": True,
+                    "players": [
+                        "Notch",
+                        "Jeb_",
+                        "TuNombreAqui"
+                    ]
+                }
+                with open(self.path, 'w', encoding='utf-8') as f:
+                    json.dump(example_whitelist, f, indent=2, ensure_ascii=False)
+                self._stamp = self._stat()
+                self.snapshot = build_whitelist_snapshot(example_whitelist)
+                log(INFO, 'WHITELIST', "Creado archivo de ejemplo en {}", self.path)
+        except Exception as e:
+            log(ERROR, 'WHITELIST', "Error cargando whitelist: {}", e)
+            if initial:
+                self.snapshot = WhitelistSnapshot(False, frozenset(), {}, 0)
+    
+    def start(self):
+        """Arranca el hilo que vigila cambios en el archivo"""
+        self._thread = threading.Thread(target=self._run, name="whitelist-watcher", daemon=True)
+        self._thread.start()
+    
+    def stop(self):
+        """Detiene el vigilante (la whitelist deja de usarse tras una recarga)"""
+        self._stopped = True
+    
+    def _run(self):
+        while not self._stopped:
+            time.sleep(self.poll_interval)
+            stamp = self._stat()
+            if stamp is not None and stamp != self._stamp:
+                log(INFO, 'WHITELIST', "Cambios detectados en {} - recargando", self.path)
+                self.load()
+    
+    def is_allowed(self, player_name, player_uuid=None):
+        """Comprueba un jugador por nombre (sin distinguir mayusculas). El UUID lo declara el
+        cliente y el servidor no lo verifica: nunca basta para entrar, solo se exige ademas
+        del nombre si la entrada de la whitelist lo trae y el cliente lo envia"""
+        snapshot = self.snapshot
+        # Si la whitelist esta desactivada o vacia, permitir a todos
+        if not snapshot.enabled or not snapshot.size:
+            return True
+        if player_name is None:
+            return False
+        name = player_name.lower()
+        if name not in snapshot.names:
+            return False
+        expected = snapshot.uuids.get(name)
+        return expected is None or player_uuid is None or player_uuid == expected
+
+def load_whitelist():
+    """Carga la whitelist desde el archivo JSON (el vigilante se arranca con whitelist.start())"""
+    global whitelist
+    whitelist = Whitelist(WHITELIST_PATH)
+    whitelist.load(initial=True)
 
-def is_player_whitelisted(player_name):
+def is_player_whitelisted(player_name, player_uuid=None):
     """Verifica si un jugador esta en la whitelist"""
-    # Si la whitelist esta desactivada, permitir a todos
-    if not whitelist_enabled:
-        return True
-    # Si la whitelist esta vacia, permitir a todos
-    if not whitelist:
-        return True
-    return player_name in whitelist
+    return whitelist.is_allowed(player_name, player_uuid)
+
+def extract_login_start(login_packet_data):
+    """Extrae (nombre, UUID) del Login Start packet. El UUID es None si el cliente no lo envia"""
+    # El formato depende de la version:
+    # - 1.20.2+: String nombre + UUID (16 bytes)
+    # - 1.19.3 a 1.20.1: String nombre + Boolean "tiene UUID" + UUID opcional
+    # - versiones antiguas: solo el nombre
+    # Ojo: el UUID lo declara el cliente, igual que el nombre
+    player_name, offset = read_string(login_packet_data, 0)
+    remaining = len(login_packet_data) - offset
+    player_uuid = None
+    if remaining == 16:
+        player_uuid = login_packet_data[offset:offset+16].hex()
+    elif remaining == 17 and login_packet_data[offset] == 1:
+        player_uuid = login_packet_data[offset+1:offset+17].hex()
+    return player_name, player_uuid
 
 def extract_player_name(login_packet_data):
     """Extrae el nombre del jugador del Login Start packet"""
     try:
-        # En el Login Start packet (0x00 en login state), el formato es:
-        # - String: nombre del jugador (VarInt length + UTF-8)
-        # - UUID: UUID del jugador (16 bytes) - solo en versiones modernas
-        
-        # Leer longitud del nombre (VarInt)
-        name_length, offset = read_varint_from_bytes(login_packet_data)
-        if name_length is None:
-            return None
-        
-        # Leer el nombre del jugador
-        player_name = login_packet_data[offset:offset+name_length].decode('utf-8')
+        player_name, _ = extract_login_start(login_packet_data)
         return player_name
     except Exception as e:
-        print(f"[ERROR] Error extrayendo nombre del jugador: {e}")
+        log(ERROR, 'ERROR', "Error extrayendo nombre del jugador: {}", e)
         return None
 
 def load_server_icon():
@@ -133,26 +970,32 @@ def load_server_icon():
             with open(SERVER_ICON_PATH, 'rb') as f:
                 icon_data = f.read()
                 server_icon_base64 = "data:image/png;base64," + base64.b64encode(icon_data).decode('utf-8')
-            print(f"[ICON] Icono del servidor cargado desde {SERVER_ICON_PATH}")
+            invalidate_status_cache()
+            log(INFO, 'ICON', "Icono del servidor cargado desde {}", SERVER_ICON_PATH)
         else:
-            print(f"[ICON] No se encontro icono en {SERVER_ICON_PATH}")
+            if server_icon_base64 is not None:
+                server_icon_base64 = None
+                invalidate_status_cache()
+            log(INFO, 'ICON', "No se encontro icono en {}", SERVER_ICON_PATH)
     except Exception as e:
-        print(f"[ICON] Error cargando icono: {e}")
+        log(ERROR, 'ICON', "Error cargando icono: {}", e)
 
-def get_real_server_status():
+def get_real_server_status(host=None, port=None):
     """Obtiene el estado real del servidor incluyendo jugadores conectados"""
+    host = host or SERVER_HOST
+    port = port or SERVER_PORT
     try:
         # Crear conexion temporal al servidor real
         sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         sock.settimeout(2)
-        sock.connect((SERVER_HOST, SERVER_PORT))
+        sock.connect((host, port))
         
         # Construir handshake packet (Status request)
         handshake_data = b''
         handshake_data += write_varint(0)  # Packet ID
         handshake_data += write_varint(767)  # Protocol version
-        handshake_data += write_varint(len(SERVER_HOST)) + SERVER_HOST.encode('utf-8')
-        handshake_data += struct.pack('>H', SERVER_PORT)
+        handshake_data += write_varint(len(host)) + host.encode('utf-8')
+        handshake_data += struct.pack('>H', port)
         handshake_data += write_varint(1)  # Next state (status)
         
         # Enviar handshake
@@ -176,7 +1019,7 @@ def get_real_server_status():
         sock.close()
         return None
     except Exception as e:
-        print(f"[DEBUG] Error obteniendo status real: {e}")
+        log(DEBUG, 'DEBUG', "Error obteniendo status real: {}", e)
         return None
 
 def read_varint(sock):
@@ -206,35 +1049,48 @@ def write_varint(value):
     return data
 
 def read_packet(sock):
-    """Lee un paquete completo del protocolo de Minecraft"""
+    """Lee un paquete completo del protocolo de Minecraft sin consumir bytes de mas"""
     try:
-        # Leer longitud del paquete (VarInt)
-        length = read_varint(sock)
+        # Mirar la cabecera sin consumirla para saber cuantos bytes ocupa la longitud
+        header = sock.recv(5, socket.MSG_PEEK)
+        if not header:
+            return None, None
+        length, offset = read_varint_from_bytes(header)
         if length is None:
+            # VarInt incompleto en el buffer del kernel: lectura byte a byte
+            length = read_varint(sock)
+            if length is None:
+                return None, None
+        else:
+            sock.recv(offset)
+        if length > MAX_PACKET_SIZE:
             return None, None
         
-        # Leer datos del paquete
-        data = b''
-        while len(data) < length:
-            chunk = sock.recv(length - len(data))
-            if not chunk:
+        # Leer datos del paquete en un buffer ya reservado
+        data = bytearray(length)
+        view = memoryview(data)
+        received = 0
+        while received < length:
+            count = sock.recv_into(view[received:])
+            if not count:
                 return None, None
-            data += chunk
+            received += count
         
         # Leer packet ID (VarInt)
         packet_id, offset = read_varint_from_bytes(data)
-        packet_data = data[offset:]
+        packet_data = bytes(view[offset:])
         
         return packet_id, packet_data
     except:
         return None, None
 
-def read_varint_from_bytes(data):
-    """Lee un VarInt desde bytes"""
+def read_varint_from_bytes(data, offset=0):
+    """Lee un VarInt desde bytes (o bytearray/memoryview) a partir de offset.
+    Devuelve (valor, offset siguiente) o (None, offset) si esta incompleto"""
     value = 0
-    offset = 0
+    end = len(data)
     for i in range(5):
-        if offset >= len(data):
+        if offset >= end:
             return None, offset
         byte = data[offset]
         value |= (byte & 0x7F) << (7 * i)
@@ -243,32 +1099,120 @@ def read_varint_from_bytes(data):
             return value, offset
     return None, offset
 
+def read_string(data, offset=0):
+    """Lee un String del protocolo (VarInt length + UTF-8) sin copiar el buffer.
+    Devuelve (texto, offset siguiente)"""
+    length, offset = read_varint_from_bytes(data, offset)
+    if length is None or offset + length > len(data):
+        raise ValueError("String incompleto")
+    end = offset + length
+    return str(memoryview(data)[offset:end], 'utf-8'), end
+
+class PacketReader:
+    """Decodificador de paquetes por conexion.
+    Lee bloques grandes del socket a un bytearray y va separando paquetes completos;
+    lo que sobra queda disponible con leftover() para reenviarlo al servidor"""
+    
+    def __init__(self, sock=None):
+        self.sock = sock
+        self.buffer = bytearray()
+        self.pos = 0
+    
+    def feed(self, data):
+        """Agrega bytes recibidos al buffer"""
+        self.buffer += data
+    
+    def next_packet(self):
+        """Extrae un paquete completo del buffer.
+        Devuelve (packet_id, datos) o None si todavia faltan bytes"""
+        buffer = self.buffer
+        length, offset = read_varint_from_bytes(buffer, self.pos)
+        if length is None:
+            if offset - self.pos >= 5:
+                raise ValueError("Longitud de paquete invalida")
+            return None
+        if length > MAX_PACKET_SIZE:
+            raise ValueError(f"Paquete demasiado grande: {length} bytes")
+        end = offset + length
+        if end > len(buffer):
+            return None
+        
+        packet_id, offset = read_varint_from_bytes(buffer, offset)
+        if packet_id is None or offset > end:
+            raise ValueError("Packet ID invalido")
+        # Una sola copia (el slice de un bytearray ya es una). La vista se suelta antes de
+        # compactar: un bytearray con vistas abiertas no puede cambiar de tamano
+        with memoryview(buffer) as view:
+            packet_data = bytes(view[offset:end])
+        
+        # Compactar el buffer cuando todo lo leido ya fue consumido
+        if end == len(buffer):
+            buffer.clear()
+            self.pos = 0
+        else:
+            self.pos = end
+        return packet_id, packet_data
+    
+    def read_packet(self):
+        """Lee del socket hasta tener un paquete completo"""
+        try:
+            while True:
+                packet = self.next_packet()
+                if packet is not None:
+                    return packet
+                data = self.sock.recv(PACKET_READ_SIZE)
+                if not data:
+                    return None, None
+                self.buffer += data
+        except (OSError, ValueError):
+            return None, None
+    
+    async def read_packet_async(self, stream):
+        """Igual que read_packet pero leyendo de un StreamReader"""
+        try:
+            while True:
+                packet = self.next_packet()
+                if packet is not None:
+                    return packet
+                data = await stream.read(PACKET_READ_SIZE)
+                if not data:
+                    return None, None
+                self.buffer += data
+        except (OSError, ValueError):
+            return None, None
+    
+    def leftover(self):
+        """Devuelve (y descarta) los bytes recibidos que aun no forman parte de un paquete"""
+        data = bytes(self.buffer[self.pos:])
+        self.buffer.clear()
+        self.pos = 0
+        return data
+
+def encode_packet(packet_id, data=b''):
+    """Construye un paquete completo (longitud + packet ID + datos)"""
+    # Packet ID como VarInt
+    full_data = write_varint(packet_id) + data
+    
+    # Longitud como VarInt
+    return write_varint(len(full_data)) + full_data
+
 def send_packet(sock, packet_id, data=b''):
     """Envia un paquete segun el protocolo de Minecraft"""
     try:
-        # Packet ID como VarInt
-        packet_id_bytes = write_varint(packet_id)
-        
-        # Datos completos
-        full_data = packet_id_bytes + data
-        
-        # Longitud como VarInt
-        length_bytes = write_varint(len(full_data))
-        
-        # Enviar todo
-        sock.sendall(length_bytes + full_data)
+        sock.sendall(encode_packet(packet_id, data))
         return True
     except:
         return False
 
+def encode_json_string(json_data, ensure_ascii=True):
+    """Codifica un objeto JSON como String del protocolo (VarInt length + UTF-8)"""
+    json_bytes = json.dumps(json_data, ensure_ascii=ensure_ascii).encode('utf-8')
+    return write_varint(len(json_bytes)) + json_bytes
+
 def send_status_response(sock, json_data):
     """Envia respuesta de status (packet 0x00)"""
-    json_str = json.dumps(json_data)
-    json_bytes = json_str.encode('utf-8')
-    
     # Packet: 0x00 + String (JSON)
-    data = write_varint(len(json_bytes)) + json_bytes
-    return send_packet(sock, 0x00, data)
+    return send_packet(sock, 0x00, encode_json_string(json_data))
 
 def send_ping_response(sock, ping_data):
     """Responde al ping (packet 0x01)"""
@@ -281,299 +1225,3147 @@ def send_disconnect(sock, message):
     json_obj = {
         "text": message
     }
-    json_str = json.dumps(json_obj, ensure_ascii=False)
-    json_bytes = json_str.encode('utf-8')
-    
-    data = write_varint(len(json_bytes)) + json_bytes
-    return send_packet(sock, 0x00, data)
+    return send_packet(sock, 0x00, encode_json_string(json_obj, ensure_ascii=False))
 
-def is_server_online():
+def is_server_online(host=None, port=None):
     """Verifica si el servidor real esta en linea"""
     try:
-        with socket.create_connection((SERVER_HOST, SERVER_PORT), timeout=2):
+        with socket.create_connection((host or SERVER_HOST, port or SERVER_PORT), timeout=2):
             return True
     except:
         return False
 
+class BackendMonitor:
+    """Sondea el servidor real en un hilo propio y guarda el ultimo estado conocido.
+    Los handlers solo leen la cache, nunca esperan al servidor"""
+    
+    def __init__(self, host, port, name='', interval=None, backoff_max=None, ttl=None):
+        self.host = host
+        self.port = port
+        self.name = name
+        self.interval = interval if interval is not None else HEALTH_CHECK_INTERVAL
+        self.backoff_max = backoff_max if backoff_max is not None else HEALTH_BACKOFF_MAX
+        self.ttl = ttl if ttl is not None else HEALTH_CACHE_TTL
+        self.online = False
+        self.status = None
+        self.checked_at = 0.0
+        self.version = 0
+        self.shared = None
+        self._wakeup = threading.Event()
+        self._thread = None
+    
+    def start(self):
+        """Hace un primer sondeo sincrono y arranca el hilo de sondeo"""
+        self.probe()
+        self._thread = threading.Thread(target=self._run, name=f"backend-monitor-{self.name}", daemon=True)
+        self._thread.start()
+    
+    def probe(self):
+        """Sondea el servidor una vez y actualiza la cache"""
+        # Con el servidor dormido solo se paga un intento de conexion
+        started = time.perf_counter()
+        online = is_server_online(self.host, self.port)
+        online_seconds = time.perf_counter() - started
+        PROBE_SECONDS.observe(online_seconds, self.name, 'online')
+        status = None
+        status_seconds = 0.0
+        if online:
+            started = time.perf_counter()
+            status = get_real_server_status(self.host, self.port)
+            status_seconds = time.perf_counter() - started
+            PROBE_SECONDS.observe(status_seconds, self.name, 'status')
+        if TRACE_ENABLED and online_seconds + status_seconds >= TRACE_SLOW_THRESHOLD:
+            log(WARNING, 'TRAZA', "Sondeo lento de {}: is_server_online {:.1f}ms, get_real_server_status {:.1f}ms",
+                self.name, online_seconds * 1000, status_seconds * 1000)
+        
+        if online != self.online or status != self.status:
+            if online != self.online:
+                log(INFO, 'HEALTH', "Servidor {} {}", self.name, 'ACTIVO' if online else 'DORMIDO')
+            # Publicar primero el status y despues el flag para que los lectores
+            # nunca vean online=True con el status de un sondeo anterior
+            self.status = status
+            self.online = online
+            self.version += 1
+        self.checked_at = time.monotonic()
+        self.publish()
+        return online
+    
+    def report_unreachable(self):
+        """Un handler no pudo conectar: marcar offline y volver a sondear ya"""
+        if self.online:
+            self.online = False
+            self.version += 1
+            self.publish()
+        self._wakeup.set()
+    
+    def request_probe(self):
+        """Pide un sondeo inmediato sin esperar al resultado"""
+        self._wakeup.set()
+    
+    def publish(self):
+        """Copia el ultimo estado a la memoria compartida (modo multiproceso)"""
+        if self.shared is not None:
+            self.shared.publish(self.online, self.version, self.checked_at, self.status)
+    
+    def _run(self):
+        delay = self.interval
+        while True:
+            self._wakeup.wait(delay)
+            self._wakeup.clear()
+            try:
+                online = self.probe()
+            except Exception as e:
+                log(ERROR, 'HEALTH', "Error sondeando servidor {}: {}", self.name, e)
+                online = False
+            
+            # Backoff exponencial mientras el servidor duerme
+            if online:
+                delay = self.interval
+            else:
+                delay = min(delay * 2, self.backoff_max)
+    
+    def is_online(self):
+        return self.online
+    
+    def snapshot(self):
+        """Devuelve (online, status real, version) desde la cache. Un status mas
+        viejo que el TTL se descarta y se usa el MOTD por defecto"""
+        version = self.version
+        online = self.online
+        status = self.status
+        if status is not None and time.monotonic() - self.checked_at > self.ttl:
+            status = None
+        return online, status, version
+
+def parse_handshake(packet_data):
+    """Decodifica el handshake leyendo cada campo por offset, sin re-cortar el paquete.
+    Devuelve (protocol, server_addr, server_port, next_state)"""
+    # Leer protocol version (VarInt)
+    protocol, offset = read_varint_from_bytes(packet_data)
+    
+    # Leer server address (String)
+    server_addr, offset = read_string(packet_data, offset)
+    
+    # Leer server port (Unsigned Short)
+    server_port, = struct.unpack_from('>H', packet_data, offset)
+    offset += 2
+    
+    # Leer next state (VarInt)
+    next_state, _ = read_varint_from_bytes(packet_data, offset)
+    
+    return protocol, server_addr, server_port, next_state
+
+def route_handshake(packet_data):
+    """Decodifica el handshake y elige el backend segun el hostname que uso el cliente.
+    Devuelve (next_state, protocol, backend) o (None, None, None) si es invalido"""
+    try:
+        protocol, server_addr, _, next_state = parse_handshake(packet_data)
+    except Exception as e:
+        if log_sampled('handshake_invalido'):
+            log(WARNING, 'HANDSHAKE', "Error parsing handshake: {}", e)
+        return None, None, None
+    return next_state, protocol, router.route(server_addr)
+
 def handle_handshake(packet_data, client_socket):
     """Maneja el handshake inicial y determina la intencion del cliente"""
     try:
-        # Leer protocol version (VarInt)
-        protocol, offset = read_varint_from_bytes(packet_data)
-        
-        # Leer server address (String)
-        addr_len, offset2 = read_varint_from_bytes(packet_data[offset:])
-        offset += offset2
-        server_addr = packet_data[offset:offset+addr_len].decode('utf-8')
-        offset += addr_len
-        
-        # Leer server port (Unsigned Short)
-        server_port = struct.unpack('>H', packet_data[offset:offset+2])[0]
-        offset += 2
-        
-        # Leer next state (VarInt)
-        next_state, _ = read_varint_from_bytes(packet_data[offset:])
-        
+        protocol, _, _, next_state = parse_handshake(packet_data)
         return next_state, protocol
     except Exception as e:
-        print(f"Error parsing handshake: {e}")
+        if log_sampled('handshake_invalido'):
+            log(WARNING, 'HANDSHAKE', "Error parsing handshake: {}", e)
         return None, None
 
-def handle_status_request(client_socket, server_online, client_protocol):
+def build_status_response(server_online, client_protocol, real_status=None, backend=None):
+    """Construye el JSON de status segun el estado del servidor"""
+    status_online = backend.status_online if backend else FAKE_SERVER_STATUS_ONLINE
+    status_offline = backend.status_offline if backend else FAKE_SERVER_STATUS_OFFLINE
+    
+    # Seleccionar el MOTD apropiado segun el estado del servidor
+    # (copias profundas: nunca modificar las plantillas ni el status cacheado)
+    if server_online:
+        if real_status:
+            status_response = copy.deepcopy(real_status)
+            # Mantener nuestro MOTD personalizado pero usar los datos reales de jugadores
+            status_response["description"] = copy.deepcopy(status_online["description"])
+        else:
+            status_response = copy.deepcopy(status_online)
+    else:
+        status_response = copy.deepcopy(status_offline)
+    
+    # Usar el protocol del cliente para evitar incompatibilidad
+    status_response.setdefault("version", {})["protocol"] = client_protocol
+    
+    # Agregar icono si existe
+    if server_icon_base64:
+        status_response["favicon"] = server_icon_base64
+    
+    return status_response
+
+def description_text(description):
+    """Texto plano de un "description" de status (cadena o componente con "extra")"""
+    if isinstance(description, str):
+        return description
+    if not isinstance(description, dict):
+        return ''
+    return description.get("text", '') + ''.join(description_text(part) for part in description.get("extra", ()))
+
+def build_query_stats(status, host):
+    """Cuerpos de las respuestas basic y full stat del query a partir de un status.
+    Los nombres de jugadores son los de "sample" (el servidor real manda como mucho 12).
+    Como vanilla, las cadenas van en latin-1: lo que no cabe se cambia por '?'"""
+    def z(value):
+        return str(value).encode('latin-1', errors='replace') + b'\x00'
+    
+    players = status.get("players") or {}
+    motd = description_text(status.get("description", ''))
+    online = players.get("online", 0)
+    maximum = players.get("max", 0)
+    names = [player.get("name", '') for player in players.get("sample") or ()]
+    basic = (z(motd) + z('SMP') + z('world') + z(online) + z(maximum) + struct.pack('<H', PROXY_PORT)
+             + z(host))
+    fields = (('hostname', motd), ('gametype', 'SMP'), ('game_id', 'MINECRAFT'),
+              ('version', (status.get("version") or {}).get("name", '')), ('plugins', ''), ('map', 'world'),
+              ('numplayers', online), ('maxplayers', maximum), ('hostport', PROXY_PORT), ('hostip', host))
+    full = (b'splitnum\x00\x80\x00' + b''.join(z(key) + z(value) for key, value in fields) + b'\x00'
+            + b'\x01player_\x00\x00' + b''.join(z(name) for name in names) + b'\x00')
+    return basic, full
+
+def invalidate_status_cache():
+    """Descarta las respuestas de status pre-codificadas (p. ej. al cambiar el icono)"""
+    if router is not None:
+        for backend in router.backends:
+            backend.invalidate_status_cache()
+
+def handle_status_request(client_socket, server_online, client_protocol, reader=None, backend=None,
+                          trace=NULL_TRACE):
     """Maneja solicitudes de status (lista de servidores)"""
+    started = time.perf_counter()
+    if reader is None:
+        reader = PacketReader(client_socket)
+    if backend is None:
+        backend = router.default
     try:
         # Recibir el packet de status request (deberia estar vacio)
-        packet_id, packet_data = read_packet(client_socket)
+        packet_id, packet_data = reader.read_packet()
+        trace.mark('leer_status_request')
         if packet_id != 0x00 or packet_data is None:
             return False
         
-        # Seleccionar el MOTD apropiado segun el estado del servidor
-        if server_online:
-            # Obtener estado real del servidor con jugadores conectados
-            real_status = get_real_server_status()
-            if real_status:
-                status_response = real_status.copy()
-                # Mantener nuestro MOTD personalizado pero usar los datos reales de jugadores
-                status_response["description"] = FAKE_SERVER_STATUS_ONLINE["description"]
-            else:
-                status_response = FAKE_SERVER_STATUS_ONLINE.copy()
-        else:
-            status_response = FAKE_SERVER_STATUS_OFFLINE.copy()
-        
-        # Usar el protocol del cliente para evitar incompatibilidad
-        status_response["version"]["protocol"] = client_protocol
-        
-        # Agregar icono si existe
-        if server_icon_base64:
-            status_response["favicon"] = server_icon_base64
-        
-        # Enviar respuesta de status
-        if not send_status_response(client_socket, status_response):
-            return False
+        # Enviar respuesta de status (pre-codificada)
+        client_socket.sendall(backend.get_status_packet(server_online, client_protocol))
+        trace.mark('enviar_status')
+        STATUS_RESPONSE_SECONDS.observe(time.perf_counter() - started)
         
         # Esperar y responder al ping
-        packet_id, ping_data = read_packet(client_socket)
+        packet_id, ping_data = reader.read_packet()
         if packet_id == 0x01:
             send_ping_response(client_socket, ping_data)
+        trace.mark('ping')
         
         return True
     except Exception as e:
-        print(f"Error en handle_status_request: {e}")
+        log(WARNING, 'STATUS', "Error en handle_status_request: {}", e)
         return False
 
-def handle_client(client_socket):
-    """Maneja a un cliente, diferenciando entre ping y login"""
-    global is_waking_up
+# --- QUERY (GAMESPY4) ---
+
+QUERY_MAGIC = b'\xfe\xfd'
+QUERY_HANDSHAKE = 0x09
+QUERY_STAT = 0x00
+
+class QueryChallenge:
+    """Challenge tokens del query sin estado por cliente: el token es un hash de la IP con
+    un secreto que rota cada QUERY_TOKEN_ROTATION segundos. Se acepta el del secreto
+    actual y el del anterior, asi un token recien dado no caduca en el acto"""
     
-    try:
-        # Leer el primer paquete (handshake)
-        packet_id, packet_data = read_packet(client_socket)
-        if packet_id is None:
-            client_socket.close()
-            return
+    def __init__(self):
+        self.secrets = (os.urandom(16), os.urandom(16))
+        self.rotation = None
+    
+    def start(self):
+        """Programa las rotaciones en el planificador de plazos (sin hilo propio)"""
+        self.rotation = deadlines.schedule(QUERY_TOKEN_ROTATION, self.rotate)
+    
+    def rotate(self):
+        self.secrets = (os.urandom(16), self.secrets[0])
+        self.start()
+    
+    @staticmethod
+    def _token(secret, ip):
+        digest = hashlib.blake2s(ip.encode('ascii'), key=secret, digest_size=4).digest()
+        return int.from_bytes(digest, 'big') & 0x7FFFFFFF
+    
+    def token(self, ip):
+        return self._token(self.secrets[0], ip)
+    
+    def is_valid(self, ip, token):
+        return any(self._token(secret, ip) == token for secret in self.secrets)
+
+query_challenge = QueryChallenge()
+
+def handle_query(data, ip, local_host):
+    """Respuesta a un paquete del query, o None si hay que ignorarlo (como hace vanilla
+    con los paquetes invalidos o con un token caducado). local_host es la direccion por
+    la que llego el paquete: es el hostip que se anuncia si no hay QUERY_PUBLIC_HOST"""
+    if len(data) < 7 or data[:2] != QUERY_MAGIC:
+        QUERY_REQUESTS_TOTAL.inc(1, 'invalido')
+        return None
+    packet_type = data[2]
+    session = data[3:7]
+    if packet_type == QUERY_HANDSHAKE:
+        QUERY_REQUESTS_TOTAL.inc(1, 'handshake')
+        return bytes((QUERY_HANDSHAKE,)) + session + str(query_challenge.token(ip)).encode('ascii') + b'\x00'
+    if packet_type == QUERY_STAT and len(data) >= 11:
+        if not query_challenge.is_valid(ip, int.from_bytes(data[7:11], 'big')):
+            QUERY_REQUESTS_TOTAL.inc(1, 'token_invalido')
+            return None
+        basic, full = router.default.get_query_stats(QUERY_PUBLIC_HOST or local_host)
+        # La peticion full stat lleva 4 bytes de relleno detras del token
+        if len(data) >= 15:
+            QUERY_REQUESTS_TOTAL.inc(1, 'full')
+            return bytes((QUERY_STAT,)) + session + full
+        QUERY_REQUESTS_TOTAL.inc(1, 'basic')
+        return bytes((QUERY_STAT,)) + session + basic
+    QUERY_REQUESTS_TOTAL.inc(1, 'invalido')
+    return None
+
+# struct in_pktinfo de Linux: ipi_ifindex, ipi_spec_dst, ipi_addr. El modulo socket
+# no exporta IP_PKTINFO hasta Python 3.13
+IP_PKTINFO = getattr(socket, 'IP_PKTINFO', 8 if sys.platform.startswith('linux') else None)
+IN_PKTINFO = struct.Struct('=i4s4s')
+
+class QueryServer(socketserver.UDPServer):
+    """UDPServer que averigua la direccion local de cada datagrama (IP_PKTINFO): escuchando
+    en 0.0.0.0, getsockname() no dice por que interfaz llego el query"""
+    
+    def server_bind(self):
+        if IP_PKTINFO is not None:
+            self.socket.setsockopt(socket.IPPROTO_IP, IP_PKTINFO, 1)
+        super().server_bind()
+    
+    def get_request(self):
+        data, ancillary, _, client_address = self.socket.recvmsg(self.max_packet_size,
+                                                                 socket.CMSG_SPACE(IN_PKTINFO.size))
+        local_host = self.server_address[0]
+        for level, kind, value in ancillary:
+            if level == socket.IPPROTO_IP and kind == IP_PKTINFO:
+                # ipi_spec_dst: la direccion local de la interfaz (tambien si el query fue a broadcast)
+                local_host = socket.inet_ntoa(IN_PKTINFO.unpack_from(value)[1])
+        return (data, self.socket, local_host), client_address
+
+class QueryHandler(socketserver.BaseRequestHandler):
+    """Un datagrama del query UDP"""
+    
+    def handle(self):
+        data, sock, local_host = self.request
+        response = handle_query(data, self.client_address[0], local_host)
+        if response is not None:
+            sock.sendto(response, self.client_address)
+
+def start_query_server():
+    """Arranca el responder del query UDP en un hilo propio"""
+    if query_challenge.rotation is None:
+        query_challenge.start()
+    start_http_server(QueryHandler, QUERY_HOST, QUERY_PORT, "query-udp", QueryServer)
+    log(INFO, 'QUERY', "Query UDP en {}:{}", QUERY_HOST, QUERY_PORT)
+
+# --- DESPERTAR DEL SERVIDOR ---
+
+def send_magic_packet(mac, broadcast_addr=None, port=None):
+    """Envia el magic packet de Wake-on-LAN por UDP (sin ejecutar procesos externos)"""
+    mac_bytes = bytes.fromhex(mac.replace(':', '').replace('-', ''))
+    if len(mac_bytes) != 6:
+        raise ValueError(f"MAC invalida: {mac}")
+    packet = b'\xff' * 6 + mac_bytes * 16
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        sock.sendto(packet, (broadcast_addr or WAKE_BROADCAST_ADDR, port or WAKE_BROADCAST_PORT))
+
+class WakeController:
+    """Maquina de estados del despertar: dormido -> despertando -> listo.
+    Un hilo sondea el arranque con backoff y avisa a los logins retenidos"""
+    
+    SLEEPING = 'dormido'
+    WAKING = 'despertando'
+    READY = 'listo'
+    
+    def __init__(self, monitor, mac):
+        self.monitor = monitor
+        self.mac = mac
+        self.wake_started = None
+        self.packets_sent = 0
+        self._cond = threading.Condition()
+        self._waiters = []
+    
+    @property
+    def state(self):
+        if self.monitor.is_online():
+            return self.READY
+        if self.wake_started is not None:
+            return self.WAKING
+        return self.SLEEPING
+    
+    def is_ready(self):
+        return self.monitor.is_online()
+    
+    def request_wake(self, requested_by):
+        """Despierta el servidor si esta dormido. No bloquea"""
+        with self._cond:
+            if self.monitor.is_online():
+                return
+            if self.wake_started is not None:
+                log(INFO, 'WOL', "Servidor {} ya despertando (solicitado por {})", self.monitor.name, requested_by)
+                return
+            self.wake_started = time.monotonic()
+        self.publish()
         
-        # El handshake siempre es packet 0x00
-        if packet_id != 0x00:
+        log(INFO, 'WOL', "Servidor {} dormido - enviando Wake-on-LAN (solicitado por {})",
+            self.monitor.name, requested_by)
+        self._send()
+        threading.Thread(target=self._wait_for_boot, name=f"wake-poller-{self.monitor.name}", daemon=True).start()
+    
+    def publish(self):
+        """Refleja 'despertando' en la memoria compartida (modo multiproceso)"""
+        if self.monitor.shared is not None:
+            self.monitor.shared.set_waking(self.wake_started is not None)
+    
+    def _send(self):
+        try:
+            send_magic_packet(self.mac)
+            self.packets_sent += 1
+            WOL_SENT_TOTAL.inc(1, self.monitor.name)
+        except Exception as e:
+            log(ERROR, 'WOL', "Error enviando magic packet: {}", e)
+    
+    def _wait_for_boot(self):
+        """Sondea el servidor hasta que acepte conexiones o se agote WAKE_TIMEOUT"""
+        delay = WAKE_POLL_INTERVAL
+        last_send = time.monotonic()
+        while True:
+            if self.monitor.probe():
+                elapsed = time.monotonic() - self.wake_started
+                WAKE_READY_SECONDS.observe(elapsed, self.monitor.name)
+                log(INFO, 'WOL', "Servidor {} listo tras {:.1f}s", self.monitor.name, elapsed)
+                break
+            
+            now = time.monotonic()
+            if now - self.wake_started >= WAKE_TIMEOUT:
+                log(WARNING, 'WOL', "El servidor {} no respondio en {}s - vuelve a 'dormido'",
+                    self.monitor.name, WAKE_TIMEOUT)
+                break
+            if now - last_send >= WAKE_RESEND_INTERVAL:
+                self._send()
+                last_send = now
+            
+            time.sleep(delay)
+            delay = min(delay * 2, WAKE_POLL_MAX)
+        
+        with self._cond:
+            self.wake_started = None
+            self.publish()
+            self._cond.notify_all()
+            waiters = list(self._waiters)
+        for notify in waiters:
+            notify()
+    
+    def wait_ready(self, timeout):
+        """Bloquea hasta que el servidor este listo. Devuelve False si se agoto el tiempo
+        o el despertar fallo"""
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while not self.is_ready():
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or self.wake_started is None:
+                    return False
+                self._cond.wait(remaining)
+        return True
+    
+    async def wait_ready_async(self, timeout):
+        """Igual que wait_ready pero sin bloquear el event loop"""
+        if self.is_ready():
+            return True
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        
+        def notify():
+            loop.call_soon_threadsafe(lambda: future.done() or future.set_result(None))
+        
+        with self._cond:
+            if self.wake_started is None:
+                return self.is_ready()
+            self._waiters.append(notify)
+        try:
+            await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            with self._cond:
+                self._waiters.remove(notify)
+        return self.is_ready()
+
+# --- PREDESPERTAR ---
+# Historial: registros LOGIN_RECORD (epoch, longitud del jugador, longitud del servidor)
+# seguidos de los dos nombres en UTF-8
+
+LOGIN_RECORD = struct.Struct('>IBB')
+WEEKDAYS = ('lun', 'mar', 'mie', 'jue', 'vie', 'sab', 'dom')
+
+def encode_login_record(when, player, backend_name):
+    player = player.encode('utf-8')[:255]
+    backend_name = backend_name.encode('utf-8')[:255]
+    return LOGIN_RECORD.pack(int(when), len(player), len(backend_name)) + player + backend_name
+
+def record_login(player_name, backend):
+    """Anade un login al historial con una sola escritura O_APPEND (segura entre workers).
+    Cada escritura toma el flock del archivo, igual que PrewakeScheduler.load mientras
+    compacta; como la compactacion reemplaza el archivo, tras el lock se comprueba que el
+    descriptor sigue siendo el de la ruta"""
+    if not PREWAKE_ENABLED:
+        return
+    record = encode_login_record(time.time(), player_name, backend.name)
+    try:
+        while True:
+            fd = os.open(PREWAKE_HISTORY_PATH, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                if os.fstat(fd).st_ino != os.stat(PREWAKE_HISTORY_PATH).st_ino:
+                    # Compactado mientras se esperaba el lock: escribir en el nuevo
+                    continue
+                os.write(fd, record)
+                return
+            finally:
+                os.close(fd)
+    except OSError as e:
+        log(WARNING, 'PREDESPERTAR', "No se pudo guardar el login en {}: {}", PREWAKE_HISTORY_PATH, e)
+
+def read_login_history(path, offset=0):
+    """([(epoch, jugador, servidor)], offset siguiente) leyendo desde offset. Un registro
+    a medio escribir al final se deja para la siguiente lectura"""
+    try:
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            data = f.read()
+    except FileNotFoundError:
+        return [], offset
+    records = []
+    position = 0
+    while position + LOGIN_RECORD.size <= len(data):
+        when, player_length, name_length = LOGIN_RECORD.unpack_from(data, position)
+        start = position + LOGIN_RECORD.size
+        end = start + player_length + name_length
+        if end > len(data):
+            break
+        records.append((when, data[start:start + player_length].decode('utf-8', errors='replace'),
+                        data[start + player_length:end].decode('utf-8', errors='replace')))
+        position = end
+    return records, offset + position
+
+def slot_of(when):
+    """(franja de la semana, inicio de la franja en epoch, fecha local) de un instante"""
+    local = time.localtime(when)
+    minute = local.tm_hour * 60 + local.tm_min
+    slot = local.tm_wday * (24 * 60 // PREWAKE_SLOT_MINUTES) + minute // PREWAKE_SLOT_MINUTES
+    start = int(when) - (minute % PREWAKE_SLOT_MINUTES) * 60 - local.tm_sec
+    return slot, start, (local.tm_year, local.tm_yday)
+
+def format_slot(slot):
+    per_day = 24 * 60 // PREWAKE_SLOT_MINUTES
+    minute = (slot % per_day) * PREWAKE_SLOT_MINUTES
+    return f"{WEEKDAYS[slot // per_day]} {minute // 60:02d}:{minute % 60:02d}"
+
+class PrewakeWindow:
+    """Una franja prevista en curso y si hubo algun login en ella"""
+    
+    __slots__ = ('backend', 'slot', 'start', 'end', 'confidence', 'logins', 'woke')
+    
+    def __init__(self, backend, slot, start, confidence):
+        self.backend = backend
+        self.slot = slot
+        self.start = start
+        self.end = start + PREWAKE_SLOT_MINUTES * 60
+        self.confidence = confidence
+        self.logins = 0
+        self.woke = False
+
+class PrewakeScheduler:
+    """Lee el historial de logins (lo escriben este proceso o los workers), calcula por
+    servidor la confianza de cada franja de la semana y despierta antes de las previstas.
+    Corre solo en el proceso principal, que es el que envia los magic packets"""
+    
+    def __init__(self, path):
+        self.path = path
+        self.offset = 0
+        self.records = []
+        # servidor -> {franja: (confianza, jugadores habituales)}
+        self.predictions = {}
+        # (servidor, fecha, franja) -> PrewakeWindow
+        self.windows = {}
+        self.windows_total = 0
+        self.windows_hit = 0
+        self.logins = 0
+        self.logins_covered = 0
+        self.last_report = time.monotonic()
+    
+    def load(self):
+        """Lee el historial y lo compacta (sin los logins mas viejos que PREWAKE_HISTORY_DAYS).
+        Los workers ya pueden estar anadiendo logins: con el flock exclusivo ninguno escribe
+        entre la lectura y el os.replace, y los que esperan reabren el archivo nuevo"""
+        try:
+            history = open(self.path, 'rb')
+        except FileNotFoundError:
+            history = None
+        try:
+            if history is not None:
+                fcntl.flock(history, fcntl.LOCK_EX)
+            records, size = read_login_history(self.path)
+            self.records = [record for record in records if record[0] >= time.time() - PREWAKE_HISTORY_DAYS * 86400]
+            if len(self.records) < len(records):
+                temporary = self.path + '.tmp'
+                with open(temporary, 'wb') as f:
+                    f.write(b''.join(encode_login_record(*record) for record in self.records))
+                os.replace(temporary, self.path)
+                size = os.path.getsize(self.path)
+        finally:
+            # Cerrar suelta el lock
+            if history is not None:
+                history.close()
+        self.offset = size
+        self.rebuild()
+        log(INFO, 'PREDESPERTAR', "Historial {}: {} logins en los ultimos {} dias{}", self.path,
+            len(self.records), PREWAKE_HISTORY_DAYS, " (modo prueba)" if PREWAKE_DRY_RUN else "")
+        self.log_predictions()
+    
+    def rebuild(self):
+        """Confianza de cada franja: semanas con algun login en ella / semanas de historial"""
+        now = time.time()
+        self.records = [record for record in self.records if record[0] >= now - PREWAKE_HISTORY_DAYS * 86400]
+        if not self.records:
+            self.predictions = {}
+            return
+        span_days = min(PREWAKE_HISTORY_DAYS, (now - min(record[0] for record in self.records)) / 86400)
+        weeks = max(1, -(-span_days // 7))
+        dates = collections.defaultdict(set)
+        players = collections.defaultdict(collections.Counter)
+        for when, player, backend_name in self.records:
+            slot, _, date = slot_of(when)
+            dates[backend_name, slot].add(date)
+            players[backend_name, slot][player] += 1
+        predictions = collections.defaultdict(dict)
+        for (backend_name, slot), seen in dates.items():
+            confidence = min(1.0, len(seen) / weeks)
+            if confidence >= PREWAKE_CONFIDENCE:
+                usual = [player for player, _ in players[backend_name, slot].most_common(3)]
+                predictions[backend_name][slot] = (confidence, usual)
+        self.predictions = dict(predictions)
+    
+    def log_predictions(self):
+        for backend in router.backends:
+            slots = self.predictions.get(backend.name, {})
+            if not slots:
+                log(INFO, 'PREDESPERTAR', "{}: ninguna franja supera el {:.0%} de confianza", backend.name,
+                    PREWAKE_CONFIDENCE)
+                continue
+            summary = ", ".join(f"{format_slot(slot)} ({confidence:.0%}: {' '.join(usual)})"
+                                for slot, (confidence, usual) in sorted(slots.items()))
+            log(INFO, 'PREDESPERTAR', "{}: franjas previstas {}", backend.name, summary)
+    
+    def refresh(self):
+        """Incorpora los logins nuevos del historial y los cuenta contra las franjas abiertas"""
+        records, self.offset = read_login_history(self.path, self.offset)
+        if not records:
+            return
+        for when, player, backend_name in records:
+            self.logins += 1
+            covered = False
+            for window in self.windows.values():
+                if (window.backend.name == backend_name
+                        and window.start - PREWAKE_LEAD_TIME <= when < window.end):
+                    window.logins += 1
+                    covered = True
+            if covered:
+                self.logins_covered += 1
+        self.records.extend(records)
+        self.rebuild()
+    
+    def tick(self, now=None):
+        now = now if now is not None else time.time()
+        self.refresh()
+        
+        for backend in router.backends:
+            slots = self.predictions.get(backend.name, {})
+            # La franja actual y la que empieza dentro de PREWAKE_LEAD_TIME
+            for when in (now, now + PREWAKE_LEAD_TIME):
+                slot, start, date = slot_of(when)
+                key = (backend.name, date, slot)
+                if slot not in slots or key in self.windows:
+                    continue
+                window = self.windows[key] = PrewakeWindow(backend, slot, start, slots[slot][0])
+                self.windows_total += 1
+                log(INFO, 'PREDESPERTAR', "{}: franja prevista {} ({:.0%}){}", backend.name, format_slot(slot),
+                    window.confidence, " - modo prueba, sin despertar" if PREWAKE_DRY_RUN else "")
+            
+            for window in self.windows.values():
+                if window.backend is not backend or PREWAKE_DRY_RUN or now >= window.end:
+                    continue
+                backend.keep_awake_until = max(backend.keep_awake_until, window.end)
+                if not window.woke:
+                    window.woke = True
+                    backend.wake.request_wake(f"prediccion {format_slot(window.slot)}")
+        
+        for key, window in list(self.windows.items()):
+            if now >= window.end:
+                del self.windows[key]
+                result = 'acierto' if window.logins else 'fallo'
+                if window.logins:
+                    self.windows_hit += 1
+                PREWAKE_WINDOWS_TOTAL.inc(1, window.backend.name, result)
+                log(INFO, 'PREDESPERTAR', "{}: franja {} terminada - {} ({} logins)", window.backend.name,
+                    format_slot(window.slot), result, window.logins)
+        
+        if PREWAKE_REPORT_INTERVAL and time.monotonic() - self.last_report >= PREWAKE_REPORT_INTERVAL:
+            self.last_report = time.monotonic()
+            self.report()
+    
+    def report(self):
+        """Predicciones frente a logins reales desde el arranque"""
+        log(INFO, 'PREDESPERTAR', "Informe: {} franjas previstas, {} con login; {} logins, {} dentro de una "
+            "franja prevista (los demas esperaron el arranque completo)", self.windows_total,
+            self.windows_hit, self.logins, self.logins_covered)
+        self.log_predictions()
+    
+    def run(self):
+        while not draining.is_set():
+            try:
+                self.tick()
+            except Exception as e:
+                log(ERROR, 'PREDESPERTAR', "Error en el predespertar: {}", e)
+            # Comprobar al menos una vez por minuto (y varias veces por franja)
+            time.sleep(min(60, PREWAKE_SLOT_MINUTES * 60 / 4))
+
+prewake = None
+
+def start_prewake():
+    global prewake
+    prewake = PrewakeScheduler(PREWAKE_HISTORY_PATH)
+    try:
+        prewake.load()
+    except OSError as e:
+        log(ERROR, 'PREDESPERTAR', "No se pudo leer el historial {}: {}", PREWAKE_HISTORY_PATH, e)
+    threading.Thread(target=prewake.run, name="prewake", daemon=True).start()
+
+# --- SERVIDORES Y ENRUTADO ---
+
+def status_with_motd(template, motd):
+    """Copia de una plantilla de status con otro texto de MOTD"""
+    status = copy.deepcopy(template)
+    if motd is not None:
+        status["description"] = {"text": motd}
+    return status
+
+class Backend:
+    """Un servidor real detras del proxy, con su sondeo, su despertar y su cache de status"""
+    
+    def __init__(self, name, host, port, mac, hostnames=(), motd_online=None, motd_offline=None,
+                 whitelist_path=None, socket_profile=None):
+        self.name = name
+        self.host = host
+        self.port = port
+        self.whitelist_path = None
+        self.whitelist = None
+        self.started = False
+        self.monitor = BackendMonitor(host, port, name)
+        self.wake = WakeController(self.monitor, mac)
+        self.status_cache = {}
+        self.status_cache_version = None
+        self.query_cache = None
+        # Ultima actividad de los tuneles ya cerrados (al arrancar, la hora de arranque)
+        self.last_activity = time.time()
+        # Hasta cuando (epoch) hay que mantenerlo despierto por una franja prevista
+        self.keep_awake_until = 0
+        self.configure(mac, hostnames, motd_online, motd_offline, whitelist_path, socket_profile)
+    
+    def configure(self, mac, hostnames=(), motd_online=None, motd_offline=None, whitelist_path=None,
+                  socket_profile=None):
+        """Lo que se puede cambiar en caliente (SIGHUP): MAC, hostnames, MOTDs, whitelist y
+        perfil de sockets de los tuneles nuevos"""
+        self.mac = mac
+        self.socket_profile = socket_profile
+        self.wake.mac = mac
+        self.hostnames = list(hostnames)
+        self.status_online = status_with_motd(FAKE_SERVER_STATUS_ONLINE, motd_online)
+        self.status_offline = status_with_motd(FAKE_SERVER_STATUS_OFFLINE, motd_offline)
+        if whitelist_path and whitelist_path == self.whitelist_path:
+            self.whitelist.load()
+        else:
+            if self.whitelist is not None:
+                self.whitelist.stop()
+            self.whitelist = None
+            if whitelist_path:
+                self.whitelist = Whitelist(whitelist_path)
+                self.whitelist.load(initial=True)
+                # Al crear el Backend el vigilante espera a start()
+                if self.started:
+                    self.whitelist.start()
+        self.whitelist_path = whitelist_path
+        self.invalidate_status_cache()
+    
+    def start(self):
+        """Arranca el sondeo y el vigilante de su whitelist"""
+        self.started = True
+        self.monitor.start()
+        if self.whitelist is not None:
+            self.whitelist.start()
+    
+    def is_player_whitelisted(self, player_name, player_uuid=None):
+        if self.whitelist is not None:
+            return self.whitelist.is_allowed(player_name, player_uuid)
+        return is_player_whitelisted(player_name, player_uuid)
+    
+    def invalidate_status_cache(self):
+        self.status_cache = {}
+        self.query_cache = None
+    
+    def tunnel_closed(self, last_activity):
+        self.last_activity = max(self.last_activity, last_activity)
+    
+    def local_idle_state(self):
+        """(tuneles abiertos, epoch de la ultima actividad) en este proceso"""
+        tunnels = [tunnel for tunnel in list(active_tunnels) if tunnel.backend is self]
+        last_activity = max([self.last_activity] + [tunnel.last_activity for tunnel in tunnels])
+        return len(tunnels), last_activity
+    
+    def idle_state(self):
+        """Como local_idle_state, sumando lo que publican los workers en modo multiproceso"""
+        active, last_activity = self.local_idle_state()
+        if self.monitor.shared is not None:
+            for worker_active, worker_last_activity in self.monitor.shared.read_idle():
+                active += worker_active
+                last_activity = max(last_activity, worker_last_activity)
+        # Tuneles que sigue reenviando el proceso anterior a una actualizacion
+        peer = peer_idle.get(self.name)
+        if peer is not None:
+            active += peer[0]
+            last_activity = max(last_activity, peer[1])
+        return active, last_activity
+    
+    def get_status_packet(self, server_online, client_protocol):
+        """Devuelve el paquete de status completo (longitud + ID + JSON) listo para enviar.
+        Solo se reconstruye cuando cambia el estado del servidor, el icono o el protocolo"""
+        _, real_status, version = self.monitor.snapshot()
+        if not server_online:
+            real_status = None
+        
+        # Un nuevo estado del servidor invalida todo lo anterior
+        if version != self.status_cache_version:
+            self.status_cache = {}
+            self.status_cache_version = version
+        
+        cache = self.status_cache
+        key = (client_protocol, server_online, real_status is not None)
+        packet = cache.get(key)
+        if packet is None:
+            status_response = build_status_response(server_online, client_protocol, real_status, self)
+            packet = encode_packet(0x00, encode_json_string(status_response))
+            if len(cache) >= STATUS_CACHE_MAX_ENTRIES:
+                cache.clear()
+            cache[key] = packet
+        return packet
+    
+    def get_query_stats(self, host):
+        """(basic, full) del query UDP, sin cabecera. Se reconstruyen, como el status, solo
+        cuando cambia el estado del servidor, la configuracion o el hostip anunciado"""
+        online, real_status, version = self.monitor.snapshot()
+        key = (version, online, real_status is not None, host)
+        cache = self.query_cache
+        if cache is None or cache[0] != key:
+            status = build_status_response(online, 0, real_status if online else None, self)
+            cache = self.query_cache = (key,) + build_query_stats(status, host)
+        return cache[1], cache[2]
+
+def normalize_hostname(server_addr):
+    """Hostname del handshake en forma canonica: sin marcas de Forge ("\\0FML\\0"),
+    sin punto final y en minusculas"""
+    return server_addr.split('\0', 1)[0].rstrip('.').lower()
+
+class BackendRouter:
+    """Tabla hostname -> Backend precalculada: diccionario de nombres exactos y
+    diccionario de sufijos para los comodines "*.dominio" """
+    
+    def __init__(self, backends, default=None):
+        self.backends = list(backends)
+        self.default = default or self.backends[0]
+        self.exact = {}
+        self.wildcard = {}
+        for backend in self.backends:
+            for hostname in backend.hostnames:
+                hostname = normalize_hostname(hostname)
+                if hostname.startswith('*.'):
+                    self.wildcard[hostname[2:]] = backend
+                else:
+                    self.exact[hostname] = backend
+    
+    def route(self, server_addr):
+        """Backend para el hostname del handshake (el mas especifico gana)"""
+        hostname = normalize_hostname(server_addr)
+        backend = self.exact.get(hostname)
+        if backend is not None:
+            return backend
+        if self.wildcard:
+            dot = hostname.find('.')
+            while dot != -1:
+                backend = self.wildcard.get(hostname[dot + 1:])
+                if backend is not None:
+                    return backend
+                dot = hostname.find('.', dot + 1)
+        return self.default
+
+def backend_settings():
+    """(nombre, host, puerto, opciones de Backend.configure) de cada servidor segun
+    BACKENDS (o SERVER_HOST/SERVER_PORT/SERVER_MAC)"""
+    if BACKENDS:
+        return [(entry.get("name") or entry["host"], entry["host"], entry.get("port", 25565),
+                 dict(mac=entry.get("mac"), hostnames=entry.get("hostnames", ()),
+                      motd_online=entry.get("motd_online"), motd_offline=entry.get("motd_offline"),
+                      whitelist_path=entry.get("whitelist"), socket_profile=entry.get("socket_profile")))
+                for entry in BACKENDS]
+    return [("principal", SERVER_HOST, SERVER_PORT, dict(mac=SERVER_MAC))]
+
+def routing_table(backends):
+    """BackendRouter con DEFAULT_BACKEND (o el primero) como servidor por defecto"""
+    default = None
+    if DEFAULT_BACKEND is not None:
+        default = next((backend for backend in backends if backend.name == DEFAULT_BACKEND), None)
+        if default is None:
+            log(WARNING, 'PROXY', "DEFAULT_BACKEND '{}' no existe - usando '{}'", DEFAULT_BACKEND, backends[0].name)
+    return BackendRouter(backends, default)
+
+def build_router():
+    """Crea los Backend y la tabla de enrutado"""
+    return routing_table([Backend(name, host, port, **options) for name, host, port, options in backend_settings()])
+
+def update_backends():
+    """Aplica BACKENDS a los servidores en marcha y reemplaza la tabla de enrutado.
+    Anadir, quitar o mover (host/puerto) un servidor necesita una actualizacion (SIGUSR2)"""
+    global router
+    current = {backend.name: backend for backend in router.backends}
+    settings = backend_settings()
+    if [name for name, _, _, _ in settings] != list(current):
+        log(WARNING, 'CONFIG', "Cambios en la lista de servidores - se aplican con kill -USR2")
+    for name, host, port, options in settings:
+        backend = current.get(name)
+        if backend is None:
+            continue
+        if (host, port) != (backend.host, backend.port):
+            log(WARNING, 'CONFIG', "Nueva direccion de {} ({}:{}) - se aplica con kill -USR2", name, host, port)
+            continue
+        backend.configure(**options)
+    router = routing_table(router.backends)
+
+# --- ADMISION DE CONEXIONES ---
+
+class AdmissionTicket:
+    """Plaza de handshake concedida a una conexion. release() se puede llamar varias veces"""
+    
+    def __init__(self, control):
+        self._control = control
+    
+    def release(self):
+        control, self._control = self._control, None
+        if control is not None:
+            control.release_handshake()
+
+class AdmissionControl:
+    """Decide en el accept si una conexion entra, antes de crear hilos o sondear el servidor.
+    - token bucket por IP de origen
+    - limite global de handshakes simultaneos
+    Los rechazos se cuentan por motivo para poder ajustar los limites"""
+    
+    def __init__(self, rate=None, burst=None, max_handshakes=None, share=1):
+        # share: procesos entre los que se reparten los limites globales (workers)
+        self.share = share
+        self.configure()
+        self.rate = rate if rate is not None else self.rate
+        self.burst = burst if burst is not None else self.burst
+        self.max_handshakes = max_handshakes if max_handshakes is not None else self.max_handshakes
+        self.active_handshakes = 0
+        self.accepted = 0
+        self.rejected = collections.Counter()
+        self._buckets = {}
+        self._lock = threading.Lock()
+        self._last_prune = time.monotonic()
+        self._last_report = self._last_prune
+    
+    def configure(self):
+        """Toma los limites de la configuracion actual (al crearlo y en cada recarga)"""
+        self.rate = ADMISSION_RATE_PER_IP / self.share
+        self.burst = max(1, ADMISSION_BURST_PER_IP // self.share)
+        self.max_handshakes = max(1, MAX_CONCURRENT_HANDSHAKES // self.share)
+    
+    def admit(self, ip):
+        """Devuelve un AdmissionTicket o None si la conexion debe rechazarse"""
+        now = time.monotonic()
+        with self._lock:
+            self._housekeeping(now)
+            
+            tokens, last = self._buckets.get(ip, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - last) * self.rate)
+            if tokens < 1:
+                self._buckets[ip] = (tokens, now)
+                self.rejected['rate_ip'] += 1
+                ADMISSION_REJECTS_TOTAL.inc(1, 'rate_ip')
+                return None
+            
+            if self.active_handshakes >= self.max_handshakes:
+                self._buckets[ip] = (tokens, now)
+                self.rejected['max_handshakes'] += 1
+                ADMISSION_REJECTS_TOTAL.inc(1, 'max_handshakes')
+                return None
+            
+            self._buckets[ip] = (tokens - 1, now)
+            self.active_handshakes += 1
+            self.accepted += 1
+        return AdmissionTicket(self)
+    
+    def release_handshake(self):
+        with self._lock:
+            self.active_handshakes -= 1
+    
+    def reject(self, reason):
+        """Cuenta un rechazo decidido despues de admit() (p. ej. con la cola de handlers llena)"""
+        with self._lock:
+            self.rejected[reason] += 1
+        ADMISSION_REJECTS_TOTAL.inc(1, reason)
+    
+    def _housekeeping(self, now):
+        """Descarta buckets ya llenos (para que el diccionario no crezca con cada IP vista)
+        y cada tanto imprime el resumen de rechazos"""
+        if now - self._last_prune < 60:
+            return
+        self._last_prune = now
+        full_after = self.burst / self.rate if self.rate > 0 else float('inf')
+        for ip, (tokens, last) in list(self._buckets.items()):
+            if now - last >= full_after:
+                del self._buckets[ip]
+        
+        if ADMISSION_REPORT_INTERVAL and now - self._last_report >= ADMISSION_REPORT_INTERVAL:
+            self._last_report = now
+            if self.rejected:
+                summary = ", ".join(f"{reason}={count}" for reason, count in sorted(self.rejected.items()))
+                log(INFO, 'ADMISION', "Aceptadas {}, rechazadas: {}", self.accepted, summary)
+
+# --- PLAZOS ---
+
+class Deadline:
+    """Plazo programado en el DeadlineScheduler. cancel() es O(1): la entrada se
+    descarta cuando llega a la cima del heap"""
+    
+    __slots__ = ('when', 'expire', 'cancelled')
+    
+    def __init__(self, when, expire):
+        self.when = when
+        self.expire = expire
+        self.cancelled = False
+    
+    def cancel(self):
+        self.cancelled = True
+
+class DeadlineScheduler:
+    """Un heap de plazos y un solo hilo que los vence, para todas las conexiones de los
+    dos motores (en vez de un timeout por socket o un hilo por temporizador).
+    expire() se llama en el hilo del planificador y debe ser rapido: cortar un socket"""
+    
+    def __init__(self):
+        self._heap = []
+        self._sequence = itertools.count()
+        self._cond = threading.Condition(threading.Lock())
+        self._started = False
+    
+    def schedule(self, delay, expire):
+        """Programa expire() dentro de delay segundos. Devuelve el Deadline para cancelarlo"""
+        deadline = Deadline(time.monotonic() + delay, expire)
+        with self._cond:
+            if not self._started:
+                self._started = True
+                threading.Thread(target=self._run, name="deadlines", daemon=True).start()
+            heapq.heappush(self._heap, (deadline.when, next(self._sequence), deadline))
+            # Solo hay que despertar al hilo si el nuevo plazo es el mas proximo
+            if self._heap[0][2] is deadline:
+                self._cond.notify()
+        return deadline
+    
+    def pending(self):
+        return len(self._heap)
+    
+    def _next_expired(self):
+        with self._cond:
+            heap = self._heap
+            while True:
+                while heap and heap[0][2].cancelled:
+                    heapq.heappop(heap)
+                if not heap:
+                    self._cond.wait()
+                    continue
+                delay = heap[0][0] - time.monotonic()
+                if delay <= 0:
+                    return heapq.heappop(heap)[2]
+                self._cond.wait(delay)
+    
+    def _run(self):
+        while True:
+            deadline = self._next_expired()
+            try:
+                deadline.expire()
+            except Exception as e:
+                log(ERROR, 'ERROR', "Error venciendo un plazo: {}", e)
+
+deadlines = DeadlineScheduler()
+
+class ConnectionDeadline:
+    """Plazo de la fase actual de una conexion: cada fase reemplaza al de la anterior.
+    Al vencer llama a close() (cortar el socket) y cuenta la fase en las metricas"""
+    
+    __slots__ = ('close', 'phase', 'deadline')
+    
+    def __init__(self, close):
+        self.close = close
+        self.phase = None
+        self.deadline = None
+    
+    def start(self, phase, seconds):
+        self.cancel()
+        self.phase = phase
+        self.deadline = deadlines.schedule(seconds, self._expire)
+    
+    def cancel(self):
+        if self.deadline is not None:
+            self.deadline.cancel()
+            self.deadline = None
+    
+    def _expire(self):
+        DEADLINES_EXPIRED_TOTAL.inc(1, self.phase)
+        log(DEBUG, 'PLAZO', "Plazo de {} vencido - cerrando conexion", self.phase)
+        self.close()
+
+def expire_idle_tunnel(stats, sockets):
+    """Plazo de inactividad de un tunel. El trafico no lo reprograma (seria un push al heap
+    por cada bloque): al vencer se mira la ultima actividad y se reprograma lo que falte"""
+    remaining = TUNNEL_IDLE_TIMEOUT - (time.time() - stats.last_activity)
+    if remaining > 0:
+        stats.idle_deadline = deadlines.schedule(remaining, lambda: expire_idle_tunnel(stats, sockets))
+        return
+    DEADLINES_EXPIRED_TOTAL.inc(1, 'tunel_inactivo')
+    log(INFO, 'TUNEL', "{} sin trafico durante {}s - cerrando tunel", stats.name, TUNNEL_IDLE_TIMEOUT)
+    for sock in sockets:
+        shutdown_socket(sock)
+
+# --- CAPTURA ---
+# Formato: CAPTURE_MAGIC y despues registros CAPTURE_RECORD (instante time.time(), sesion,
+# tipo, longitud) seguidos de sus datos. Una sesion empieza con CAPTURE_OPEN (JSON con
+# tipo, jugador y servidor), sigue con los bytes de cada direccion y acaba con CAPTURE_CLOSE
+
+CAPTURE_MAGIC = b'MCPCAP\x00\x01'
+CAPTURE_RECORD = struct.Struct('>dIBI')
+CAPTURE_OPEN, CAPTURE_CLIENT, CAPTURE_SERVER, CAPTURE_CLOSE = range(4)
+
+class CaptureWriter:
+    """Archivo de captura de un proceso, compartido por todas sus sesiones. Los registros
+    se acumulan en un buffer de CAPTURE_BUFFER_SIZE: grabar un bloque del tunel es una
+    copia en memoria bajo un lock, y el write() al disco llega cada megabyte"""
+    
+    def __init__(self, path):
+        self.path = path
+        self.pid = os.getpid()
+        self.full = False
+        self._sessions = itertools.count(1)
+        self._lock = threading.Lock()
+        self._last_flush = time.monotonic()
+        self._file = open(path, 'ab', buffering=CAPTURE_BUFFER_SIZE)
+        if self._file.tell() == 0:
+            self._file.write(CAPTURE_MAGIC)
+        self.size = self._file.tell()
+    
+    def session(self, kind, name, backend):
+        session = CaptureSession(self, next(self._sessions))
+        info = {"kind": kind, "name": name, "backend": backend.name if backend is not None else None}
+        self.write(session.number, CAPTURE_OPEN, json.dumps(info).encode('utf-8'))
+        return session
+    
+    def write(self, session, record_type, data=b''):
+        with self._lock:
+            if self.full:
+                return
+            if self.size + CAPTURE_RECORD.size + len(data) > CAPTURE_MAX_BYTES:
+                self.full = True
+                log(WARNING, 'CAPTURA', "{} llego a {} bytes - captura detenida", self.path, CAPTURE_MAX_BYTES)
+                return
+            self._file.write(CAPTURE_RECORD.pack(time.time(), session, record_type, len(data)))
+            self._file.write(data)
+            self.size += CAPTURE_RECORD.size + len(data)
+            # Con poco trafico el buffer tardaria en llenarse: al cerrar sesiones se vuelca
+            # como mucho una vez por segundo para no perder la captura si el proceso muere
+            if record_type == CAPTURE_CLOSE and time.monotonic() - self._last_flush >= 1:
+                self._flush()
+    
+    def flush(self):
+        with self._lock:
+            self._flush()
+    
+    def _flush(self):
+        self._last_flush = time.monotonic()
+        try:
+            self._file.flush()
+        except OSError as e:
+            log(ERROR, 'CAPTURA', "Error escribiendo {}: {}", self.path, e)
+
+class CaptureSession:
+    """Una conexion dentro del archivo de captura"""
+    
+    __slots__ = ('writer', 'number')
+    
+    def __init__(self, writer, number):
+        self.writer = writer
+        self.number = number
+    
+    def record(self, direction, data):
+        self.writer.write(self.number, CAPTURE_CLIENT if direction == "client->server" else CAPTURE_SERVER, data)
+    
+    def close(self):
+        self.writer.write(self.number, CAPTURE_CLOSE)
+
+capture_writer = None
+capture_lock = threading.Lock()
+
+def capture_session(kind, name, backend, handshake, login=None):
+    """Abre una sesion en la captura de este proceso y graba lo que envio el cliente
+    hasta ahora (handshake y Login Start). None si la captura esta desactivada"""
+    global capture_writer
+    if not CAPTURE_ENABLED:
+        return None
+    with capture_lock:
+        # Tras un fork el archivo del padre no sirve: cada worker abre el suyo
+        if capture_writer is None or capture_writer.pid != os.getpid():
+            path = os.path.join(CAPTURE_DIR, f"{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}.mcap")
+            try:
+                os.makedirs(CAPTURE_DIR, exist_ok=True)
+                capture_writer = CaptureWriter(path)
+            except OSError as e:
+                log(ERROR, 'CAPTURA', "No se pudo abrir {}: {}", path, e)
+                return None
+            log(INFO, 'CAPTURA', "Grabando sesiones en {}", path)
+    session = capture_writer.session(kind, name, backend)
+    data = encode_packet(0x00, handshake)
+    if login is not None:
+        data += encode_packet(0x00, login)
+    session.record("client->server", data)
+    return session
+
+def flush_capture():
+    if capture_writer is not None and capture_writer.pid == os.getpid():
+        capture_writer.flush()
+
+atexit.register(flush_capture)
+
+# --- TUNELES ---
+
+class TunnelStats:
+    """Contadores de bytes de un tunel cliente <-> servidor"""
+    
+    __slots__ = ('name', 'engine', 'backend', 'started', 'last_activity', 'client_to_server',
+                 'server_to_client', '_open_directions', '_lock', 'idle_deadline', 'capture', 'profile',
+                 'sockets', 'buffers')
+    
+    def __init__(self, name, engine, backend=None, capture=None):
+        self.name = name
+        self.engine = engine
+        self.backend = backend
+        self.started = time.monotonic()
+        self.last_activity = time.time()
+        self.client_to_server = 0
+        self.server_to_client = 0
+        self._open_directions = 2
+        self._lock = threading.Lock()
+        self.idle_deadline = None
+        self.capture = capture
+        self.profile = None
+        self.sockets = ()
+        # Bytes de los buffers de copia de las dos direcciones
+        self.buffers = 0
+        active_tunnels.add(self)
+        TUNNELS_TOTAL.inc()
+    
+    def tune(self, client_socket, server_socket):
+        """Aplica el perfil de sockets del servidor (o TUNNEL_SOCKET_PROFILE) a los dos lados"""
+        self.profile = (self.backend.socket_profile if self.backend is not None else None) or TUNNEL_SOCKET_PROFILE
+        self.sockets = (client_socket, server_socket)
+        profile = socket_profile(self.profile)
+        tune_socket(client_socket, profile)
+        tune_socket(server_socket, profile)
+    
+    def watch_idle(self, *sockets):
+        """Cierra los sockets del tunel tras TUNNEL_IDLE_TIMEOUT sin trafico"""
+        if TUNNEL_IDLE_TIMEOUT:
+            self.idle_deadline = deadlines.schedule(TUNNEL_IDLE_TIMEOUT, lambda: expire_idle_tunnel(self, sockets))
+    
+    def add(self, direction, count):
+        self.last_activity = time.time()
+        if direction == "client->server":
+            self.client_to_server += count
+        else:
+            self.server_to_client += count
+    
+    def hold(self, delta):
+        """Anota un buffer de copia creado (o cambiado de tamano) por una direccion"""
+        with self._lock:
+            self.buffers += delta
+    
+    def memory(self):
+        """Bytes que ocupa el tunel en el heap de Python: el objeto, su nombre y lock,
+        los sockets y los buffers de copia"""
+        return (sys.getsizeof(self) + sys.getsizeof(self.name) + sys.getsizeof(self._lock)
+                + sum(sys.getsizeof(sock) for sock in self.sockets) + self.buffers)
+    
+    def close_direction(self):
+        """Marca una direccion como terminada. Devuelve True si era la ultima"""
+        with self._lock:
+            self._open_directions -= 1
+            return self._open_directions == 0
+    
+    def report(self):
+        """Cierra el registro del tunel e imprime el resumen. Se llama con los sockets
+        todavia abiertos para leer su TCP_INFO"""
+        active_tunnels.discard(self)
+        if self.idle_deadline is not None:
+            self.idle_deadline.cancel()
+        if self.capture is not None:
+            self.capture.close()
+        if self.backend is not None:
+            self.backend.tunnel_closed(self.last_activity)
+        elapsed = max(time.monotonic() - self.started, 1e-6)
+        total = self.client_to_server + self.server_to_client
+        TUNNEL_BYTES.observe(total)
+        BYTES_FORWARDED_TOTAL.inc(self.client_to_server, 'client->server')
+        BYTES_FORWARDED_TOTAL.inc(self.server_to_client, 'server->client')
+        rtts = []
+        if self.profile is not None:
+            TUNNEL_THROUGHPUT.observe(total / elapsed, self.profile)
+            for side, sock in zip(('cliente', 'servidor'), self.sockets):
+                info = tcp_info(sock)
+                if info is None:
+                    continue
+                rtt, retransmits = info
+                TUNNEL_RTT_SECONDS.observe(rtt, self.profile, side)
+                TUNNEL_RETRANSMITS_TOTAL.inc(retransmits, self.profile, side)
+                rtts.append(f"rtt {side} {rtt * 1000:.1f} ms")
+        backend_name = self.backend.name if self.backend is not None else '-'
+        log(INFO, 'TUNEL', "{}@{} cerrado ({}, perfil {}): {} bytes cliente->servidor, {} bytes servidor->cliente "
+            "en {:.1f}s ({:.3f} MB/s{})", self.name, backend_name, self.engine, self.profile or '-',
+            self.client_to_server, self.server_to_client, elapsed, total / elapsed / 1e6,
+            "".join(", " + rtt for rtt in rtts))
+
+def splice_supported():
+    """Indica si podemos usar os.splice para los tuneles"""
+    return TUNNEL_SPLICE and hasattr(os, 'splice')
+
+def tunnel_engine(capture):
+    """Copia de un tunel nuevo: con splice los bytes no pasan por Python y no se pueden grabar"""
+    return "splice" if splice_supported() and capture is None else "copy"
+
+# Opciones de TCP que no existen en todas las plataformas
+TCP_KEEPALIVE_OPTIONS = tuple(getattr(socket, name, None) for name in ('TCP_KEEPIDLE', 'TCP_KEEPINTVL', 'TCP_KEEPCNT'))
+# struct tcp_info de Linux: tcpi_rtt (microsegundos) y tcpi_total_retrans
+TCP_INFO_SIZE = 104
+TCP_INFO_RTT_OFFSET = 68
+TCP_INFO_RETRANS_OFFSET = 100
+
+def socket_profile(name):
+    """Opciones del perfil de TUNNEL_SOCKET_PROFILES ({} si no existe)"""
+    profile = TUNNEL_SOCKET_PROFILES.get(name)
+    if profile is None:
+        if log_sampled('perfil_desconocido'):
+            log(WARNING, 'TUNEL', "Perfil de sockets '{}' no definido - opciones del sistema", name)
+        return {}
+    return profile
+
+def tune_socket(sock, profile):
+    """Aplica las opciones de un perfil a un socket. Una opcion que el sistema no
+    admite se ignora (el tunel funciona igual, solo sin ese ajuste)"""
+    options = []
+    if 'nodelay' in profile:
+        options.append((socket.IPPROTO_TCP, socket.TCP_NODELAY, int(bool(profile['nodelay']))))
+    if profile.get('rcvbuf'):
+        options.append((socket.SOL_SOCKET, socket.SO_RCVBUF, profile['rcvbuf']))
+    if profile.get('sndbuf'):
+        options.append((socket.SOL_SOCKET, socket.SO_SNDBUF, profile['sndbuf']))
+    if profile.get('keepalive'):
+        options.append((socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1))
+        for option, value in zip(TCP_KEEPALIVE_OPTIONS, profile['keepalive']):
+            if option is not None:
+                options.append((socket.IPPROTO_TCP, option, value))
+    if profile.get('user_timeout') and hasattr(socket, 'TCP_USER_TIMEOUT'):
+        options.append((socket.IPPROTO_TCP, socket.TCP_USER_TIMEOUT, profile['user_timeout']))
+    for level, option, value in options:
+        try:
+            sock.setsockopt(level, option, value)
+        except OSError as e:
+            log(DEBUG, 'TUNEL', "Opcion de socket {} no aplicada: {}", option, e)
+
+def tcp_info(sock):
+    """(RTT en segundos, retransmisiones) segun TCP_INFO, o None si no esta disponible"""
+    if not hasattr(socket, 'TCP_INFO'):
+        return None
+    try:
+        data = sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_INFO, TCP_INFO_SIZE)
+    except OSError:
+        return None
+    if len(data) < TCP_INFO_SIZE:
+        return None
+    rtt, = struct.unpack_from('=I', data, TCP_INFO_RTT_OFFSET)
+    retransmits, = struct.unpack_from('=I', data, TCP_INFO_RETRANS_OFFSET)
+    return rtt / 1e6, retransmits
+
+class ReadSize:
+    """Tamano de lectura adaptativo del bucle de copia: se duplica cuando una lectura
+    llena el buffer (rafaga de chunks: menos llamadas al sistema) y se reduce a la mitad
+    tras muchas lecturas pequenas seguidas (juego normal: menos memoria por tunel)"""
+    
+    __slots__ = ('size', 'minimum', 'maximum', 'small')
+    
+    SHRINK_AFTER = 64
+    
+    def __init__(self, profile_name):
+        profile = socket_profile(profile_name) if profile_name is not None else {}
+        self.minimum = profile.get('read_min', TUNNEL_CHUNK_SIZE)
+        self.maximum = max(self.minimum, profile.get('read_max', TUNNEL_CHUNK_SIZE))
+        self.size = self.minimum
+        self.small = 0
+    
+    def update(self, count):
+        """Cuenta una lectura de count bytes. True si el tamano cambio"""
+        if count == self.size and self.size < self.maximum:
+            self.size = min(self.size * 2, self.maximum)
+            self.small = 0
+            return True
+        if count <= self.size // 4 and self.size > self.minimum:
+            self.small += 1
+            if self.small >= self.SHRINK_AFTER:
+                self.size = max(self.size // 2, self.minimum)
+                self.small = 0
+                return True
+        else:
+            self.small = 0
+        return False
+
+def shutdown_socket(sock):
+    """Corta ambas direcciones de un socket para despertar a quien este bloqueado en el"""
+    try:
+        sock.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass
+
+def forward_copy(src, dst, stats, direction):
+    """Copia datos de src a dst pasando por Python (recv + sendall)"""
+    read_size = ReadSize(stats.profile)
+    buffer = bytearray(read_size.size)
+    stats.hold(len(buffer))
+    view = memoryview(buffer)
+    while True:
+        count = src.recv_into(buffer)
+        if not count:
+            break
+        if stats.capture is not None:
+            stats.capture.record(direction, view[:count])
+        dst.sendall(view[:count])
+        stats.add(direction, count)
+        if read_size.update(count):
+            stats.hold(read_size.size - len(buffer))
+            buffer = bytearray(read_size.size)
+            view = memoryview(buffer)
+
+def forward_splice(src, dst, stats, direction):
+    """Mueve datos de src a dst dentro del kernel con os.splice a traves de un pipe"""
+    pipe_read, pipe_write = os.pipe()
+    try:
+        src_fd = src.fileno()
+        dst_fd = dst.fileno()
+        while True:
+            count = os.splice(src_fd, pipe_write, TUNNEL_CHUNK_SIZE, flags=os.SPLICE_F_MOVE)
+            if count == 0:
+                break
+            pending = count
+            while pending:
+                pending -= os.splice(pipe_read, dst_fd, pending, flags=os.SPLICE_F_MOVE)
+            stats.add(direction, count)
+    finally:
+        os.close(pipe_read)
+        os.close(pipe_write)
+
+def forward(src, dst, stats, direction):
+    """Reenvia una direccion del tunel y cierra ambos sockets al terminar"""
+    try:
+        if stats.engine == "splice":
+            try:
+                forward_splice(src, dst, stats, direction)
+                return
+            except OSError as e:
+                # splice puede no estar soportado para este socket: volver a la copia
+                # normal solo si todavia no se movio ningun byte en esta direccion
+                moved = stats.client_to_server if direction == "client->server" else stats.server_to_client
+                if moved or e.errno not in (errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP):
+                    raise
+        forward_copy(src, dst, stats, direction)
+    except OSError:
+        pass
+    finally:
+        shutdown_socket(src)
+        shutdown_socket(dst)
+        if stats.close_direction():
+            stats.report()
+            src.close()
+            dst.close()
+
+def start_tunnel(client_socket, server_socket, name, leftover=b'', backend=None, capture=None):
+    """Crea el tunel bidireccional entre cliente y servidor real"""
+    stats = TunnelStats(name, tunnel_engine(capture), backend, capture)
+    
+    # Bytes del cliente leidos de mas durante el login
+    if leftover:
+        if capture is not None:
+            capture.record("client->server", leftover)
+        server_socket.sendall(leftover)
+        stats.add("client->server", len(leftover))
+    
+    stats.tune(client_socket, server_socket)
+    stats.watch_idle(client_socket, server_socket)
+    threading.Thread(target=forward, args=(client_socket, server_socket, stats, "client->server"), daemon=True).start()
+    threading.Thread(target=forward, args=(server_socket, client_socket, stats, "server->client"), daemon=True).start()
+    return stats
+
+def connect_to_backend(conn, login_packet_data):
+    """Abre la conexion al servidor real, reenvia handshake y Login Start y crea el tunel"""
+    backend = conn.backend
+    trace = conn.trace
+    capture = capture_session('login', conn.player_name, backend, conn.handshake, login_packet_data)
+    # Necesitamos reconstruir la conexion porque ya leimos el Login Start
+    # Creamos una nueva conexion al servidor real
+    try:
+        # Si el servidor no contesta a tiempo, abort() corta tambien este socket
+        conn.server_sock = server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        conn.start_phase('conectar_servidor', BACKEND_CONNECT_TIMEOUT)
+        server_socket.connect((backend.host, backend.port))
+        trace.mark('conectar_servidor')
+        
+        # Reenviar handshake original y Login Start
+        server_socket.sendall(encode_packet(0x00, conn.handshake) + encode_packet(0x00, login_packet_data))
+        trace.mark('reenviar_login')
+        conn.deadline.cancel()
+        
+        # Crear tuneles bidireccionales (con lo que el cliente ya haya enviado de mas)
+        start_tunnel(conn.sock, server_socket, conn.player_name, conn.reader.leftover(), backend, capture)
+        trace.mark('abrir_tunel')
+        trace.outcome = 'login'
+        return True
+    except Exception as e:
+        log(ERROR, 'ERROR', "Error conectando al servidor {}: {}", backend.name, e)
+        trace.outcome = 'servidor_inalcanzable'
+        backend.monitor.report_unreachable()
+        if capture is not None:
+            capture.close()
+        if conn.server_sock is not None:
+            conn.server_sock.close()
+        conn.sock.close()
+        return False
+
+class Connection:
+    """Estado de una conexion del motor threads hasta que se abre el tunel (o se cierra).
+    Un objeto con __slots__ por conexion en vez de variables sueltas y closures: el plazo
+    corta los sockets con abort() sin crear una lambda por conexion"""
+    
+    __slots__ = ('sock', 'server_sock', 'reader', 'trace', 'deadline', 'phase', 'handshake',
+                 'next_state', 'protocol', 'backend', 'player_name', 'player_uuid')
+    
+    def __init__(self, sock, accepted_at):
+        self.sock = sock
+        self.server_sock = None
+        self.reader = PacketReader(sock)
+        self.trace = start_trace(accepted_at, sock=sock)
+        self.deadline = ConnectionDeadline(self.abort)
+        self.phase = None
+        self.handshake = None
+        self.next_state = None
+        self.protocol = None
+        self.backend = None
+        self.player_name = None
+        self.player_uuid = None
+    
+    def start_phase(self, phase, seconds):
+        """Entra en una fase con su plazo (reemplaza al de la fase anterior)"""
+        self.phase = phase
+        self.deadline.start(phase, seconds)
+    
+    def abort(self):
+        """Corta los sockets: la lectura o el connect bloqueado en el handler termina"""
+        shutdown_socket(self.sock)
+        if self.server_sock is not None:
+            shutdown_socket(self.server_sock)
+    
+    def finish(self):
+        """Cancela el plazo pendiente y cierra la traza al salir del handler"""
+        self.deadline.cancel()
+        # Rompe el ciclo conexion -> plazo -> abort(): se libera sin esperar al recolector
+        self.deadline = None
+        self.trace.finish()
+
+def handle_client(client_socket, accepted_at=None):
+    """Maneja a un cliente, diferenciando entre ping y login"""
+    if accepted_at is None:
+        accepted_at = time.perf_counter()
+    conn = Connection(client_socket, accepted_at)
+    reader = conn.reader
+    trace = conn.trace
+    
+    # Ninguna fase antes del tunel puede quedarse colgada: al vencer su plazo se corta
+    # el socket y la lectura bloqueada en este hilo termina
+    conn.start_phase('handshake', HANDSHAKE_TIMEOUT)
+    
+    try:
+        # Leer el primer paquete (handshake)
+        packet_id, conn.handshake = reader.read_packet()
+        trace.mark('leer_handshake')
+        if packet_id is None:
+            client_socket.close()
+            return
+        
+        # El handshake siempre es packet 0x00
+        if packet_id != 0x00:
             client_socket.close()
             return
         
-        # Procesar handshake para determinar la intencion
-        next_state, client_protocol = handle_handshake(packet_data, client_socket)
+        # Procesar handshake para determinar la intencion y el servidor destino
+        conn.next_state, conn.protocol, conn.backend = route_handshake(conn.handshake)
+        backend = conn.backend
+        trace.mark('parsear_handshake')
+        HANDSHAKE_SECONDS.observe(time.perf_counter() - accepted_at)
+        CONNECTIONS_TOTAL.inc(1, str(conn.next_state))
         
-        if next_state is None:
+        if conn.next_state is None:
             client_socket.close()
             return
         
-        print(f"[DEBUG] Cliente usando protocol version: {client_protocol}")
+        log(DEBUG, 'DEBUG', "Cliente usando protocol version: {} -> servidor {}", conn.protocol, backend.name)
         
-        server_online = is_server_online()
+        server_online = backend.monitor.is_online()
+        trace.mark('estado_servidor')
         
-        if next_state == 1:  # Status request (lista de servidores)
-            print("[STATUS] Ping de lista de servidores detectado")
-            if server_online:
-                print("[STATUS] Servidor activo - mostrando MOTD de bienvenida")
-            else:
-                print("[STATUS] Servidor dormido - mostrando MOTD de suspension")
-            handle_status_request(client_socket, server_online, client_protocol)
+        if conn.next_state == 1:  # Status request (lista de servidores)
+            # Los pings de la lista de servidores se repiten mucho: registro muestreado
+            if log_sampled('status'):
+                log(INFO, 'STATUS', "Ping de lista de servidores detectado")
+                if server_online:
+                    log(INFO, 'STATUS', "Servidor activo - mostrando MOTD de bienvenida")
+                else:
+                    log(INFO, 'STATUS', "Servidor dormido - mostrando MOTD de suspension")
+            trace.outcome = 'status'
+            conn.start_phase('status', STATUS_TIMEOUT)
+            capture = capture_session('status', None, backend, conn.handshake)
+            handle_status_request(client_socket, server_online, conn.protocol, reader, backend, trace)
             client_socket.close()
+            if capture is not None:
+                capture.close()
                 
-        elif next_state == 2:  # Login request (conexion real)
-            print("[LOGIN] Intento de conexion detectado")
+        elif conn.next_state == 2:  # Login request (conexion real)
+            log(INFO, 'LOGIN', "Intento de conexion detectado")
             
             # Leer el Login Start packet del cliente
-            login_packet_id, login_packet_data = read_packet(client_socket)
+            conn.start_phase('login_start', LOGIN_START_TIMEOUT)
+            login_packet_id, login_packet_data = reader.read_packet()
+            trace.mark('leer_login_start')
             
             if login_packet_id != 0x00:
-                print("[LOGIN] Packet ID inesperado en login")
+                log(WARNING, 'LOGIN', "Packet ID inesperado en login")
                 client_socket.close()
                 return
             
-            # Extraer nombre del jugador
-            player_name = extract_player_name(login_packet_data)
+            # Extraer nombre y UUID del jugador
+            try:
+                conn.player_name, conn.player_uuid = extract_login_start(login_packet_data)
+            except Exception as e:
+                log(ERROR, 'ERROR', "Error extrayendo nombre del jugador: {}", e)
+                conn.player_name = None
+            player_name = conn.player_name
             
             if player_name is None:
-                print("[LOGIN] No se pudo extraer el nombre del jugador")
+                log(WARNING, 'LOGIN', "No se pudo extraer el nombre del jugador")
                 client_socket.close()
                 return
             
-            print(f"[LOGIN] Jugador: {player_name}")
+            log(INFO, 'LOGIN', "Jugador: {}", player_name)
             
             # Verificar whitelist
-            if not is_player_whitelisted(player_name):
-                print(f"[WHITELIST] Jugador {player_name} NO esta en la whitelist - RECHAZADO")
+            allowed = backend.is_player_whitelisted(player_name, conn.player_uuid)
+            trace.mark('whitelist')
+            if not allowed:
+                trace.outcome = 'rechazado'
+                log(INFO, 'WHITELIST', "Jugador {} NO esta en la whitelist - RECHAZADO", player_name)
+                WHITELIST_REJECTS_TOTAL.inc()
                 send_disconnect(client_socket, MENSAJE_NO_WHITELIST)
                 time.sleep(0.1)
                 client_socket.close()
                 return
             
-            print(f"[WHITELIST] Jugador {player_name} esta en la whitelist - PERMITIDO")
+            log(INFO, 'WHITELIST', "Jugador {} esta en la whitelist - PERMITIDO", player_name)
+            record_login(player_name, backend)
             
-            if server_online:
-                print("[LOGIN] Servidor activo - conectando jugador")
-                # Necesitamos reconstruir la conexion porque ya leimos el Login Start
-                # Creamos una nueva conexion al servidor real
-                try:
-                    server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                    server_socket.settimeout(10)
-                    server_socket.connect((SERVER_HOST, SERVER_PORT))
-                    
-                    # Reenviar handshake original
-                    send_packet(server_socket, 0x00, packet_data)
-                    
-                    # Reenviar Login Start
-                    send_packet(server_socket, 0x00, login_packet_data)
-                    
-                    # Crear tuneles bidireccionales
-                    def forward(src, dst, name):
-                        try:
-                            while True:
-                                data = src.recv(4096)
-                                if not data:
-                                    break
-                                dst.sendall(data)
-                        except:
-                            pass
-                        finally:
-                            try:
-                                src.close()
-                            except:
-                                pass
-                    
-                    threading.Thread(target=forward, args=(client_socket, server_socket, "client->server"), daemon=True).start()
-                    threading.Thread(target=forward, args=(server_socket, client_socket, "server->client"), daemon=True).start()
-                    
-                except Exception as e:
-                    print(f"[ERROR] Error conectando al servidor: {e}")
+            if not server_online:
+                # Despertar y retener el login hasta que el servidor acepte conexiones
+                backend.wake.request_wake(player_name)
+                log(INFO, 'LOGIN', "Reteniendo a {} mientras arranca el servidor", player_name)
+                conn.start_phase('retener_login', WAKE_HOLD_TIMEOUT + HANDSHAKE_TIMEOUT)
+                ready = backend.wake.wait_ready(WAKE_HOLD_TIMEOUT)
+                trace.mark('retener_login')
+                if not ready:
+                    trace.outcome = 'despertando'
+                    log(INFO, 'LOGIN', "Informando al jugador - servidor despertando")
+                    send_disconnect(client_socket, MENSAJE_DESPERTANDO)
+                    time.sleep(0.1)
                     client_socket.close()
-            else:
-                if not is_waking_up:
-                    is_waking_up = True
-                    print(f"[WOL] Servidor dormido - enviando Wake-on-LAN (solicitado por {player_name})")
-                    os.system(f'wakeonlan {SERVER_MAC}')
-                    threading.Timer(60.0, reset_waking_up_flag).start()
-                else:
-                    print(f"[WOL] Servidor ya despertando (solicitado por {player_name})")
-                
-                print("[LOGIN] Informando al jugador - servidor despertando")
-                
-                mensaje_json = {
-                    "text": "Despertando el servidor! Espera unos 30 segundos y vuelve a recargar la lista de servidores."
-                }
-                
-                json_str = json.dumps(mensaje_json, ensure_ascii=False)
-                json_bytes = json_str.encode('utf-8')
-                data = write_varint(len(json_bytes)) + json_bytes
-                send_packet(client_socket, 0x00, data)
-                
-                time.sleep(0.1)
-                client_socket.close()
+                    return
+            
+            log(INFO, 'LOGIN', "Servidor activo - conectando jugador")
+            connect_to_backend(conn, login_packet_data)
         else:
             client_socket.close()
             
     except Exception as e:
-        print(f"[ERROR] Error en handle_client: {e}")
+        log(ERROR, 'ERROR', "Error en handle_client: {}", e)
+        trace.outcome = 'error'
         client_socket.close()
+    finally:
+        conn.finish()
+
+def handle_admitted_client(client_socket, ticket, accepted_at=None):
+    """Atiende a un cliente ya admitido y libera su plaza de handshake al terminar"""
+    try:
+        handle_client(client_socket, accepted_at)
+    finally:
+        ticket.release()
+
+class HandlerPool:
+    """Hilos fijos del motor threads que atienden las conexiones admitidas (handshake,
+    status y login) en vez de un hilo nuevo por conexion. La cola es acotada: si esta
+    llena, submit() devuelve False y la conexion se rechaza en el accept"""
+    
+    def __init__(self, size=None, queue_depth=None, share=1):
+        # share: procesos entre los que se reparte el pool (workers)
+        self.size = size if size is not None else max(1, HANDLER_POOL_SIZE // share)
+        depth = queue_depth if queue_depth is not None else max(1, HANDLER_QUEUE_DEPTH // share)
+        self.queue = queue.Queue(maxsize=depth)
+        self.busy = 0
+        self._lock = threading.Lock()
+    
+    def start(self):
+        for number in range(self.size):
+            threading.Thread(target=self._run, name=f"handler-{number}", daemon=True).start()
+    
+    def submit(self, client_socket, ticket, accepted_at):
+        """Encola una conexion admitida. False si la cola esta llena"""
+        try:
+            self.queue.put_nowait((client_socket, ticket, accepted_at))
+            return True
+        except queue.Full:
+            return False
+    
+    def _run(self):
+        while True:
+            client_socket, ticket, accepted_at = self.queue.get()
+            HANDLER_QUEUE_WAIT_SECONDS.observe(time.perf_counter() - accepted_at)
+            with self._lock:
+                self.busy += 1
+            try:
+                handle_admitted_client(client_socket, ticket, accepted_at)
+            except Exception as e:
+                log(ERROR, 'ERROR', "Error en el pool de handlers: {}", e)
+            finally:
+                with self._lock:
+                    self.busy -= 1
 
-def reset_waking_up_flag():
-    """Reinicia el flag de 'despertando'"""
-    global is_waking_up
-    is_waking_up = False
-    print("[WOL] Flag de 'despertando' reiniciado")
+def set_thread_stack_size():
+    """Aplica THREAD_STACK_SIZE a los hilos que se creen a partir de ahora"""
+    try:
+        threading.stack_size(THREAD_STACK_SIZE)
+    except (ValueError, RuntimeError) as e:
+        log(WARNING, 'PROXY', "THREAD_STACK_SIZE={} no valido, se usa la pila del sistema: {}",
+            THREAD_STACK_SIZE, e)
 
 def proxy_connection(client_socket, initial_data, is_status):
     """Establece tunel entre cliente y servidor real"""
     try:
         server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         server_socket.settimeout(10)
-        server_socket.connect((SERVER_HOST, SERVER_PORT))
+        backend = router.default
+        server_socket.connect((backend.host, backend.port))
         
         # Reenviar handshake inicial
         send_packet(server_socket, 0x00, initial_data)
         
-        def forward(src, dst, name):
-            try:
-                while True:
-                    data = src.recv(4096)
-                    if not data:
-                        break
-                    dst.sendall(data)
-            except:
-                pass
-            finally:
-                try:
-                    src.close()
-                except:
-                    pass
-        
         # Solo para status, no necesitamos mantener la conexion
         if is_status:
             # Reenviar los paquetes de status
-            handle_status_request(client_socket, True, 767)
+            handle_status_request(client_socket, True, 767, backend=backend)
             client_socket.close()
             server_socket.close()
             return
         
         # Para login, mantener conexion activa
-        threading.Thread(target=forward, args=(client_socket, server_socket, "client->server"), daemon=True).start()
-        threading.Thread(target=forward, args=(server_socket, client_socket, "server->client"), daemon=True).start()
+        start_tunnel(client_socket, server_socket, "proxy", backend=backend)
         
     except Exception as e:
-        print(f"[ERROR] Error en proxy_connection: {e}")
+        log(ERROR, 'ERROR', "Error en proxy_connection: {}", e)
         try:
             client_socket.close()
         except:
             pass
 
-def main():
-    # Cargar whitelist al iniciar
-    load_whitelist()
-    
-    # Cargar icono al iniciar
-    load_server_icon()
+# --- MOTOR ASYNCIO ---
+# Misma logica que handle_client/proxy_connection pero sobre un unico event loop,
+# sin crear hilos por conexion ni por tunel.
+
+async def send_packet_async(writer, packet_id, data=b''):
+    """Envia un paquete a traves de un StreamWriter"""
+    try:
+        writer.write(encode_packet(packet_id, data))
+        await writer.drain()
+        return True
+    except (ConnectionError, OSError):
+        return False
+
+async def close_writer(writer):
+    """Cierra un StreamWriter ignorando errores"""
+    try:
+        writer.close()
+        await writer.wait_closed()
+    except Exception:
+        pass
+
+async def wait_fd_async(loop, fd, writable=False):
+    """Espera a que un descriptor este listo para leer (o escribir)"""
+    future = loop.create_future()
+    
+    def ready():
+        if not future.done():
+            future.set_result(None)
+    
+    if writable:
+        loop.add_writer(fd, ready)
+    else:
+        loop.add_reader(fd, ready)
+    try:
+        await future
+    finally:
+        if writable:
+            loop.remove_writer(fd)
+        else:
+            loop.remove_reader(fd)
+
+async def forward_copy_async(loop, src, dst, stats, direction):
+    """Copia datos de src a dst pasando por Python en el event loop"""
+    read_size = ReadSize(stats.profile)
+    buffer = bytearray(read_size.size)
+    stats.hold(len(buffer))
+    view = memoryview(buffer)
+    while True:
+        count = await loop.sock_recv_into(src, buffer)
+        if not count:
+            break
+        if stats.capture is not None:
+            stats.capture.record(direction, view[:count])
+        await loop.sock_sendall(dst, view[:count])
+        stats.add(direction, count)
+        if read_size.update(count):
+            stats.hold(read_size.size - len(buffer))
+            buffer = bytearray(read_size.size)
+            view = memoryview(buffer)
+
+async def forward_splice_async(loop, src, dst, stats, direction):
+    """Version no bloqueante de forward_splice: espera con el selector del event loop"""
+    pipe_read, pipe_write = os.pipe()
+    flags = os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK
+    try:
+        src_fd = src.fileno()
+        dst_fd = dst.fileno()
+        while True:
+            try:
+                count = os.splice(src_fd, pipe_write, TUNNEL_CHUNK_SIZE, flags=flags)
+            except BlockingIOError:
+                await wait_fd_async(loop, src_fd)
+                continue
+            if count == 0:
+                break
+            pending = count
+            while pending:
+                try:
+                    pending -= os.splice(pipe_read, dst_fd, pending, flags=flags)
+                except BlockingIOError:
+                    await wait_fd_async(loop, dst_fd, writable=True)
+            stats.add(direction, count)
+    finally:
+        os.close(pipe_read)
+        os.close(pipe_write)
+
+async def forward_async(src, dst, stats, direction):
+    """Reenvia una direccion del tunel sobre sockets no bloqueantes"""
+    loop = asyncio.get_running_loop()
+    try:
+        if stats.engine == "splice":
+            try:
+                await forward_splice_async(loop, src, dst, stats, direction)
+                return
+            except OSError as e:
+                moved = stats.client_to_server if direction == "client->server" else stats.server_to_client
+                if moved or e.errno not in (errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP):
+                    raise
+        await forward_copy_async(loop, src, dst, stats, direction)
+    except OSError:
+        pass
+    finally:
+        shutdown_socket(src)
+        shutdown_socket(dst)
+
+async def detach_stream(reader, writer):
+    """Separa el socket de un par StreamReader/StreamWriter para usarlo en bruto.
+    Devuelve el socket (no bloqueante) y los bytes que el stream ya habia leido"""
+    transport = writer.transport
+    
+    # Vaciar lo pendiente de escritura y dejar de leer del socket
+    transport.set_write_buffer_limits(high=0)
+    await writer.drain()
+    transport.pause_reading()
+    
+    # Lo que ya esta en el buffer del reader pertenece al cliente y debe reenviarse
+    reader.feed_eof()
+    leftover = await reader.read()
+    
+    sock = socket.socket(fileno=os.dup(transport.get_extra_info('socket').fileno()))
+    sock.setblocking(False)
+    transport.abort()
+    return sock, leftover
+
+async def run_tunnel_async(client_socket, server_socket, name, leftover=b'', backend=None, capture=None):
+    """Tunel bidireccional como dos corrutinas sobre el mismo event loop"""
+    stats = TunnelStats(name, tunnel_engine(capture), backend, capture)
+    stats.tune(client_socket, server_socket)
+    stats.watch_idle(client_socket, server_socket)
+    try:
+        if leftover:
+            if capture is not None:
+                capture.record("client->server", leftover)
+            await asyncio.get_running_loop().sock_sendall(server_socket, leftover)
+            stats.add("client->server", len(leftover))
+        await asyncio.gather(
+            forward_async(client_socket, server_socket, stats, "client->server"),
+            forward_async(server_socket, client_socket, stats, "server->client"),
+        )
+    finally:
+        stats.report()
+        client_socket.close()
+        server_socket.close()
+
+async def handle_status_request_async(reader, writer, server_online, client_protocol, packets, backend,
+                                      trace=NULL_TRACE):
+    """Maneja solicitudes de status (lista de servidores) en el event loop"""
+    started = time.perf_counter()
+    try:
+        packet_id, packet_data = await packets.read_packet_async(reader)
+        trace.mark('leer_status_request')
+        if packet_id != 0x00 or packet_data is None:
+            return False
+        
+        # Enviar respuesta de status (pre-codificada)
+        writer.write(backend.get_status_packet(server_online, client_protocol))
+        await writer.drain()
+        trace.mark('enviar_status')
+        STATUS_RESPONSE_SECONDS.observe(time.perf_counter() - started)
+        
+        # Esperar y responder al ping
+        packet_id, ping_data = await packets.read_packet_async(reader)
+        if packet_id == 0x01:
+            await send_packet_async(writer, 0x01, ping_data)
+        trace.mark('ping')
+        
+        return True
+    except Exception as e:
+        log(WARNING, 'STATUS', "Error en handle_status_request_async: {}", e)
+        return False
+
+async def connect_to_backend_async(reader, writer, packets, packet_data, login_packet_data, player_name, ticket, backend,
+                                   trace=NULL_TRACE, deadline=None):
+    """Equivalente asincrono de connect_to_backend: el tunel corre en esta misma corrutina"""
+    loop = asyncio.get_running_loop()
+    capture = capture_session('login', player_name, backend, packet_data, login_packet_data)
+    server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server_socket.setblocking(False)
+    try:
+        if deadline is not None:
+            # Si el servidor no contesta a tiempo, sock_connect falla al cortar el socket
+            deadline.close = lambda: shutdown_socket(server_socket)
+            deadline.start('conectar_servidor', BACKEND_CONNECT_TIMEOUT)
+        await loop.sock_connect(server_socket, (backend.host, backend.port))
+        trace.mark('conectar_servidor')
+        
+        # Reenviar handshake original y Login Start
+        await loop.sock_sendall(server_socket, encode_packet(0x00, packet_data) + encode_packet(0x00, login_packet_data))
+        trace.mark('reenviar_login')
+        if deadline is not None:
+            deadline.cancel()
+    except Exception as e:
+        log(ERROR, 'ERROR', "Error conectando al servidor {}: {}", backend.name, e)
+        trace.outcome = 'servidor_inalcanzable'
+        backend.monitor.report_unreachable()
+        if capture is not None:
+            capture.close()
+        server_socket.close()
+        return False
     
-    proxy_server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    proxy_server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    # Tuneles bidireccionales como corrutinas
+    ticket.release()
+    client_socket, leftover = await detach_stream(reader, writer)
+    trace.mark('abrir_tunel')
+    trace.outcome = 'login'
+    # El tunel dura toda la partida: la traza termina aqui
+    trace.finish()
+    await run_tunnel_async(client_socket, server_socket, player_name, packets.leftover() + leftover, backend,
+                           capture)
+    return True
+
+async def handle_client_async(reader, writer):
+    """Equivalente asincrono de handle_client"""
+    accepted_at = time.perf_counter()
+    
+    # Admision antes de cualquier otra cosa
+    peer = writer.get_extra_info('peername')
+    ticket = admission.admit(peer[0])
+    if ticket is None:
+        writer.transport.abort()
+        return
+    
+    if log_sampled('conexion'):
+        log(INFO, 'CONEXION', "Nueva conexion de {}", peer)
+    
+    packets = PacketReader()
+    trace = start_trace(accepted_at, peer)
+    
+    # Plazos por fase en el mismo planificador que el motor threads: al vencer se aborta
+    # el transporte desde el event loop y la lectura pendiente termina con EOF
+    loop = asyncio.get_running_loop()
+    deadline = ConnectionDeadline(lambda: loop.call_soon_threadsafe(writer.transport.abort))
+    deadline.start('handshake', HANDSHAKE_TIMEOUT)
     
     try:
-        proxy_server.bind((PROXY_HOST, PROXY_PORT))
-        proxy_server.listen(10)
-        print(f"[PROXY] Proxy de Minecraft escuchando en {PROXY_HOST}:{PROXY_PORT}")
-        print(f"[PROXY] Servidor objetivo: {SERVER_HOST}:{SERVER_PORT}")
-        print("[PROXY] Esperando conexiones...")
+        # Leer el primer paquete (handshake)
+        packet_id, packet_data = await packets.read_packet_async(reader)
+        trace.mark('leer_handshake')
+        if packet_id != 0x00:
+            return
+        
+        next_state, client_protocol, backend = route_handshake(packet_data)
+        trace.mark('parsear_handshake')
+        HANDSHAKE_SECONDS.observe(time.perf_counter() - accepted_at)
+        CONNECTIONS_TOTAL.inc(1, str(next_state))
+        if next_state is None:
+            return
+        
+        log(DEBUG, 'DEBUG', "Cliente usando protocol version: {} -> servidor {}", client_protocol, backend.name)
+        
+        server_online = backend.monitor.is_online()
+        trace.mark('estado_servidor')
+        
+        if next_state == 1:  # Status request (lista de servidores)
+            # Los pings de la lista de servidores se repiten mucho: registro muestreado
+            if log_sampled('status'):
+                log(INFO, 'STATUS', "Ping de lista de servidores detectado")
+                if server_online:
+                    log(INFO, 'STATUS', "Servidor activo - mostrando MOTD de bienvenida")
+                else:
+                    log(INFO, 'STATUS', "Servidor dormido - mostrando MOTD de suspension")
+            trace.outcome = 'status'
+            deadline.start('status', STATUS_TIMEOUT)
+            capture = capture_session('status', None, backend, packet_data)
+            await handle_status_request_async(reader, writer, server_online, client_protocol, packets, backend, trace)
+            if capture is not None:
+                capture.close()
+            
+        elif next_state == 2:  # Login request (conexion real)
+            log(INFO, 'LOGIN', "Intento de conexion detectado")
+            
+            deadline.start('login_start', LOGIN_START_TIMEOUT)
+            login_packet_id, login_packet_data = await packets.read_packet_async(reader)
+            trace.mark('leer_login_start')
+            if login_packet_id != 0x00:
+                log(WARNING, 'LOGIN', "Packet ID inesperado en login")
+                return
+            
+            try:
+                player_name, player_uuid = extract_login_start(login_packet_data)
+            except Exception as e:
+                log(ERROR, 'ERROR', "Error extrayendo nombre del jugador: {}", e)
+                player_name = None
+            if player_name is None:
+                log(WARNING, 'LOGIN', "No se pudo extraer el nombre del jugador")
+                return
+            
+            log(INFO, 'LOGIN', "Jugador: {}", player_name)
+            
+            allowed = backend.is_player_whitelisted(player_name, player_uuid)
+            trace.mark('whitelist')
+            if not allowed:
+                trace.outcome = 'rechazado'
+                log(INFO, 'WHITELIST', "Jugador {} NO esta en la whitelist - RECHAZADO", player_name)
+                WHITELIST_REJECTS_TOTAL.inc()
+                await send_packet_async(writer, 0x00, encode_json_string({"text": MENSAJE_NO_WHITELIST}, ensure_ascii=False))
+                return
+            
+            log(INFO, 'WHITELIST', "Jugador {} esta en la whitelist - PERMITIDO", player_name)
+            record_login(player_name, backend)
+            
+            if not server_online:
+                # Despertar y retener el login hasta que el servidor acepte conexiones
+                backend.wake.request_wake(player_name)
+                log(INFO, 'LOGIN', "Reteniendo a {} mientras arranca el servidor", player_name)
+                deadline.start('retener_login', WAKE_HOLD_TIMEOUT + HANDSHAKE_TIMEOUT)
+                ready = await backend.wake.wait_ready_async(WAKE_HOLD_TIMEOUT)
+                trace.mark('retener_login')
+                if not ready:
+                    trace.outcome = 'despertando'
+                    log(INFO, 'LOGIN', "Informando al jugador - servidor despertando")
+                    await send_packet_async(writer, 0x00, encode_json_string({"text": MENSAJE_DESPERTANDO}, ensure_ascii=False))
+                    await asyncio.sleep(0.1)
+                    return
+            
+            log(INFO, 'LOGIN', "Servidor activo - conectando jugador")
+            await connect_to_backend_async(reader, writer, packets, packet_data, login_packet_data, player_name, ticket,
+                                           backend, trace, deadline)
+    except asyncio.CancelledError:
+        # Cierre del proceso (SIGTERM o Ctrl+C): asyncio.run cancela las conexiones abiertas y
+        # asyncio.streams volcaria la traza de cada tarea cancelada como un error
+        pass
+    except Exception as e:
+        log(ERROR, 'ERROR', "Error en handle_client_async: {}", e)
+        trace.outcome = 'error'
+    finally:
+        deadline.cancel()
+        trace.finish()
+        ticket.release()
+        await close_writer(writer)
+
+async def main_async(listener=None, worker=None):
+    """Acepta conexiones con asyncio.start_server"""
+    global stop_accepting
+    
+    if listener is not None:
+        server = await asyncio.start_server(handle_client_async, sock=listener, backlog=LISTEN_BACKLOG)
+    else:
+        server = await asyncio.start_server(handle_client_async, PROXY_HOST, PROXY_PORT,
+                                            backlog=LISTEN_BACKLOG, reuse_address=True)
+    loop = asyncio.get_running_loop()
+    stop_accepting = lambda: loop.call_soon_threadsafe(server.close)
+    log(INFO, 'PROXY', "Proxy de Minecraft escuchando en {}:{} (motor asyncio{})",
+        PROXY_HOST, PROXY_PORT, worker_label(worker))
+    print_backends()
+    log(INFO, 'PROXY', "Esperando conexiones...")
+    async with server:
+        try:
+            await server.serve_forever()
+        except asyncio.CancelledError:
+            if not draining.is_set():
+                raise
+        # Socket cedido en una actualizacion: los tuneles siguen hasta terminar el drenado
+        await loop.run_in_executor(None, drained.wait)
+
+def main_threads(listener=None, worker=None):
+    """Acepta conexiones y las reparte al pool de handlers (modo clasico)"""
+    global stop_accepting, accept_interruptible, handler_pool
+    proxy_server = listener
+    
+    if threading.current_thread() is threading.main_thread():
+        # Al ceder el socket, SIGUSR2 al propio hilo saca al accept del bloqueo (StopAccepting)
+        accept_interruptible = True
+        stop_accepting = lambda: signal.pthread_kill(threading.main_thread().ident, signal.SIGUSR2)
+    
+    try:
+        if proxy_server is None:
+            proxy_server = create_listener()
+        # Un worker anterior con asyncio pudo dejar el socket heredado en modo no bloqueante
+        proxy_server.setblocking(True)
+        log(INFO, 'PROXY', "Proxy de Minecraft escuchando en {}:{} (motor threads{})",
+            PROXY_HOST, PROXY_PORT, worker_label(worker))
+        print_backends()
+        
+        set_thread_stack_size()
+        handler_pool = HandlerPool(share=admission.share)
+        handler_pool.start()
+        stack = threading.stack_size()
+        log(INFO, 'PROXY', "Pool de {} handlers, cola de {}, pila por hilo: {}", handler_pool.size,
+            handler_pool.queue.maxsize, f"{stack // 1024} KiB" if stack else "la del sistema")
+        log(INFO, 'PROXY', "Esperando conexiones...")
         
         while True:
             client_socket, addr = proxy_server.accept()
-            print(f"\n[CONEXION] Nueva conexion de {addr}")
-            handler = threading.Thread(target=handle_client, args=(client_socket,))
-            handler.daemon = True
-            handler.start()
+            accepted_at = time.perf_counter()
+            
+            # Rechazo temprano: sin hilo y sin sondear el servidor
+            ticket = admission.admit(addr[0])
+            if ticket is None:
+                client_socket.close()
+                continue
+            
+            if not handler_pool.submit(client_socket, ticket, accepted_at):
+                # Todos los hilos ocupados y la cola llena: mejor rechazar que acumular
+                ticket.release()
+                admission.reject('pool_lleno')
+                if log_sampled('pool_lleno'):
+                    log(WARNING, 'ADMISION', "Pool de handlers saturado - rechazando {}", addr)
+                client_socket.close()
+                continue
             
+            if log_sampled('conexion'):
+                log(INFO, 'CONEXION', "Nueva conexion de {}", addr)
+            
+    except StopAccepting:
+        # Socket cedido en una actualizacion: los tuneles siguen hasta terminar el drenado
+        proxy_server.close()
+        drained.wait()
     except KeyboardInterrupt:
-        print("\n[PROXY] Cerrando proxy...")
+        log(INFO, 'PROXY', "Cerrando proxy...")
     except Exception as e:
-        print(f"[ERROR] Error en main: {e}")
+        log(ERROR, 'ERROR', "Error en main: {}", e)
     finally:
-        proxy_server.close()
+        if proxy_server is not None:
+            proxy_server.close()
+
+def create_listener(reuse_port=False):
+    """Socket de escucha en PROXY_HOST:PROXY_PORT"""
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    listener.bind((PROXY_HOST, PROXY_PORT))
+    listener.listen(LISTEN_BACKLOG)
+    return listener
+
+def worker_label(worker):
+    return f", worker {worker}" if worker is not None else ""
+
+# --- MODO MULTIPROCESO ---
+# El supervisor es el unico que sondea los servidores y envia Wake-on-LAN; los workers
+# solo aceptan conexiones. El estado de cada servidor vive en un mmap anonimo heredado
+# en el fork y los workers piden sondeos o despertares al supervisor por un pipe.
+# Los workers no son hijos del supervisor sino de un lanzador sin hilos (WorkerLauncher)
+
+class SharedBackendState:
+    """Estado de un servidor en memoria compartida: cabecera fija + status real en JSON.
+    No hay locks entre procesos (un worker que muriera con el lock cogido bloquearia a
+    todos): cada zona tiene un solo proceso escritor y un numero de secuencia (seqlock),
+    impar mientras se escribe. El lector copia la zona y la da por buena si la secuencia
+    era par y no cambio mientras copiaba"""
+    
+    SEQUENCE = struct.Struct('<I')
+    # 'Despertando': un byte suelto (escritura atomica) que escriben el supervisor y los workers
+    WAKING_OFFSET = 0
+    # secuencia, online, version, checked_at (monotonic, comun a todo el sistema), bytes de status.
+    # Solo la escribe el supervisor
+    HEADER_OFFSET = 8
+    HEADER = struct.Struct('<IB3xQdI')
+    # Actividad de cada worker (la escribe solo ese worker): secuencia, tuneles abiertos,
+    # epoch de la ultima actividad
+    IDLE_SLOT = struct.Struct('<IId')
+    # Lecturas seguidas con la zona a medio escribir antes de rendirse (el escritor murio a medias)
+    READ_RETRIES = 1000
+    
+    def __init__(self, workers, size=None):
+        self.workers = workers
+        self.size = size if size is not None else SHARED_STATUS_SIZE
+        self.status_offset = self.HEADER_OFFSET + self.HEADER.size
+        self.idle_offset = self.status_offset + self.size
+        self.mem = mmap.mmap(-1, self.idle_offset + workers * self.IDLE_SLOT.size)
+        # Varios hilos del supervisor publican: se turnan dentro del proceso
+        self.publish_lock = threading.Lock()
+    
+    def _begin_write(self, offset):
+        # Si un escritor anterior murio a medias la secuencia ya es impar: se mantiene
+        sequence = self.SEQUENCE.unpack_from(self.mem, offset)[0] | 1
+        self.SEQUENCE.pack_into(self.mem, offset, sequence)
+        return sequence
+    
+    def _end_write(self, offset, sequence):
+        self.SEQUENCE.pack_into(self.mem, offset, (sequence + 1) & 0xFFFFFFFF)
+    
+    def _read_stable(self, offset, read):
+        """read() sobre una copia coherente de la zona, o None si no se consigue"""
+        for _ in range(self.READ_RETRIES):
+            sequence = self.SEQUENCE.unpack_from(self.mem, offset)[0]
+            if not sequence & 1:
+                value = read()
+                if self.SEQUENCE.unpack_from(self.mem, offset)[0] == sequence:
+                    return value
+            # Ceder el procesador al escritor
+            time.sleep(0)
+        return None
+    
+    def publish(self, online, version, checked_at, status):
+        data = json.dumps(status).encode('utf-8') if status is not None else b''
+        if len(data) > self.size:
+            # No cabe: los workers mostraran el MOTD por defecto
+            data = b''
+        with self.publish_lock:
+            sequence = self._begin_write(self.HEADER_OFFSET)
+            self.mem[self.status_offset:self.status_offset + len(data)] = data
+            self.HEADER.pack_into(self.mem, self.HEADER_OFFSET, sequence, online, version, checked_at, len(data))
+            self._end_write(self.HEADER_OFFSET, sequence)
+    
+    def set_waking(self, waking):
+        self.mem[self.WAKING_OFFSET] = int(waking)
+    
+    def is_online(self):
+        return self.mem[self.HEADER_OFFSET + self.SEQUENCE.size] == 1
+    
+    def is_waking(self):
+        return self.mem[self.WAKING_OFFSET] == 1
+    
+    def read_header(self):
+        """(online, version, checked_at) sin copiar el status, o None si no se pudo leer
+        una copia coherente. Sirve para detectar cambios; el status se lee con read()"""
+        return self._read_stable(self.HEADER_OFFSET,
+                                 lambda: self.HEADER.unpack_from(self.mem, self.HEADER_OFFSET)[1:4])
+    
+    def read(self):
+        """(online, version, checked_at, status), o None si no se pudo leer una copia coherente"""
+        def copy():
+            _, online, version, checked_at, length = self.HEADER.unpack_from(self.mem, self.HEADER_OFFSET)
+            return online, version, checked_at, self.mem[self.status_offset:self.status_offset + length]
+        state = self._read_stable(self.HEADER_OFFSET, copy)
+        if state is None:
+            return None
+        online, version, checked_at, data = state
+        return bool(online), version, checked_at, json.loads(data) if data else None
+    
+    def publish_idle(self, worker, active, last_activity):
+        offset = self.idle_offset + worker * self.IDLE_SLOT.size
+        sequence = self._begin_write(offset)
+        self.IDLE_SLOT.pack_into(self.mem, offset, sequence, active, last_activity)
+        self._end_write(offset, sequence)
+    
+    def read_idle(self):
+        """(tuneles, epoch) de cada worker. Un hueco que no se puede leer (su worker murio
+        escribiendolo) cuenta como sin tuneles hasta que el relanzado lo reescribe"""
+        slots = []
+        for worker in range(self.workers):
+            offset = self.idle_offset + worker * self.IDLE_SLOT.size
+            slot = self._read_stable(offset, lambda: self.IDLE_SLOT.unpack_from(self.mem, offset)[1:])
+            slots.append(slot if slot is not None else (0, 0.0))
+        return slots
+
+# Extremo de escritura del pipe de ordenes hacia el supervisor (solo en los workers)
+supervisor_commands = None
+
+def send_supervisor_command(command, index, argument=None):
+    """Envia una orden de una linea al supervisor. Las escrituras de menos de PIPE_BUF
+    bytes son atomicas, asi que varios workers pueden compartir el pipe"""
+    line = json.dumps([command, index, argument]).encode('utf-8') + b'\n'
+    try:
+        os.write(supervisor_commands, line)
+        return True
+    except OSError as e:
+        # Pipe lleno (supervisor atascado) o cerrado: mejor perder la orden que bloquear
+        log(WARNING, 'WORKER', "No se pudo enviar '{}' al supervisor: {}", command, e)
+        return False
+
+class WorkerBackendMonitor(BackendMonitor):
+    """BackendMonitor de un worker: no sondea, lee lo que publica el supervisor
+    y le pide los sondeos por el pipe de ordenes"""
+    
+    def __init__(self, monitor, index):
+        super().__init__(monitor.host, monitor.port, monitor.name, monitor.interval,
+                         monitor.backoff_max, monitor.ttl)
+        self.shared = monitor.shared
+        self.index = index
+        self.version = -1
+    
+    def start(self):
+        pass
+    
+    def probe(self):
+        self.request_probe()
+        return self.is_online()
+    
+    def report_unreachable(self):
+        send_supervisor_command('unreachable', self.index)
+    
+    def request_probe(self):
+        send_supervisor_command('probe', self.index)
+    
+    def publish(self):
+        pass
+    
+    def is_online(self):
+        return self.shared.is_online()
+    
+    def is_waking(self):
+        return self.shared.is_waking()
+    
+    def snapshot(self):
+        # El JSON solo se decodifica cuando el supervisor publica una version nueva.
+        # Si no se puede leer (supervisor muerto a media escritura) se sigue con lo anterior
+        header = self.shared.read_header()
+        if header is not None:
+            online, version, checked_at = header
+            if version != self.version:
+                state = self.shared.read()
+                if state is not None:
+                    self.online, self.version, self.checked_at, self.status = state
+            else:
+                self.online = bool(online)
+                self.checked_at = checked_at
+        return super().snapshot()
+
+class WorkerWakeController(WakeController):
+    """WakeController de un worker: el despertar lo hace el supervisor y aqui solo
+    se consulta el estado compartido"""
+    
+    def __init__(self, monitor):
+        super().__init__(monitor, None)
+    
+    @property
+    def state(self):
+        if self.monitor.is_online():
+            return self.READY
+        if self.monitor.is_waking():
+            return self.WAKING
+        return self.SLEEPING
+    
+    def request_wake(self, requested_by):
+        shared = self.monitor.shared
+        if shared.is_online():
+            return
+        was_waking = shared.is_waking()
+        # Marcar ya 'despertando' para que wait_ready no falle antes de que el
+        # supervisor procese la orden; el supervisor corrige el flag al recibirla
+        shared.set_waking(True)
+        if not send_supervisor_command('wake', self.monitor.index, requested_by) and not was_waking:
+            shared.set_waking(False)
+    
+    def wait_ready(self, timeout):
+        deadline = time.monotonic() + timeout
+        while not self.is_ready():
+            if not self.monitor.is_waking() or time.monotonic() >= deadline:
+                return False
+            time.sleep(WORKER_POLL_INTERVAL)
+        return True
+    
+    async def wait_ready_async(self, timeout):
+        deadline = time.monotonic() + timeout
+        while not self.is_ready():
+            if not self.monitor.is_waking() or time.monotonic() >= deadline:
+                return False
+            await asyncio.sleep(WORKER_POLL_INTERVAL)
+        return True
+
+def share_backend_state(workers):
+    """Reserva la memoria compartida de cada servidor (antes del primer sondeo)"""
+    for backend in router.backends:
+        backend.monitor.shared = SharedBackendState(workers)
+
+def publish_worker_idle(index):
+    """Hilo de cada worker: copia la actividad de sus tuneles a la memoria compartida
+    para que el supervisor sirva /idle con el total"""
+    while True:
+        for backend in router.backends:
+            active, last_activity = backend.local_idle_state()
+            backend.monitor.shared.publish_idle(index, active, last_activity)
+        time.sleep(1)
+
+def reset_after_fork():
+    """En el hijo de un fork: locks nuevos para el estado de modulo. Solo sobrevive el hilo
+    que hizo el fork, y un lock que otro hilo tuviera cogido quedaria cogido para siempre.
+    Los objetos de cada servidor (monitores, despertares) los reemplaza run_worker"""
+    global profiler_lock, capture_lock, reload_lock, upgrade_lock, draining, drained, deadlines
+    for metric in metrics_registry:
+        if hasattr(metric, '_lock'):
+            metric._lock = threading.Lock()
+    log_writer._flush_lock = threading.Lock()
+    log_writer._wakeup = threading.Event()
+    profiler_lock = threading.Lock()
+    capture_lock = threading.Lock()
+    reload_lock = threading.Lock()
+    upgrade_lock = threading.Lock()
+    draining = threading.Event()
+    drained = threading.Event()
+    # Planificador propio: el hilo del padre no existe en el hijo
+    deadlines = DeadlineScheduler()
+    if admission is not None:
+        admission._lock = threading.Lock()
+
+os.register_at_fork(after_in_child=reset_after_fork)
+
+def run_worker(index, workers, listener, engine, reload=False):
+    """Cuerpo de un proceso worker tras el fork. Con reload relee la configuracion: el
+    lanzador no recarga, y un worker relanzado tras un SIGHUP partiria de la anterior"""
+    global admission, trace_prefix
+    
+    trace_prefix = f"w{index}-"
+    
+    for position, backend in enumerate(router.backends):
+        backend.monitor = WorkerBackendMonitor(backend.monitor, position)
+        backend.wake = WorkerWakeController(backend.monitor)
+        backend.invalidate_status_cache()
+    
+    # El lanzador no arranco ningun hilo: vigilantes de whitelist (el monitor de un
+    # worker no sondea, solo lee lo que publica el supervisor)
+    whitelist.start()
+    for backend in router.backends:
+        backend.start()
+    threading.Thread(target=publish_worker_idle, args=(index,), name="idle-publisher", daemon=True).start()
+    
+    # El kernel reparte las conexiones de una misma IP entre todos los workers
+    admission = AdmissionControl(share=workers)
+    if reload:
+        reload_config()
+    
+    if METRICS_ENABLED:
+        start_metrics_server(METRICS_PORT + 1 + index)
+    
+    if engine == 'threads':
+        main_threads(listener, index)
+        return
+    asyncio.run(main_async(listener, index))
+
+class WorkerLauncher:
+    """Proceso sin hilos que crea los workers con fork, los espera y relanza los que mueren.
+    Recibe del supervisor las senales que debe reenviar a los workers (un numero por linea;
+    EOF = parar) y le cuenta por otro pipe cada worker que arranca o termina"""
+    
+    def __init__(self, workers, engine, listeners, orders, events):
+        self.workers = workers
+        self.engine = engine
+        self.listeners = listeners
+        self.orders = orders
+        self.events = events
+        self.children = {}
+        # Hubo un SIGHUP: los workers que se creen a partir de ahora releen la configuracion
+        self.reloaded = False
+        self.draining = False
+    
+    def run(self):
+        log_writer.discard()
+        signal.signal(signal.SIGTERM, raise_keyboard_interrupt)
+        # Las senales las atiende el supervisor y llegan por el pipe de ordenes. Los workers
+        # heredan SIG_IGN hasta instalar sus handlers: un SIGUSR2 temprano no los mata
+        for signum in (signal.SIGHUP, signal.SIGUSR1, signal.SIGUSR2):
+            signal.signal(signum, signal.SIG_IGN)
+        try:
+            for index in range(self.workers):
+                self._spawn(index)
+            pending = b''
+            while self.children or not self.draining:
+                # Sin SIGCHLD: un worker caido se detecta en el siguiente segundo
+                readable, _, _ = select.select([self.orders], [], [], 1)
+                if readable:
+                    data = os.read(self.orders, 4096)
+                    if not data:
+                        return
+                    *lines, pending = (pending + data).split(b'\n')
+                    for line in lines:
+                        self._forward(int(line))
+                self._reap()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stop()
+    
+    def _forward(self, signum):
+        if signum == signal.SIGHUP:
+            self.reloaded = True
+        elif signum == signal.SIGUSR2:
+            # Actualizacion: los workers drenan y ya no se relanzan
+            self.draining = True
+        for pid in list(self.children):
+            try:
+                os.kill(pid, signum)
+            except OSError:
+                pass
+    
+    def _reap(self):
+        while self.children:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+            if pid == 0:
+                return
+            index = self.children.pop(pid, None)
+            if index is None:
+                continue
+            self._report('terminado', index, pid, os.waitstatus_to_exitcode(status))
+            if not self.draining:
+                time.sleep(WORKER_RESTART_DELAY)
+                self._spawn(index)
+    
+    def _report(self, event, index, pid, code=None):
+        try:
+            os.write(self.events, json.dumps([event, index, pid, code]).encode('utf-8') + b'\n')
+        except OSError:
+            pass
+    
+    def _spawn(self, index):
+        flush_log()
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                global stop_accepting, still_busy
+                stop_accepting = None
+                still_busy = connections_open
+                os.close(self.orders)
+                os.close(self.events)
+                log_writer.discard()
+                log_writer.start()
+                signal.signal(signal.SIGTERM, raise_keyboard_interrupt)
+                install_profile_signal()
+                install_signal(signal.SIGHUP, handle_reload_signal)
+                install_signal(signal.SIGUSR2, handle_upgrade_signal)
+                for position, listener in enumerate(self.listeners):
+                    if position != index:
+                        listener.close()
+                run_worker(index, self.workers, self.listeners[index], self.engine, self.reloaded)
+            except KeyboardInterrupt:
+                pass
+            except BaseException as e:
+                log(ERROR, 'ERROR', "Error en worker {}: {}", index, e)
+                code = 1
+            finally:
+                # os._exit no pasa por atexit: la captura del worker se vuelca aqui
+                flush_capture()
+                flush_log()
+                os._exit(code)
+        self.children[pid] = index
+        self._report('arrancado', index, pid)
+    
+    def stop(self):
+        for pid in self.children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+        for pid in list(self.children):
+            try:
+                os.waitpid(pid, 0)
+            except OSError:
+                pass
+        self.children.clear()
+
+class Supervisor:
+    """Crea un socket SO_REUSEPORT por worker y los conserva abiertos: si un worker
+    muere, las conexiones que el kernel le asigna esperan en el backlog hasta que
+    el worker relanzado hereda el mismo socket.
+    El supervisor tiene hilos (sondeos, ordenes, HTTP, plazos) y un fork desde aqui podria
+    dejar en el worker un lock cogido para siempre: los workers los crea un WorkerLauncher
+    que se separa con start_launcher() antes de arrancar ningun hilo"""
+    
+    def __init__(self, workers, engine, listeners=None):
+        self.workers = workers
+        self.engine = engine
+        # Los sockets pueden venir heredados de una actualizacion (uno por worker)
+        self.listeners = listeners or []
+        # pid -> indice de los workers vivos, segun lo que cuenta el lanzador
+        self.children = {}
+        self.commands_read, self.commands_write = os.pipe()
+        self.launcher = None
+        self.launcher_orders = None
+        self.launcher_events = None
+    
+    def start_launcher(self, close_fds=()):
+        """Separa el proceso lanzador de workers. Hay que llamarlo antes de arrancar ningun
+        hilo; close_fds son descriptores de este proceso que el lanzador no debe retener"""
+        if not self.listeners:
+            self.listeners = [create_listener(reuse_port=True) for _ in range(self.workers)]
+        orders_read, orders_write = os.pipe()
+        events_read, events_write = os.pipe()
+        # Vaciar el registro antes del fork para no duplicar lineas pendientes
+        flush_log()
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                global supervisor_commands
+                for fd in (orders_write, events_read, self.commands_read) + tuple(close_fds):
+                    os.close(fd)
+                supervisor_commands = self.commands_write
+                os.set_blocking(supervisor_commands, False)
+                WorkerLauncher(self.workers, self.engine, self.listeners, orders_read, events_write).run()
+            except KeyboardInterrupt:
+                # systemctl stop manda SIGTERM a todo el grupo, tambien al lanzador
+                pass
+            except BaseException as e:
+                log(ERROR, 'ERROR', "Error en el lanzador de workers: {}", e)
+                code = 1
+            finally:
+                flush_log()
+                os._exit(code)
+        os.close(orders_read)
+        os.close(events_write)
+        # Solo los workers escriben ordenes: con todos muertos, _read_commands ve EOF
+        os.close(self.commands_write)
+        self.launcher = pid
+        self.launcher_orders = orders_write
+        self.launcher_events = events_read
+    
+    def run(self):
+        global stop_accepting, still_busy
+        
+        if self.launcher is None:
+            self.start_launcher()
+        log(INFO, 'SUPERVISOR', "Escuchando en {}:{} con {} workers (SO_REUSEPORT)",
+            PROXY_HOST, PROXY_PORT, self.workers)
+        print_backends()
+        threading.Thread(target=self._read_commands, name="supervisor-commands", daemon=True).start()
+        
+        # Al drenar tras una actualizacion son los workers los que dejan de aceptar
+        stop_accepting = lambda: self._signal_workers(signal.SIGUSR2)
+        still_busy = lambda: bool(self.children)
+        signal.signal(signal.SIGTERM, raise_keyboard_interrupt)
+        install_profile_signal(self._forwarding(handle_profile_signal))
+        install_signal(signal.SIGHUP, self._forwarding(handle_reload_signal))
+        install_signal(signal.SIGUSR2, handle_upgrade_signal)
+        try:
+            for event, index, pid, code in self._read_events():
+                if event == 'arrancado':
+                    self.children[pid] = index
+                    log(INFO, 'SUPERVISOR', "Worker {} arrancado (pid {})", index, pid)
+                    continue
+                self.children.pop(pid, None)
+                if draining.is_set():
+                    log(INFO, 'SUPERVISOR', "Worker {} (pid {}) drenado", index, pid)
+                    if not self.children:
+                        break
+                    continue
+                log(WARNING, 'SUPERVISOR', "Worker {} (pid {}) termino con codigo {} "
+                    "- relanzando en {}s", index, pid, code, WORKER_RESTART_DELAY)
+            else:
+                log(ERROR, 'SUPERVISOR', "El lanzador de workers termino inesperadamente - cerrando")
+                self._signal_orphans()
+        except KeyboardInterrupt:
+            log(INFO, 'SUPERVISOR', "Cerrando proxy...")
+        finally:
+            self.stop()
+    
+    def _read_events(self):
+        """Eventos del lanzador (evento, indice, pid, codigo) hasta que cierra el pipe"""
+        pending = b''
+        while True:
+            data = os.read(self.launcher_events, 4096)
+            if not data:
+                return
+            *lines, pending = (pending + data).split(b'\n')
+            for line in lines:
+                yield json.loads(line)
+    
+    def _signal_orphans(self):
+        """Sin lanzador nadie espera a los workers: pararlos directamente"""
+        for pid in self.children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+        self.children.clear()
+    
+    def _forwarding(self, handler):
+        """Handler de senal que actua en el supervisor y reenvia la senal a cada worker"""
+        def forward(signum, frame):
+            handler(signum, frame)
+            self._signal_workers(signum)
+        return forward
+    
+    def _signal_workers(self, signum):
+        """Las senales a los workers pasan por el lanzador, que sabe cuales estan vivos"""
+        if self.launcher_orders is None:
+            return
+        try:
+            os.write(self.launcher_orders, f"{int(signum)}\n".encode('ascii'))
+        except OSError:
+            pass
+    
+    def _read_commands(self):
+        """Atiende las ordenes de los workers: sondear o despertar un servidor"""
+        pending = b''
+        while True:
+            data = os.read(self.commands_read, 4096)
+            if not data:
+                return
+            *lines, pending = (pending + data).split(b'\n')
+            for line in lines:
+                try:
+                    command, index, argument = json.loads(line)
+                    backend = router.backends[index]
+                    if command == 'wake':
+                        backend.wake.request_wake(argument)
+                        # Corrige el flag adelantado por el worker (p. ej. si ya estaba listo)
+                        backend.wake.publish()
+                    elif command == 'unreachable':
+                        backend.monitor.report_unreachable()
+                    elif command == 'probe':
+                        backend.monitor.request_probe()
+                except Exception as e:
+                    log(WARNING, 'SUPERVISOR', "Orden invalida de un worker: {}", e)
+    
+    def stop(self):
+        # EOF en el pipe de ordenes: el lanzador para los workers, los espera y sale
+        if self.launcher_orders is not None:
+            os.close(self.launcher_orders)
+            self.launcher_orders = None
+        if self.launcher is not None:
+            try:
+                os.waitpid(self.launcher, 0)
+            except OSError:
+                pass
+            self.launcher = None
+        self.children.clear()
+        for listener in self.listeners:
+            listener.close()
+
+def raise_keyboard_interrupt(signum, frame):
+    """SIGTERM (systemctl stop) cierra igual que Ctrl+C"""
+    raise KeyboardInterrupt
+
+# --- RECARGA Y ACTUALIZACION ---
+
+# Opciones que solo se leen al arrancar: cambiarlas requiere una actualizacion (SIGUSR2)
+RESTART_KEYS = frozenset({
+    'PROXY_HOST', 'PROXY_PORT', 'PROXY_ENGINE', 'WORKERS', 'SHARED_STATUS_SIZE', 'LISTEN_BACKLOG',
+    'METRICS_ENABLED', 'METRICS_HOST', 'METRICS_PORT', 'IDLE_ENDPOINT_ENABLED', 'IDLE_ENDPOINT_HOST',
+    'IDLE_ENDPOINT_PORT', 'LOG_QUEUE_SIZE', 'CONFIG_PATH', 'HANDLER_POOL_SIZE', 'HANDLER_QUEUE_DEPTH',
+    'THREAD_STACK_SIZE', 'CAPTURE_DIR', 'CAPTURE_BUFFER_SIZE', 'QUERY_ENABLED', 'QUERY_HOST', 'QUERY_PORT',
+    'PREWAKE_ENABLED', 'PREWAKE_HISTORY_PATH',
+})
+# Variable de entorno con los descriptores que el proceso viejo pasa al nuevo
+UPGRADE_ENV = 'MCPROXY_UPGRADE'
+
+# Valores de la configuracion al arrancar (sin CONFIG_PATH): una opcion que se borra
+# del archivo vuelve a su valor original en la siguiente recarga
+config_defaults = {}
+reload_lock = threading.Lock()
+
+# Sockets de escucha de este proceso (los que hereda el proceso nuevo)
+listeners = []
+upgrade_lock = threading.Lock()
+draining = threading.Event()
+drained = threading.Event()
+def connections_open():
+    return bool(active_tunnels) or admission.active_handshakes > 0
+
+# Los fija el bucle de accept: dejar de aceptar, y si quedan conexiones por drenar
+stop_accepting = None
+still_busy = connections_open
+accept_interruptible = False
+# Actividad de los tuneles del proceso anterior mientras drena: nombre -> (tuneles, epoch)
+peer_idle = {}
+
+class StopAccepting(Exception):
+    """Saca al motor threads del accept cuando el proceso nuevo ya tiene el socket"""
+
+def read_config_file():
+    """Opciones de CONFIG_PATH (vacio si no existe)"""
+    if not CONFIG_PATH or not os.path.exists(CONFIG_PATH):
+        return {}
+    with open(CONFIG_PATH, 'r', encoding='utf-8') as f:
+        data = json.load(f)
+    if not isinstance(data, dict):
+        raise ValueError("se esperaba un objeto JSON")
+    return data
+
+def apply_config(data, initial=False):
+    """Copia las opciones a las globales del modulo. Devuelve los nombres que cambiaron"""
+    values = dict(config_defaults)
+    for key, value in data.items():
+        if key in CONFIG_KEYS:
+            values[key] = value
+        else:
+            log(WARNING, 'CONFIG', "Opcion desconocida en {}: {}", CONFIG_PATH, key)
+    changed = set()
+    for key, value in values.items():
+        if globals()[key] == value:
+            continue
+        if not initial and key in RESTART_KEYS:
+            log(WARNING, 'CONFIG', "{} solo se aplica al arrancar - usa kill -USR2 para actualizar", key)
+            continue
+        globals()[key] = value
+        changed.add(key)
+    return changed
+
+def load_config():
+    """Al arrancar: guarda los valores originales y aplica CONFIG_PATH encima"""
+    global config_defaults
+    config_defaults = {name: globals()[name] for name in CONFIG_KEYS}
+    try:
+        changed = apply_config(read_config_file(), initial=True)
+    except Exception as e:
+        log(ERROR, 'CONFIG', "Error leyendo {}: {} - usando la configuracion del script", CONFIG_PATH, e)
+        return
+    if changed:
+        log(INFO, 'CONFIG', "{} opciones cargadas desde {}", len(changed), CONFIG_PATH)
+
+def reload_config():
+    """Relee CONFIG_PATH, la whitelist, el icono y los MOTDs sin cerrar conexiones"""
+    with reload_lock:
+        log(INFO, 'CONFIG', "Recargando configuracion...")
+        try:
+            data = read_config_file()
+        except Exception as e:
+            log(ERROR, 'CONFIG', "Error leyendo {}: {} - se mantiene la configuracion actual", CONFIG_PATH, e)
+            return
+        changed = apply_config(data)
+        if 'LOG_LEVEL' in changed and LOG_LEVEL in LOG_LEVELS:
+            log_writer.level = LOG_LEVELS[LOG_LEVEL]
+        
+        whitelist.path = WHITELIST_PATH
+        whitelist.load()
+        load_server_icon()
+        update_backends()
+        admission.configure()
+        # Las plantillas de status y los mensajes se leen de las globales al construir cada respuesta
+        invalidate_status_cache()
+        log(INFO, 'CONFIG', "Configuracion recargada ({})", ', '.join(sorted(changed)) or 'sin cambios en las opciones')
+
+def handle_reload_signal(signum, frame):
+    """SIGHUP: recarga en un hilo aparte (no en medio del bucle de eventos o del accept)"""
+    threading.Thread(target=reload_config, name="reload", daemon=True).start()
+
+def handle_upgrade_signal(signum, frame):
+    """SIGUSR2: en el proceso principal arranca la actualizacion; en un worker (reenviada
+    por el supervisor) empieza el drenado"""
+    if draining.is_set():
+        # La envia stop_accepting al propio hilo principal para salir del accept bloqueado
+        if accept_interruptible:
+            raise StopAccepting
+        return
+    target = drain if supervisor_commands is not None else start_upgrade
+    threading.Thread(target=target, name="upgrade", daemon=True).start()
+
+def notify_systemd(message):
+    """Mensaje para systemd (Type=notify); no hace nada fuera de systemd"""
+    address = os.environ.get('NOTIFY_SOCKET')
+    if not address:
+        return
+    if address.startswith('@'):
+        address = '\0' + address[1:]
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sock:
+            sock.sendto(message.encode('utf-8'), address)
+    except OSError as e:
+        log(WARNING, 'PROXY', "No se pudo avisar a systemd: {}", e)
+
+def wait_upgrade_ready(fd, timeout):
+    """True si el proceso nuevo escribe en el pipe; EOF = murio antes de estar listo"""
+    readable, _, _ = select.select([fd], [], [], timeout)
+    return bool(readable) and os.read(fd, 1) == b'1'
+
+def start_upgrade():
+    """Arranca una copia nueva del proxy que hereda los sockets de escucha, espera a que
+    este lista y drena este proceso. Si la copia no arranca, este sigue como estaba"""
+    if draining.is_set() or not upgrade_lock.acquire(blocking=False):
+        log(INFO, 'UPGRADE', "Ya hay una actualizacion en curso")
+        return
+    try:
+        ready_read, ready_write = os.pipe()
+        idle_read, idle_write = os.pipe()
+        fds = [listener.fileno() for listener in listeners]
+        env = dict(os.environ)
+        env[UPGRADE_ENV] = json.dumps({"listeners": fds, "ready": ready_write, "idle": idle_read})
+        
+        # Los puertos HTTP pasan al proceso nuevo
+        close_http_servers()
+        log(INFO, 'UPGRADE', "Arrancando proceso nuevo con {} sockets de escucha heredados", len(fds))
+        flush_log()
+        try:
+            child = subprocess.Popen([sys.executable] + sys.argv, env=env, pass_fds=fds + [ready_write, idle_read])
+        finally:
+            os.close(ready_write)
+            os.close(idle_read)
+        
+        try:
+            ready = wait_upgrade_ready(ready_read, UPGRADE_READY_TIMEOUT)
+        finally:
+            os.close(ready_read)
+        if not ready:
+            log(ERROR, 'UPGRADE', "El proceso nuevo (pid {}) no arranco - se sigue con el actual", child.pid)
+            child.kill()
+            child.wait()
+            os.close(idle_write)
+            start_http_endpoints()
+            return
+        log(INFO, 'UPGRADE', "Proceso nuevo (pid {}) aceptando conexiones - drenando este", child.pid)
+        drain(idle_write)
+    except Exception as e:
+        log(ERROR, 'UPGRADE', "Error en la actualizacion: {}", e)
+    finally:
+        upgrade_lock.release()
+
+def drain(idle_write=None):
+    """Deja de aceptar y espera a que se cierren las conexiones abiertas. Mientras tanto
+    pasa la actividad de sus tuneles al proceso nuevo para el endpoint /idle"""
+    draining.set()
+    close_http_servers()
+    if stop_accepting is not None:
+        stop_accepting()
+    deadline = time.monotonic() + UPGRADE_DRAIN_TIMEOUT if UPGRADE_DRAIN_TIMEOUT else None
+    while still_busy():
+        if idle_write is not None:
+            send_peer_idle(idle_write)
+        if deadline is not None and time.monotonic() >= deadline:
+            log(WARNING, 'UPGRADE', "Drenado sin terminar tras {}s - cerrando igualmente", UPGRADE_DRAIN_TIMEOUT)
+            break
+        time.sleep(1)
+    if idle_write is not None:
+        send_peer_idle(idle_write)
+        os.close(idle_write)
+    log(INFO, 'UPGRADE', "Drenado completo")
+    drained.set()
+
+def send_peer_idle(fd):
+    state = {backend.name: backend.idle_state() for backend in router.backends}
+    try:
+        os.write(fd, (json.dumps(state) + '\n').encode('utf-8'))
+    except OSError:
+        pass
+
+def read_peer_idle(fd):
+    """Hilo del proceso nuevo: actividad del proceso viejo hasta que termina de drenar"""
+    global peer_idle
+    with os.fdopen(fd, 'rb') as stream:
+        for line in stream:
+            try:
+                peer_idle = {name: tuple(state) for name, state in json.loads(line).items()}
+            except ValueError:
+                continue
+    # El proceso viejo salio: su ultima actividad pasa a contar como la de tuneles cerrados
+    for backend in router.backends:
+        state = peer_idle.get(backend.name)
+        if state is not None:
+            backend.tunnel_closed(state[1])
+    peer_idle = {}
+
+def inherited_upgrade():
+    """Descriptores recibidos del proceso anterior (None si es un arranque normal)"""
+    value = os.environ.pop(UPGRADE_ENV, None)
+    return json.loads(value) if value else None
+
+def complete_upgrade(upgrade):
+    """Avisa al proceso viejo de que este ya acepta y pasa a ser el principal para systemd"""
+    threading.Thread(target=read_peer_idle, args=(upgrade["idle"],), name="peer-idle", daemon=True).start()
+    os.write(upgrade["ready"], b'1')
+    os.close(upgrade["ready"])
+
+# --- ARRANQUE ---
+
+def print_backends():
+    """Muestra la tabla de enrutado al arrancar"""
+    for backend in router.backends:
+        hostnames = ", ".join(backend.hostnames) or "(sin hostnames)"
+        default = " [por defecto]" if backend is router.default else ""
+        log(INFO, 'PROXY', "Servidor {}: {}:{} <- {}{}", backend.name, backend.host, backend.port, hostnames, default)
+
+def parse_args():
+    """Opciones de linea de comandos"""
+    parser = argparse.ArgumentParser(description="Proxy de Minecraft con Wake-on-LAN")
+    parser.add_argument('--engine', choices=['asyncio', 'threads'], default=PROXY_ENGINE,
+                        help="Motor de conexiones (por defecto: %(default)s)")
+    parser.add_argument('--workers', type=int, default=WORKERS,
+                        help="Procesos worker con SO_REUSEPORT; 0 = uno por nucleo (por defecto: %(default)s)")
+    parser.add_argument('--log-level', choices=list(LOG_LEVELS), default=LOG_LEVEL,
+                        help="Nivel minimo de registro (por defecto: %(default)s)")
+    return parser.parse_args()
+
+def main():
+    global router, admission
+    
+    # Opciones de CONFIG_PATH (antes de la linea de comandos, que toma de ahi sus valores por defecto)
+    load_config()
+    args = parse_args()
+    
+    # Registro asincrono: los handlers solo encolan (el hilo escritor arranca mas abajo)
+    log_writer.level = LOG_LEVELS[args.log_level]
+    log_writer.queue_size = LOG_QUEUE_SIZE
+    log_writer.flush_interval = LOG_FLUSH_INTERVAL
+    install_profile_signal()
+    install_signal(signal.SIGHUP, handle_reload_signal)
+    install_signal(signal.SIGUSR2, handle_upgrade_signal)
+    # Sin esto SIGTERM mata el proceso sin pasar por atexit y se pierde el registro encolado
+    install_signal(signal.SIGTERM, raise_keyboard_interrupt)
+    
+    # Cargar whitelist al iniciar (el vigilante arranca con los demas hilos)
+    load_whitelist()
+    
+    # Cargar icono al iniciar
+    load_server_icon()
+    
+    # Control de admision del accept
+    admission = AdmissionControl()
+    
+    workers = args.workers if args.workers > 0 else (os.cpu_count() or 1)
+    
+    # Sockets de escucha: heredados del proceso anterior (SIGUSR2) o nuevos
+    upgrade = inherited_upgrade()
+    if upgrade is not None:
+        listeners[:] = [socket.socket(fileno=fd) for fd in upgrade["listeners"]]
+        if listeners[0].getsockname() != (PROXY_HOST, PROXY_PORT):
+            # Nueva direccion de escucha: la anterior se cierra al drenar el proceso viejo
+            for listener in listeners:
+                listener.close()
+            listeners.clear()
+        elif len(listeners) != workers:
+            log(WARNING, 'UPGRADE', "Se heredaron {} sockets de escucha - usando {} "
+                "workers en vez de {} (cambiar WORKERS requiere reiniciar)", len(listeners), len(listeners), workers)
+            workers = len(listeners)
+    if not listeners:
+        try:
+            listeners[:] = [create_listener(reuse_port=workers > 1) for _ in range(workers)]
+        except OSError as e:
+            log(ERROR, 'ERROR', "Error en main: {}", e)
+            return
+    
+    # Servidores reales: tabla de enrutado y sondeo en segundo plano de cada uno
+    router = build_router()
+    supervisor = None
+    if workers > 1:
+        share_backend_state(workers)
+        # El lanzador de workers se separa mientras este proceso aun no tiene hilos
+        supervisor = Supervisor(workers, args.engine, listeners)
+        supervisor.start_launcher(close_fds=(upgrade["ready"], upgrade["idle"]) if upgrade is not None else ())
+    
+    log_writer.start()
+    whitelist.start()
+    for backend in router.backends:
+        backend.start()
+    
+    # Metricas y actividad de los tuneles (en el supervisor si hay workers)
+    start_http_endpoints()
+    if PREWAKE_ENABLED:
+        start_prewake()
+    
+    # Los sockets ya escuchan: lo que llegue espera en el backlog hasta el primer accept
+    if upgrade is not None:
+        complete_upgrade(upgrade)
+    notify_systemd(f"READY=1\nMAINPID={os.getpid()}")
+    
+    if supervisor is not None:
+        supervisor.run()
+        return
+    
+    if args.engine == 'threads':
+        main_threads(listeners[0])
+        return
+    
+    try:
+        asyncio.run(main_async(listeners[0]))
+    except KeyboardInterrupt:
+        log(INFO, 'PROXY', "Cerrando proxy...")
+    except Exception as e:
+        log(ERROR, 'ERROR', "Error en main: {}", e)
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()